@@ -1 +1,4 @@
-__all__ = ["bpmn_model", "n_gram_index", "petri_net", "reachability_graph", "utils"]
+__all__ = [
+    "bloom_filter", "bpmn_model", "case_tracker", "frozen_n_gram_index", "n_gram_index", "n_gram_storage", "petri_net",
+    "reachability_graph", "reverse_suffix_automaton", "sqlite_n_gram_index", "utils"
+]
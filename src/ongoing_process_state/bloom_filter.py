@@ -0,0 +1,56 @@
+import math
+import struct
+from pathlib import Path
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set to rapidly discard items that were never added: if an item is not in the filter, it was
+    not added; if it is in the filter, it was added with a probability of (1 - false positive rate). The items are
+    given by their (64-bit) hash, so the caller chooses a hash that is cheap for its items and stable across processes
+    if the filter is persisted.
+    """
+
+    def __init__(self, num_items: int, false_positive_rate: float = 0.01):
+        if not 0.0 < false_positive_rate < 1.0:
+            raise RuntimeError(f"Error, the false positive rate must be in (0, 1), got {false_positive_rate}.")
+        num_items = max(num_items, 1)
+        self.false_positive_rate = false_positive_rate
+        # Optimal number of bits and hash functions for the expected number of items
+        self.num_bits = max(8, math.ceil(-num_items * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / num_items * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _get_positions(self, item_hash: int):
+        # Double hashing: derive all the positions from the two halves of the hash
+        first_hash = item_hash & 0xffffffff
+        second_hash = ((item_hash >> 32) & 0xffffffff) | 1
+        return ((first_hash + i * second_hash) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item_hash: int):
+        for position in self._get_positions(item_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item_hash: int) -> bool:
+        for position in self._get_positions(item_hash):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_file(self, file_path: Path):
+        with open(file_path, "wb") as output_file:
+            output_file.write(struct.pack("<dQI", self.false_positive_rate, self.num_bits, self.num_hashes))
+            output_file.write(self.bits)
+
+    @staticmethod
+    def from_file(file_path: Path) -> 'BloomFilter':
+        with open(file_path, "rb") as input_file:
+            header = input_file.read(struct.calcsize("<dQI"))
+            (false_positive_rate, num_bits, num_hashes) = struct.unpack("<dQI", header)
+            bloom_filter = BloomFilter(1, false_positive_rate)
+            bloom_filter.num_bits = num_bits
+            bloom_filter.num_hashes = num_hashes
+            bloom_filter.bits = bytearray(input_file.read())
+        if len(bloom_filter.bits) != (num_bits + 7) // 8:
+            raise RuntimeError(f"Problem with format of Bloom filter file: {file_path}.")
+        return bloom_filter
@@ -0,0 +1,64 @@
+from typing import Dict, FrozenSet, Hashable, List, Tuple
+
+from ongoing_process_state.n_gram_index import NGramIndex
+
+
+class CaseTracker:
+    """
+    Track the state of ongoing cases event by event over an n-gram index. For each case, the tracker keeps the suffixes
+    of its trace that are the prefix of some n-gram of the index, each of them with its rolling hash (see
+    [NGramIndex.extend_rolling_suffixes]). Each new event updates the hash of every suffix in O(n) integer operations,
+    and the index is probed directly with these hashes, without building the key of any n-gram.
+    """
+
+    def __init__(self, n_gram_index: NGramIndex):
+        self.n_gram_index = n_gram_index
+        # Dict with the case ID as key, and the suffixes of its trace as value
+        self._cases: Dict[Hashable, List[Tuple[int, int, int]]] = {}
+
+    def start_case(self, case_id: Hashable):
+        """
+        Start tracking a case with no recorded events, i.e., with [NGramIndex.TRACE_START] as its only activity.
+        """
+        self._cases[case_id] = NGramIndex.get_empty_rolling_suffixes()
+        self._add_activity(case_id, NGramIndex.TRACE_START)
+
+    def update(self, case_id: Hashable, activity: str) -> int:
+        """
+        Record a new event of a case (starting to track it if it was not tracked yet) and compute its new state.
+        Activities that are not in the reachability graph are filtered out, as in [NGramIndex.get_best_marking_id_for].
+
+        :param case_id: ID of the case of the event.
+        :param activity: label of the activity executed in the event.
+        :return: the ID of the marking corresponding to the state of the case after the event.
+        """
+        if case_id not in self._cases:
+            self.start_case(case_id)
+        self._add_activity(case_id, activity)
+        return self.get_best_marking_id(case_id)
+
+    def _add_activity(self, case_id: Hashable, activity: str):
+        code = self.n_gram_index.activity_codes.get(activity)
+        if code is not None:
+            self._cases[case_id] = self.n_gram_index.extend_rolling_suffixes(self._cases[case_id], code)
+
+    def get_best_marking_id(self, case_id: Hashable) -> int:
+        """
+        Retrieve the ID of the marking corresponding to the current state of a tracked case.
+        """
+        return self.n_gram_index.get_best_marking_id_for_rolling_suffixes(self._cases[case_id])
+
+    def get_best_marking_state(self, case_id: Hashable) -> FrozenSet[str]:
+        """
+        Retrieve the marking (set of enabled flows) corresponding to the current state of a tracked case.
+        """
+        return self.n_gram_index.graph.frozen_markings[self.get_best_marking_id(case_id)]
+
+    def end_case(self, case_id: Hashable):
+        """
+        Stop tracking a (finished) case.
+        """
+        self._cases.pop(case_id, None)
+
+    def __len__(self) -> int:
+        return len(self._cases)
@@ -0,0 +1,277 @@
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, FrozenSet
+
+import numpy as np
+
+from ongoing_process_state.reachability_graph import ReachabilityGraph
+
+_MASK = (1 << 64) - 1
+
+
+def _hash(key: Tuple[int, ...], seed: int) -> int:
+    """
+    64-bit hash of a tuple of activity codes. The built-in hash of a tuple of ints does not depend on the hash
+    randomization of the process (it only applies to str and bytes), and it is computed in C, so it is both stable
+    and cheap. The stability across Python builds is verified when reading a frozen index from a file.
+    """
+    return hash((seed,) + key) & _MASK
+
+
+class FrozenNGramIndex:
+    """
+    Read-only version of an n-gram index (see NGramIndex.freeze) for static deployments. The n-grams (encoded as
+    tuples of activity codes) are stored in flat arrays, indexed by a minimal perfect hash built with the
+    hash-and-displace method (CHD): the n-grams are distributed in buckets, and each bucket stores the displacement
+    (d0, d1) that maps all its n-grams to free slots with (h1 + d0 * h2 + d1) mod N, being h1 and h2 the two halves of
+    a second hash of the n-gram (or, for buckets with one n-gram, directly its slot as a negative value). If some bucket
+    cannot be displaced, the construction restarts with another seed for the hashes. Each lookup computes two hashes
+    and verifies the n-gram stored in the slot, returning the same result as the original index.
+    """
+
+    BUCKET_SIZE = 4  # Average number of n-grams per bucket of the perfect hash
+
+    def __init__(self, graph: ReachabilityGraph, n_gram_size_limit: int, activity_codes: Dict[str, int]):
+        self.graph = graph
+        self.n_gram_size_limit = n_gram_size_limit
+        self.activity_codes = activity_codes  # Dict with activity label as key, and its (int) code as value
+        self.num_n_grams = 0
+        self.seed = 0  # Seed of the hashes of the minimal perfect hash
+        self.max_n_gram_size = 0  # Size of the longest n-gram in the index
+        self.displacements = array("q")  # Displacement d0 * N + d1 of each bucket (or -(slot + 1) for single ones)
+        self.key_offsets = array("I", [0])  # Start of the n-gram of each slot in [self.key_codes]
+        self.key_codes = array("i")  # Activity codes of the n-grams of all slots
+        self.marking_offsets = array("I", [0])  # Start of the marking IDs of each slot in [self.marking_ids]
+        self.marking_ids = array("i")  # Marking IDs of the n-grams of all slots
+        self.resolutions = array("i")  # Best marking ID of the n-gram of each slot
+
+    @staticmethod
+    def build(
+            graph: ReachabilityGraph,
+            n_gram_size_limit: int,
+            activity_codes: Dict[str, int],
+            n_grams: Dict[Tuple[int, ...], Tuple[FrozenSet[int], int]],
+    ) -> 'FrozenNGramIndex':
+        """
+        Build the frozen index for the given n-grams.
+
+        :param graph: reachability graph of the index.
+        :param n_gram_size_limit: maximum size of the n-grams in the index.
+        :param activity_codes: dict with the code of each activity label.
+        :param n_grams: dict with the encoded n-grams as key, and their marking IDs and best marking ID as value.
+        :return: the frozen index.
+        """
+        frozen_index = FrozenNGramIndex(graph, n_gram_size_limit, activity_codes)
+        frozen_index.num_n_grams = len(n_grams)
+        frozen_index.max_n_gram_size = max([len(n_gram) for n_gram in n_grams], default=0)
+        # Search for a seed of the hashes with which all buckets can be displaced to free slots
+        slots = None
+        while slots is None:
+            frozen_index.seed += 1
+            slots = frozen_index._place_n_grams(list(n_grams))
+        # Store the n-grams, their markings, and their resolutions in slot order
+        for n_gram in slots:
+            (markings, resolution) = n_grams[n_gram]
+            frozen_index.key_codes.extend(n_gram)
+            frozen_index.key_offsets.append(len(frozen_index.key_codes))
+            frozen_index.marking_ids.extend(sorted(markings))
+            frozen_index.marking_offsets.append(len(frozen_index.marking_ids))
+            frozen_index.resolutions.append(resolution)
+        # Return frozen index
+        return frozen_index
+
+    def _place_n_grams(self, n_grams: List[Tuple[int, ...]]) -> Optional[List[Tuple[int, ...]]]:
+        """
+        Distribute the n-grams in buckets with the current seed, and search the displacement of each bucket (storing
+        them in [self.displacements]). The search for a bucket is bounded to the N^2 possible displacements, as two
+        n-grams with the same pair of second hashes cannot be separated by any of them.
+
+        :param n_grams: list with the encoded n-grams to place.
+        :return: the n-gram placed in each slot, or None if some bucket cannot be displaced with the current seed.
+        """
+        num_n_grams = len(n_grams)
+        # Distribute the n-grams in buckets
+        num_buckets = max(1, (num_n_grams + FrozenNGramIndex.BUCKET_SIZE - 1) // FrozenNGramIndex.BUCKET_SIZE)
+        buckets = [[] for _ in range(num_buckets)]
+        for n_gram in n_grams:
+            buckets[_hash(n_gram, self.seed) % num_buckets] += [n_gram]
+        # Search the displacement of each bucket, starting with the biggest ones
+        displacements = [0] * num_buckets
+        slots = [None] * num_n_grams
+        free_slots = None
+        for bucket_id in sorted(range(num_buckets), key=lambda i: len(buckets[i]), reverse=True):
+            bucket = buckets[bucket_id]
+            if len(bucket) == 0:
+                break
+            elif len(bucket) == 1:
+                # Bucket with one n-gram, assign directly the next free slot
+                if free_slots is None:
+                    free_slots = iter([slot for slot in range(num_n_grams) if slots[slot] is None])
+                slot = next(free_slots)
+                slots[slot] = bucket[0]
+                displacements[bucket_id] = -(slot + 1)
+                continue
+            hashes = [self._get_second_hashes(n_gram) for n_gram in bucket]
+            if len(set(hashes)) < len(bucket):
+                # Indistinguishable n-grams, no displacement can separate them
+                return None
+            positions = None
+            for displacement in range(num_n_grams * num_n_grams):
+                (d0, d1) = divmod(displacement, num_n_grams)
+                positions = [(first + d0 * second + d1) % num_n_grams for first, second in hashes]
+                if len(set(positions)) == len(bucket) and all(slots[position] is None for position in positions):
+                    displacements[bucket_id] = displacement
+                    break
+                positions = None
+            if positions is None:
+                # No displacement maps this bucket to free slots
+                return None
+            for n_gram, position in zip(bucket, positions):
+                slots[position] = n_gram
+        self.displacements = array("q", displacements)
+        return slots
+
+    def __len__(self) -> int:
+        return self.num_n_grams
+
+    def _get_second_hashes(self, n_gram_key: Tuple[int, ...]) -> Tuple[int, int]:
+        value = _hash(n_gram_key, -self.seed)
+        num_n_grams = self.num_n_grams
+        return (value & 0xffffffff) % num_n_grams, ((value >> 32) % (num_n_grams - 1) + 1) if num_n_grams > 1 else 1
+
+    def _get_slot(self, n_gram_key: Tuple[int, ...]) -> Optional[int]:
+        """
+        Search for the slot of an encoded n-gram, or None if it is not in the index.
+        """
+        if self.num_n_grams == 0:
+            return None
+        displacement = self.displacements[_hash(n_gram_key, self.seed) % len(self.displacements)]
+        if displacement < 0:
+            slot = -displacement - 1
+        else:
+            (d0, d1) = divmod(displacement, self.num_n_grams)
+            (first, second) = self._get_second_hashes(n_gram_key)
+            slot = (first + d0 * second + d1) % self.num_n_grams
+        # Verify the n-gram stored in the slot (lengths first, to avoid copying the codes of most misses)
+        (start, end) = (self.key_offsets[slot], self.key_offsets[slot + 1])
+        if end - start == len(n_gram_key) and tuple(self.key_codes[start:end]) == n_gram_key:
+            return slot
+        return None
+
+    def _get_key(self, n_gram: List[str]) -> Optional[Tuple[int, ...]]:
+        key = tuple(self.activity_codes.get(label) for label in n_gram)
+        return None if None in key else key
+
+    def get_marking_ids(self, n_gram: List[str]) -> FrozenSet[int]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the IDs (in the reachability
+        graph) of the markings associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: an immutable set with the ID(s) of the marking(s) corresponding to the state of the process.
+        """
+        n_gram_key = self._get_key(n_gram)
+        slot = self._get_slot(n_gram_key) if n_gram_key is not None else None
+        if slot is None:
+            return frozenset()
+        return frozenset(self.marking_ids[self.marking_offsets[slot]:self.marking_offsets[slot + 1]])
+
+    def get_marking_state(self, n_gram: List[str]) -> List[FrozenSet[str]]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the list of markings (set of
+        enabled flows) associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: a list with the marking(s) corresponding to the state of the process.
+        """
+        return [self.graph.frozen_markings[marking] for marking in self.get_marking_ids(n_gram)]
+
+    def get_best_marking_id_for(self, n_gram: List[str]) -> int:
+        """
+        Same as NGramIndex.get_best_marking_id_for: the best marking is the precomputed resolution of the longest
+        suffix of the (filtered) n-gram present in the index.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the ID of the marking corresponding to the state of the case given the last N activities.
+        """
+        # Filter out nonexistent (in the reachability graph) activities, and encode the n-gram
+        n_gram_key = tuple(self.activity_codes[label] for label in n_gram if label in self.activity_codes)
+        upper = min(len(n_gram_key), self.max_n_gram_size)
+        if upper == 0:
+            return self.graph.initial_marking_id
+        # Search for the longest suffix
+        slot = self._get_slot(n_gram_key[-upper:])
+        if slot is not None:
+            return self.resolutions[slot]
+        # Binary search keeping [lower] as a suffix in the index (or 0) and [upper] as a suffix not in the index
+        lower, final_marking = 0, self.graph.initial_marking_id
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            slot = self._get_slot(n_gram_key[-middle:])
+            if slot is None:
+                upper = middle
+            else:
+                lower, final_marking = middle, self.resolutions[slot]
+        # Return found marking
+        return final_marking
+
+    def get_best_marking_state_for(self, n_gram: List[str]) -> FrozenSet[str]:
+        """
+        Same as NGramIndex.get_best_marking_state_for.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the marking corresponding to the state of the case given the last N activities.
+        """
+        return self.graph.frozen_markings[self.get_best_marking_id_for(n_gram)]
+
+    def to_file(self, file_path: Path):
+        """
+        Store the frozen index in a (NumPy .npz) binary file. The reachability graph must be stored separately.
+        """
+        labels = sorted(self.activity_codes, key=lambda label: self.activity_codes[label])
+        with open(file_path, "wb") as output_file:
+            np.savez(
+                output_file,
+                header=np.array(
+                    [self.n_gram_size_limit, self.num_n_grams, self.max_n_gram_size, self.seed],
+                    dtype=np.int64,
+                ),
+                activity_labels=np.array(labels, dtype=str),
+                activity_codes=np.array([self.activity_codes[label] for label in labels], dtype=np.int64),
+                displacements=np.frombuffer(self.displacements, dtype=np.dtype("q")),
+                key_offsets=np.frombuffer(self.key_offsets, dtype=np.dtype("I")),
+                key_codes=np.frombuffer(self.key_codes, dtype=np.dtype("i")),
+                marking_offsets=np.frombuffer(self.marking_offsets, dtype=np.dtype("I")),
+                marking_ids=np.frombuffer(self.marking_ids, dtype=np.dtype("i")),
+                resolutions=np.frombuffer(self.resolutions, dtype=np.dtype("i")),
+            )
+
+    @staticmethod
+    def from_file(file_path: Path, reachability_graph: ReachabilityGraph) -> 'FrozenNGramIndex':
+        with open(file_path, "rb") as input_file:
+            data = np.load(input_file)
+            (n_gram_size_limit, num_n_grams, max_n_gram_size, seed) = [int(value) for value in data["header"]]
+            activity_codes = {
+                str(label): int(code)
+                for label, code in zip(data["activity_labels"], data["activity_codes"])
+            }
+            frozen_index = FrozenNGramIndex(reachability_graph, n_gram_size_limit, activity_codes)
+            frozen_index.num_n_grams = num_n_grams
+            frozen_index.max_n_gram_size = max_n_gram_size
+            frozen_index.seed = seed
+            for name, typecode in [
+                ("displacements", "q"),
+                ("key_offsets", "I"),
+                ("key_codes", "i"),
+                ("marking_offsets", "I"),
+                ("marking_ids", "i"),
+                ("resolutions", "i"),
+            ]:
+                setattr(frozen_index, name, array(typecode, data[name].astype(np.dtype(typecode)).tobytes()))
+        # Verify the hashes of this Python build place each n-gram in the slot where it was stored
+        for slot in range(num_n_grams):
+            (start, end) = (frozen_index.key_offsets[slot], frozen_index.key_offsets[slot + 1])
+            n_gram_key = tuple(frozen_index.key_codes[start:end])
+            if frozen_index._get_slot(n_gram_key) != slot:
+                raise RuntimeError(f"Error, the perfect hash of {file_path} is not valid in this Python build.")
+        return frozen_index
@@ -1,35 +1,374 @@
 import ast
-import random
+import itertools
+import math
+import os
 import re
+import threading
+import time
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
 from pathlib import Path
-from typing import Set, List
+from typing import Set, List, Optional, Tuple, Dict, FrozenSet, Iterable, Iterator, Callable
 
+import numpy as np
+
+from ongoing_process_state.bloom_filter import BloomFilter
+from ongoing_process_state.frozen_n_gram_index import FrozenNGramIndex
+from ongoing_process_state.n_gram_storage import SQLiteNGramTier
 from ongoing_process_state.reachability_graph import ReachabilityGraph
+from ongoing_process_state.sqlite_n_gram_index import SQLiteNGramIndex
+
+
+class NGramIndexLayout(Enum):
+    DICT = "DICT"  # Lookups probe the map of n-grams once for each k-gram
+    TRIE = "TRIE"  # Lookups walk a trie with the n-grams read backwards (from the last activity)
+
+
+class SuffixTrieNode:
+    __slots__ = ("children", "markings", "resolution")
+
+    def __init__(self):
+        self.children: Dict = {}  # Dict with the previous activity (label or code) as key, and its node as value
+        self.markings: FrozenSet[int] = frozenset()  # Marking IDs associated to the n-gram ending in this node
+        self.resolution: Optional[int] = None  # ID of the best marking for the n-gram ending in this node
 
 
 class NGramIndex:
     TRACE_START = "DEFAULT_TRACE_START_LABEL"
+    PAD_CODE = -1  # Code to (left) pad the encoded n-grams of a batch to the same length
+    ROLLING_HASH_BASE = 1_000_003  # Base of the polynomial (rolling) hash of the encoded n-grams
+    ROLLING_HASH_MODULUS = (1 << 61) - 1  # Modulus (Mersenne prime) of the polynomial (rolling) hash
+    BUILD_CHECKPOINT_INTERVAL = 10_000  # Number of paths expanded between the checks of the budgets of a build
+    # (and the saves of its checkpoint)
 
-    def __init__(self, graph: ReachabilityGraph, n_gram_size_limit: int = 5):
+    def __init__(
+            self,
+            graph: ReachabilityGraph,
+            n_gram_size_limit: int = 5,
+            encode_activities: bool = False,
+            layout: NGramIndexLayout = NGramIndexLayout.DICT,
+            cache_size: int = 0,
+            bloom_false_positive_rate: Optional[float] = None,
+            lazy: bool = False,
+            lazy_file_path: Optional[Path] = None,
+            partial_order: bool = False,
+    ):
+        if lazy and partial_order:
+            raise RuntimeError("Error, an index with partial-order keys cannot be lazy.")
         self.graph = graph
         self.n_gram_size_limit = n_gram_size_limit
-        self.markings = {}  # Dict with the N-Gram (tuple) as key and list with marking ID(s) as value
+        self.encode_activities = encode_activities  # Store the n-grams as tuples of activity codes instead of labels
+        self.layout = layout  # Structure used to search for the best marking of an n-gram
+        self.activity_codes = {}  # Dict with activity label as key, and its (int) code as value
+        self.activity_labels = []  # List with the activity label of each code (inverse of [self.activity_codes])
+        self.markings = {}  # Dict with the N-Gram (tuple) as key and (frozen)set with marking ID(s) as value
+        self.suffix_trie = None  # Root of the trie with the n-grams read backwards (only with TRIE layout)
+        self.resolutions = None  # Dict with the N-Gram (tuple) as key and its best marking ID and size k as value
+        self._max_n_gram_size = 0  # Size of the longest n-gram in [self.resolutions]
+        self._batch_tables = None  # Sorted arrays of packed k-grams for batch lookups (built on first use)
+        self._rolling_hash_table = None  # Table of n-grams by rolling hash for the case trackers (built on first use)
+        self.bloom_false_positive_rate = bloom_false_positive_rate  # Rate of the Bloom filter (None to disable it)
+        self.bloom_filter = None  # Bloom filter with all the n-grams in [self.markings] to rapidly discard misses
+        self.cache_size = cache_size  # Maximum number of n-grams in the LRU cache of best markings (0 to disable it)
+        self.cache_hits = 0  # Number of searches of the best marking answered by the cache
+        self.cache_misses = 0  # Number of searches of the best marking not present in the cache
+        self._cache = OrderedDict()  # Dict with the queried n-gram (tuple) as key and its best marking ID as value
+        self.tier_split = None  # Maximum size of the n-grams kept in [self.markings] (None if the index is not tiered)
+        self.disk_tier = None  # Disk-backed store with the n-grams longer than [self.tier_split] (None if not tiered)
+        self.lazy = lazy  # Compute the markings of each n-gram from the graph when first queried, instead of building
+        self.lazy_file_path = lazy_file_path  # File where the n-grams computed on demand are persisted (None to not)
+        self._missing_n_grams = set()  # N-grams computed on demand that are not in the index
+        self.partial_order = partial_order  # Key the runs of concurrent activities as multisets (sorted tuples)
+        self._concurrent_activities = {}  # Dict with the activity (key) as key and its concurrent activities as value
+        self.truncated = False  # Whether the last build was stopped (at a budget) before reaching the size limit
+        self._update_activity_codes()
+        if self.lazy and self.lazy_file_path is not None and Path(self.lazy_file_path).exists():
+            # Preload the n-grams computed on demand in previous runs
+            with open(self.lazy_file_path, "r") as input_file:
+                for line in input_file:
+                    if line.strip() != "":
+                        (n_gram_key, markings) = self._parse_line(line)
+                        self.markings[n_gram_key] = frozenset(markings)
 
-    def add_associations(self, n_gram: List[str], markings: Set[str]):
-        n_gram_key = tuple(n_gram)
+    def _update_activity_codes(self):
+        """
+        Assign an integer code to each activity label of the reachability graph that has no code yet. The trace start
+        label is always encoded as 0, and the codes already assigned are never modified, so keys previously encoded
+        remain valid when the graph grows.
+        """
+        if NGramIndex.TRACE_START not in self.activity_codes:
+            self.activity_codes[NGramIndex.TRACE_START] = 0
+            self.activity_labels += [NGramIndex.TRACE_START]
+        for label in sorted(self.graph.activity_to_edges):
+            if label not in self.activity_codes:
+                self.activity_codes[label] = len(self.activity_codes)
+                self.activity_labels += [label]
+
+    def _get_key(self, n_gram: List[str]) -> Optional[tuple]:
+        """
+        Transform an n-gram (list of activity labels) into the key used to store it in the index, i.e., a tuple of
+        activity labels, or a tuple of activity codes if the index encodes the activities.
+
+        :param n_gram: list of activity labels.
+        :return: the key of the n-gram in the index, or None if it has a label without code.
+        """
+        if not self.encode_activities:
+            return tuple(n_gram)
+        key = tuple(self.activity_codes.get(label) for label in n_gram)
+        return None if None in key else key
+
+    def _get_labels(self, n_gram_key: tuple) -> Tuple[str, ...]:
+        """
+        Transform a key of the index back into its tuple of activity labels.
+        """
+        if not self.encode_activities:
+            return n_gram_key
+        if self.partial_order:
+            # The runs of concurrent activities of a partial-order key are tuples of codes
+            return tuple(
+                tuple(self.activity_labels[code] for code in element)
+                if isinstance(element, tuple) else self.activity_labels[element]
+                for element in n_gram_key
+            )
+        return tuple(self.activity_labels[code] for code in n_gram_key)
+
+    def _add_association(self, n_gram_key: tuple, markings: Set[int]):
         if n_gram_key in self.markings:
             self.markings[n_gram_key] |= markings
         else:
-            self.markings[n_gram_key] = markings
+            self.markings[n_gram_key] = set(markings)
 
-    def add_association(self, n_gram: List[str], marking: str):
-        n_gram_key = tuple(n_gram)
-        if n_gram_key in self.markings:
-            self.markings[n_gram_key] |= {marking}
+    def _get_marking_ids(self, n_gram_key: Optional[tuple]) -> FrozenSet[int]:
+        if n_gram_key is None:
+            return frozenset()
+        if self.lazy and n_gram_key not in self.markings:
+            return self._compute_marking_ids(n_gram_key)
+        if self.partial_order:
+            return self._get_partial_order_marking_ids(n_gram_key)
+        if self.disk_tier is not None and len(n_gram_key) > self.tier_split:
+            # Deep n-gram, search in the disk tier only if it might be there
+            stored = self.disk_tier.get(self._get_labels(n_gram_key)) if self._may_contain(n_gram_key) else None
+            return frozenset() if stored is None else stored[0]
+        return self.markings.get(n_gram_key, frozenset())
+
+    def _compute_marking_ids(self, n_gram_key: tuple) -> FrozenSet[int]:
+        """
+        Compute on demand (lazy mode) the marking IDs of an n-gram not computed yet, with the same result as a complete
+        build: the n-gram is in the index if it is within the size limit, its suffix of size n-1 is in the index and
+        non-deterministic (for n > 1), and it can be read backwards in the reachability graph. The result is memoised
+        (and persisted in [self.lazy_file_path], if any).
+        """
+        if n_gram_key in self._missing_n_grams:
+            return frozenset()
+        markings = frozenset()
+        if 0 < len(n_gram_key) <= self.n_gram_size_limit and (
+                len(n_gram_key) == 1 or len(self._get_marking_ids(n_gram_key[1:])) > 1
+        ):
+            markings = self._search_marking_ids_backwards(self._get_labels(n_gram_key))
+        # Memoise the result
+        if len(markings) == 0:
+            self._missing_n_grams.add(n_gram_key)
         else:
-            self.markings[n_gram_key] = {marking}
+            self.markings[n_gram_key] = markings
+            if self.lazy_file_path is not None:
+                with open(self.lazy_file_path, "a") as output_file:
+                    output_file.write(self._format_line(n_gram_key, markings))
+        return markings
+
+    def _search_marking_ids_backwards(self, n_gram: Tuple[str, ...]) -> FrozenSet[int]:
+        """
+        Search for the markings reached by an n-gram reading it backwards from its last activity over the incoming
+        edges of the reachability graph (see [_search_paths_backwards]).
+        """
+        return frozenset(target_marking for target_marking, _ in self._search_paths_backwards(n_gram))
+
+    def _search_paths_backwards(self, n_gram: Tuple[str, ...]) -> Set[Tuple[int, Optional[int]]]:
+        """
+        Search for the paths of an n-gram reading it backwards from its last activity over the incoming edges of the
+        reachability graph, as the pairs (target marking, current marking) of each path. The current marking is None
+        if the path reached the trace start.
+        """
+        pairs = None  # None represents the pairs (m, m) of all markings, to avoid materializing them
+        for label in reversed(n_gram):
+            if label == NGramIndex.TRACE_START:
+                # Trace start: keep the paths starting at the initial marking (nothing can be read before)
+                initial_marking_id = self.graph.initial_marking_id
+                pairs = {(initial_marking_id, initial_marking_id)} if pairs is None else pairs
+                pairs = {
+                    (target_marking, None) for target_marking, marking_id in pairs if marking_id == initial_marking_id
+                }
+            elif pairs is None:
+                pairs = {
+                    (self.graph.edges[edge_id][1], self.graph.edges[edge_id][0])
+                    for edge_id in self.graph.activity_to_edges.get(label, set())
+                }
+            else:
+                pairs = {
+                    (target_marking, self.graph.edges[edge_id][0])
+                    for target_marking, marking_id in pairs
+                    if marking_id is not None
+                    for edge_id in self.graph.incoming_edges[marking_id]
+                    if self.graph.edge_to_activity[edge_id] == label
+                }
+        return pairs or set()
 
-    def get_marking_state(self, n_gram: List[str]) -> List[Set[str]]:
+    def _get_partial_order_marking_ids(self, n_gram_key: tuple) -> FrozenSet[int]:
+        """
+        Retrieve the marking IDs of an n-gram in an index with partial-order keys: first with its partial-order key,
+        and then, if its interleaving was not collapsed, with the n-gram itself.
+        """
+        partial_order_key = self._get_partial_order_key(n_gram_key)
+        markings = self.markings.get(partial_order_key)
+        if markings is None and partial_order_key != n_gram_key:
+            markings = self.markings.get(n_gram_key)
+        return frozenset() if markings is None else markings
+
+    def _get_partial_order_key(self, n_gram_key: tuple) -> tuple:
+        """
+        Transform the key of an n-gram into its partial-order key: split the n-gram (from the first activity) into
+        maximal runs of pairwise concurrent activities, and replace each run of more than one activity by the sorted
+        tuple of its activities, so all the interleavings of a run get the same key.
+        """
+        runs = []
+        run = []
+        for element in n_gram_key:
+            concurrent_activities = self._concurrent_activities.get(element, ())
+            if all(other in concurrent_activities for other in run):
+                run += [element]
+            else:
+                runs += [run]
+                run = [element]
+        if len(run) > 0:
+            runs += [run]
+        return tuple(run[0] if len(run) == 1 else tuple(sorted(run)) for run in runs)
+
+    def _update_concurrent_activities(self):
+        """
+        Compute the pairs of concurrent activities, i.e., the pairs of different activities A and B that form a diamond
+        in the reachability graph: from a marking, executing A and then B reaches the same marking as B and then A.
+        """
+        self._concurrent_activities = {}
+        for marking_id in self.graph.markings:
+            # Group the targets of the outgoing edges of the marking by activity
+            targets = {}
+            for edge_id in self.graph.outgoing_edges[marking_id]:
+                label = self.graph.edge_to_activity[edge_id]
+                targets.setdefault(label, set()).add(self.graph.edges[edge_id][1])
+            # Search for the diamonds of each pair of activities
+            for label_a, label_b in itertools.combinations(targets, 2):
+                after_a_b = {
+                    self.graph.edges[edge_id][1]
+                    for target in targets[label_a]
+                    for edge_id in self.graph.outgoing_edges[target]
+                    if self.graph.edge_to_activity[edge_id] == label_b
+                }
+                after_b_a = {
+                    self.graph.edges[edge_id][1]
+                    for target in targets[label_b]
+                    for edge_id in self.graph.outgoing_edges[target]
+                    if self.graph.edge_to_activity[edge_id] == label_a
+                }
+                if len(after_a_b & after_b_a) > 0:
+                    (element_a, element_b) = self._get_key([label_a, label_b])
+                    self._concurrent_activities.setdefault(element_a, set()).add(element_b)
+                    self._concurrent_activities.setdefault(element_b, set()).add(element_a)
+
+    def _collapse_interleavings(self):
+        """
+        Replace the n-grams of the index by their partial-order keys (see [_get_partial_order_key]) when it does not
+        change the markings of any n-gram: all the interleavings of the runs with the same partial-order key must be in
+        the index with the same markings. Otherwise, the n-grams are kept with their (sequence) key.
+        """
+        # Group the n-grams by partial-order key
+        groups = {}
+        for n_gram_key in self.markings:
+            groups.setdefault(self._get_partial_order_key(n_gram_key), []).append(n_gram_key)
+        for partial_order_key, n_gram_keys in groups.items():
+            if len(n_gram_keys) > 1 and self._is_collapsible(partial_order_key, set(n_gram_keys)):
+                markings = self.markings[n_gram_keys[0]]
+                for n_gram_key in n_gram_keys:
+                    del self.markings[n_gram_key]
+                self.markings[partial_order_key] = markings
+
+    def _is_collapsible(self, partial_order_key: tuple, n_gram_keys: Set[tuple]) -> bool:
+        """
+        Check that the n-grams in [n_gram_keys] are all the interleavings with partial-order key [partial_order_key],
+        and that all of them have the same markings.
+        """
+        markings = self.markings[next(iter(n_gram_keys))]
+        if any(self.markings[n_gram_key] != markings for n_gram_key in n_gram_keys):
+            return False
+        # Check every interleaving of the runs with the same partial-order key is in the group
+        runs = [itertools.permutations(run) if isinstance(run, tuple) else [(run,)] for run in partial_order_key]
+        for interleaving in itertools.product(*runs):
+            n_gram_key = tuple(itertools.chain.from_iterable(interleaving))
+            if n_gram_key not in n_gram_keys and self._get_partial_order_key(n_gram_key) == partial_order_key:
+                return False
+        return True
+
+    def _get_resolution(self, n_gram_key: tuple) -> Optional[Tuple[int, int]]:
+        """
+        Retrieve the precomputed best marking (and size of the k-gram where the search stops) of an n-gram of the
+        index, from the memory or the disk tier, or None if the n-gram is not in the index.
+        """
+        if self.disk_tier is not None and len(n_gram_key) > self.tier_split:
+            # Deep n-gram, search in the disk tier only if it might be there
+            stored = self.disk_tier.get(self._get_labels(n_gram_key)) if self._may_contain(n_gram_key) else None
+            return None if stored is None else stored[1]
+        return self.resolutions.get(n_gram_key)
+
+    def _get_associations(self) -> Iterable[Tuple[tuple, FrozenSet[int]]]:
+        """
+        Iterate over all the n-grams of the index with their marking IDs, including the ones in the disk tier.
+        """
+        yield from self.markings.items()
+        if self.disk_tier is not None:
+            for n_gram, markings, _ in self.disk_tier.items():
+                yield self._get_key(list(n_gram)), markings
+
+    def _get_bloom_key(self, n_gram_key: tuple) -> int:
+        # Hash of the encoded n-gram, so the filter is valid for both encoded and non-encoded indexes (the built-in hash
+        # of a tuple of ints is cheap, and stable across processes)
+        return hash(self._get_codes(n_gram_key))
+
+    def _may_contain(self, n_gram_key: tuple) -> bool:
+        """
+        Check, with the Bloom filter (if any), if an n-gram might be in the index. Intended to skip the probes of
+        storages where a miss is expensive, as probing the in-memory map costs less than checking the filter.
+        """
+        return self.bloom_filter is None or self._get_bloom_key(n_gram_key) in self.bloom_filter
+
+    def add_associations(self, n_gram: List[str], markings: Set[int]):
+        if self.disk_tier is not None:
+            raise RuntimeError("Error, the associations of a tiered index cannot be modified (build it again instead).")
+        if self.partial_order:
+            raise RuntimeError("Error, the associations of an index with partial-order keys cannot be modified.")
+        if any(label not in self.activity_codes for label in n_gram):
+            # Assign codes to the activities added to the graph since the last update
+            self._update_activity_codes()
+        n_gram_key = self._get_key(n_gram)
+        if n_gram_key is None:
+            raise RuntimeError(f"Error, the n-gram {n_gram} has activities that are not in the reachability graph.")
+        markings = frozenset(markings)
+        previous_markings = self.markings.get(n_gram_key)
+        self.markings[n_gram_key] = markings if previous_markings is None else previous_markings | markings
+        self._reset_lookup_structures()
+
+    def add_association(self, n_gram: List[str], marking: int):
+        self.add_associations(n_gram, {marking})
+
+    def get_marking_ids(self, n_gram: List[str]) -> FrozenSet[int]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the IDs (in the reachability
+        graph) of the markings associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: an immutable set with the ID(s) of the marking(s) corresponding to the state of the process.
+        """
+        return self._get_marking_ids(self._get_key(n_gram))
+
+    def get_marking_state(self, n_gram: List[str]) -> List[FrozenSet[str]]:
         """
         Retrieve, given an n-gram representing the last N activities executed in a trace, the list of markings (set of
         enabled flows) associated to that state.
@@ -37,48 +376,112 @@ class NGramIndex:
         :param n_gram: list of activity labels representing the last N activities recorded in the trace.
         :return: a list with the marking(s) corresponding to the state of the process.
         """
-        n_gram_key = tuple(n_gram)
-        markings = {}
-        # If present, retrieve marking IDs associated to this n-gram
-        if n_gram_key in self.markings:
-            markings = self.markings[n_gram_key]
+        # Retrieve marking IDs associated to this n-gram (if present)
+        markings = self.get_marking_ids(n_gram)
         # Return set of markings
-        return [self.graph.markings[marking] for marking in markings]
+        return [self.graph.frozen_markings[marking] for marking in markings]
 
-    def get_best_marking_state_for(self, n_gram: List[str]) -> Set[str]:
+    def get_best_marking_state_for(self, n_gram: List[str]) -> FrozenSet[str]:
         """
         Retrieve, given an n-gram representing the last N activities executed in a trace, the marking (set of enabled
         flows) that has higher probability to be the one associated to that state. To do this, the function retrieves
         the marking(s) of each k-gram (being k in 1..n) until the associated marking(s) is deterministic (only one
         marking), or k = n (limit reached). If maximum size n-gram is reached and more than one marking are associated
-        to it, return one of them randomly.
+        to it, return the one with the lowest ID (so the result is always the same for the same n-gram).
+
+        This search depends only on the content of the index, so its result is precomputed for each n-gram of the
+        index (see [_build_resolutions]), and the search is reduced to finding the longest suffix of the n-gram
+        present in the index.
 
         If the n-gram contains activities that are not in the reachability graph (or marking n-grams), filter them out.
 
         :param n_gram: list of activity labels representing the last N activities recorded in the trace.
         :return: the marking corresponding to the state of the case given the last N activities.
         """
-        # Filter out nonexistent (in the reachability graph) activities
-        n_gram = [
-            label
-            for label in n_gram
-            if label in self.graph.activity_to_edges or label == NGramIndex.TRACE_START
-        ]
+        return self.graph.frozen_markings[self.get_best_marking_id_for(n_gram)]
+
+    def get_best_marking_id_for(self, n_gram: List[str]) -> int:
+        """
+        Same as [get_best_marking_state_for], but returning the ID of the marking in the reachability graph.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the ID of the marking corresponding to the state of the case given the last N activities.
+        """
+        if self.cache_size <= 0:
+            return self._get_best_marking_id(self._filter_n_gram(n_gram))
+        # Search in the cache before searching in the index
+        cache_key = tuple(n_gram)
+        marking_id = self._cache.get(cache_key)
+        if marking_id is not None:
+            self._cache.move_to_end(cache_key)
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            marking_id = self._get_best_marking_id(self._filter_n_gram(n_gram))
+            self._add_to_cache(cache_key, marking_id)
+        return marking_id
+
+    def warm_up(self, n_grams: Iterable[List[str]]):
+        """
+        Preload the LRU cache with the best marking of the most frequent n-grams in [n_grams] (e.g., the n-grams
+        observed in a historical event log, see [utils.read_n_grams_from_event_log]). The most frequent n-grams are
+        inserted last, so they are the last ones to be evicted.
+
+        :param n_grams: n-grams (lists of activity labels) to count, with the same format as the ones to query.
+        """
+        if self.cache_size > 0:
+            frequencies = Counter(tuple(n_gram) for n_gram in n_grams)
+            for cache_key, _ in reversed(frequencies.most_common(self.cache_size)):
+                self._add_to_cache(cache_key, self._get_best_marking_id(self._filter_n_gram(list(cache_key))))
+
+    def _add_to_cache(self, cache_key: tuple, marking_id: int):
+        self._cache[cache_key] = marking_id
+        self._cache.move_to_end(cache_key)
+        if len(self._cache) > self.cache_size:
+            # Evict least recently used n-gram
+            self._cache.popitem(last=False)
+
+    def _filter_n_gram(self, n_gram: List[str]) -> list:
+        """
+        Filter out the activities of an n-gram that are not in the reachability graph, and encode it if needed.
+        """
+        if self.encode_activities:
+            return [self.activity_codes[label] for label in n_gram if label in self.activity_codes]
+        else:
+            return [
+                label
+                for label in n_gram
+                if label in self.graph.activity_to_edges or label == NGramIndex.TRACE_START
+            ]
+
+    def _get_best_marking_id(self, n_gram: list) -> int:
+        """
+        Search for the best marking of an (already filtered and encoded) n-gram, with the lookup structures available.
+        """
+        if self.layout == NGramIndexLayout.TRIE and self.suffix_trie is not None:
+            return self._get_best_marking_id_in_trie(n_gram)
+        elif self.resolutions is not None:
+            return self._get_best_marking_id_in_resolutions(n_gram)
+        else:
+            return self._get_best_marking_id_iteratively(n_gram)
+
+    def _get_best_marking_id_iteratively(self, n_gram: list) -> int:
+        """
+        Search for the best marking of an (already filtered and encoded) n-gram retrieving the marking(s) of each
+        k-gram (being k in 1..n) until they are deterministic, or the k-gram is not in the index.
+        """
         # Initialize estimated marking to initial marking (if no other marking found, that's default)
-        final_marking = self.get_marking_state([NGramIndex.TRACE_START])[0]
+        final_marking = self.graph.initial_marking_id
         stop_search = False
         k = 1
         # Search iteratively for a deterministic marking
         while not stop_search and k <= len(n_gram):
             # Get marking(s) corresponding last K activities of the n-gram
-            markings = self.get_marking_state(n_gram[-k:])
-            if len(markings) == 1:
-                # Deterministic marking, stop search
-                final_marking = markings[0]
-                stop_search = True
-            elif len(markings) > 1:
-                # More than one marking, keep first and continue expanding n-gram
-                final_marking = random.choice(markings)
+            markings = self._get_marking_ids(tuple(n_gram[-k:]))
+            if len(markings) > 0:
+                # Keep the marking with lowest ID, and stop if deterministic
+                final_marking = min(markings)
+                stop_search = len(markings) == 1
                 k += 1
             else:
                 # No marking(s) found, stop search
@@ -86,85 +489,1526 @@ class NGramIndex:
         # Return found marking
         return final_marking
 
-    def build(self):
+    def _get_best_marking_id_in_resolutions(self, n_gram: list) -> int:
+        """
+        Search for the best marking of an (already filtered and encoded) n-gram as the precomputed resolution of its
+        longest suffix present in the index (see [_search_resolution]). In a tiered index, the search is first done
+        with the n-grams in memory, and it is widened to the disk tier only if the search of the best marking goes
+        beyond them (i.e., the longest suffix in memory is non-deterministic and of the maximum size in memory).
+        """
+        upper = min(len(n_gram), self._max_n_gram_size)
+        if upper == 0:
+            return self.graph.initial_marking_id
+        if self.disk_tier is None or upper <= self.tier_split:
+            return self._search_resolution(n_gram, self.resolutions.get, 0, upper)[0]
+        # Search in the memory tier
+        resolution = self._search_resolution(n_gram, self.resolutions.get, 0, self.tier_split)
+        if resolution[1] < self.tier_split or len(self.markings[tuple(n_gram[-self.tier_split:])]) == 1:
+            return resolution[0]
+        # Widen the search to the disk tier
+        return self._search_resolution(n_gram, self._get_resolution, self.tier_split, upper, resolution)[0]
+
+    def _search_resolution(
+            self,
+            n_gram: list,
+            get_resolution: Callable[[tuple], Optional[Tuple[int, int]]],
+            lower: int,
+            upper: int,
+            lower_resolution: Optional[Tuple[int, int]] = None,
+    ) -> Tuple[int, int]:
+        """
+        Search for the precomputed resolution of the longest suffix of an (already filtered and encoded) n-gram present
+        in the index with a size in (lower, upper], being the suffix of size [lower] present in the index (if > 0).
+        First, the suffix of size [upper] is searched. If not present, the size of the longest suffix in the index is
+        searched with a binary search: the result of the iterative search for an n-gram is the same as for any of its
+        suffixes in the index such that the next (longer) suffix is not in the index.
+
+        :return: the resolution of the longest suffix, or the one of the suffix of size [lower] if none.
+        """
+        if lower_resolution is None:
+            lower_resolution = (self.graph.initial_marking_id, 0)
+        # Search for the longest suffix
+        resolution = get_resolution(tuple(n_gram[-upper:]))
+        if resolution is not None:
+            return resolution
+        # Binary search keeping [lower] as a suffix in the index (or 0) and [upper] as a suffix not in the index
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            resolution = get_resolution(tuple(n_gram[-middle:]))
+            if resolution is None:
+                upper = middle
+            else:
+                lower, lower_resolution = middle, resolution
+        # Return found resolution
+        return lower_resolution
+
+    def _get_best_marking_id_in_trie(self, n_gram: list) -> int:
+        """
+        Equivalent to the iterative search of [get_best_marking_state_for] but walking the suffix trie from the last
+        activity of the (already filtered and encoded) n-gram backwards, so each k-gram is one node hop.
+        """
+        final_marking = self.graph.initial_marking_id
+        node = self.suffix_trie
+        for element in reversed(n_gram):
+            node = node.children.get(element)
+            if node is None or len(node.markings) == 0:
+                # No marking(s) found, stop search
+                break
+            final_marking = node.resolution
+            if len(node.markings) == 1:
+                # Deterministic marking, stop search
+                break
+        # Return found marking
+        return final_marking
+
+    def _build_resolutions(self, n_gram_keys: Optional[Iterable[tuple]] = None):
+        """
+        Precompute, for each n-gram of the index, the result of the iterative search of [get_best_marking_state_for],
+        i.e., the ID of the final marking and the size k of the k-gram where the search stops. The n-grams are processed
+        by increasing size, so the search for an n-gram continues the one of its suffix of size n-1.
+
+        :param n_gram_keys: if given, only recompute the result of these n-grams (and keep the rest).
+        """
+        if self.lazy:
+            raise RuntimeError("Error, this lookup needs the complete index, not available in lazy mode (build it).")
+        if self.partial_order:
+            raise RuntimeError("Error, this lookup is not available in an index with partial-order keys.")
+        if n_gram_keys is None:
+            self.resolutions = {}
+            self._max_n_gram_size = 0 if self.disk_tier is None else self.disk_tier.get_max_size()
+        for n_gram_key in sorted(self.markings if n_gram_keys is None else n_gram_keys, key=len):
+            markings = self.markings[n_gram_key]
+            size = len(n_gram_key)
+            self._max_n_gram_size = max(self._max_n_gram_size, size)
+            if size > 1:
+                previous = self.resolutions.get(n_gram_key[1:])
+                if previous is None:
+                    # The search stops before reaching this n-gram, the result is the one of its longest suffix
+                    self.resolutions[n_gram_key] = self._get_resolution_of_longest_suffix(n_gram_key[1:])
+                    continue
+                elif previous[1] < size - 1 or len(self.markings[n_gram_key[1:]]) == 1:
+                    # The search stops before reaching this n-gram, same result as its suffix
+                    self.resolutions[n_gram_key] = previous
+                    continue
+            # The search reaches this n-gram
+            if len(markings) > 0:
+                self.resolutions[n_gram_key] = (min(markings), size)
+            else:
+                self.resolutions[n_gram_key] = self._get_resolution_of_longest_suffix(n_gram_key[1:])
+
+    def _get_resolution_of_longest_suffix(self, n_gram_key: tuple) -> Tuple[int, int]:
+        for k in range(len(n_gram_key), 0, -1):
+            if n_gram_key[-k:] in self.resolutions:
+                return self.resolutions[n_gram_key[-k:]]
+        return self.graph.initial_marking_id, 0
+
+    def _build_suffix_trie(self):
+        """
+        Build the trie with the n-grams of [self.markings] read backwards. The nodes share the sets of markings with
+        [self.markings], and store the precomputed resolution of their n-gram.
+        """
+        self.suffix_trie = SuffixTrieNode()
+        for n_gram_key, markings in self._get_associations():
+            node = self.suffix_trie
+            for element in reversed(n_gram_key):
+                child = node.children.get(element)
+                if child is None:
+                    child = SuffixTrieNode()
+                    node.children[element] = child
+                node = child
+            node.markings = markings
+            node.resolution = self._get_resolution(n_gram_key)[0]
+
+    def get_approximate_marking_ids(
+            self,
+            n_gram: List[str],
+            max_distance: int = 1,
+    ) -> List[Tuple[Tuple[str, ...], int, FrozenSet[int]]]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace (possibly with spurious or
+        missing events), the n-grams of the index within an edit distance of [max_distance] from a suffix of the
+        n-gram, together with their markings. As the n-grams of the index represent the last activities of a trace,
+        each of them is aligned with the end of the queried n-gram, and the older activities of the query are skipped
+        at no cost.
+
+        The search walks the suffix trie (n-grams read backwards, see [NGramIndexLayout.TRIE]) computing
+        one row of the Levenshtein distance table per node, and discards the sub-tries where all the distances in the
+        row exceed [max_distance], so only a small part of the index is visited.
+
+        If the n-gram contains activities that are not in the reachability graph (or marking n-grams), filter them out.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :param max_distance: maximum edit distance (insertions, deletions, and substitutions of activities).
+        :return: a list of tuples with the n-gram of the index (as activity labels), its edit distance, and the IDs of
+        its markings, ranked by distance and then by size of the n-gram (longest first).
+        """
+        if self.suffix_trie is None:
+            if self.resolutions is None:
+                self._build_resolutions()
+            self._build_suffix_trie()
+        # Read the query backwards, keeping only the activities that can be aligned with an n-gram of the index
+        query = list(reversed(self._filter_n_gram(n_gram)))[:self._max_n_gram_size + max_distance]
+        # Walk the trie with the row of distances between the n-gram of each node and each suffix of the query
+        results = []
+        stack = [(self.suffix_trie, (), list(range(len(query) + 1)))]
+        while len(stack) > 0:
+            (node, reversed_key, row) = stack.pop()
+            for element, child in node.children.items():
+                child_row = [row[0] + 1]
+                for j in range(1, len(query) + 1):
+                    child_row += [min(row[j] + 1, child_row[j - 1] + 1, row[j - 1] + (query[j - 1] != element))]
+                distance = min(child_row)
+                if distance <= max_distance:
+                    child_key = reversed_key + (element,)
+                    if len(child.markings) > 0:
+                        results += [(distance, child_key, child.markings)]
+                    stack += [(child, child_key, child_row)]
+        # Rank by distance, and then by size of the n-gram
+        results.sort(key=lambda result: (result[0], -len(result[1]), str(result[1])))
+        return [
+            (self._get_labels(tuple(reversed(reversed_key))), distance, markings)
+            for distance, reversed_key, markings in results
+        ]
+
+    def encode_n_grams(self, n_grams: List[List[str]], length: Optional[int] = None) -> np.ndarray:
+        """
+        Encode a list of n-grams into the 2-D array of activity codes expected by [get_best_marking_states_for]. As in
+        [get_best_marking_state_for], the activities not present in the reachability graph are filtered out. Each row
+        is left-padded with [NGramIndex.PAD_CODE] to the same length.
+
+        :param n_grams: list of n-grams, each of them a list of activity labels.
+        :param length: number of columns of the array (keeping the last activities of longer n-grams). By default, the
+        length of the longest n-gram.
+        :return: a 2-D array with one encoded n-gram per row.
+        """
+        encoded_n_grams = [
+            [self.activity_codes[label] for label in n_gram if label in self.activity_codes]
+            for n_gram in n_grams
+        ]
+        if length is None:
+            length = max([len(n_gram) for n_gram in encoded_n_grams], default=0)
+        batch = np.full((len(encoded_n_grams), length), NGramIndex.PAD_CODE, dtype=np.int64)
+        for i, n_gram in enumerate(encoded_n_grams):
+            n_gram = n_gram[-length:] if length > 0 else []
+            if len(n_gram) > 0:
+                batch[i, length - len(n_gram):] = n_gram
+        return batch
+
+    def get_best_marking_states_for(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Vectorized version of [get_best_marking_state_for] to compute the state of many ongoing cases in one call.
+        Instead of the markings, this method returns their IDs in the reachability graph.
+
+        All the n-grams of the batch are searched together for each k (being k in 1..n): each k-gram is packed into
+        one integer and searched in a sorted array with the packed k-grams of the index. The search stops for an
+        n-gram when its marking is deterministic, when its k-gram is not in the index, or when reaching its padding.
+        If the index has k-grams too long to be packed in 64 bits (large alphabets or size limits), the n-grams still
+        non-deterministic at the longest packed size continue their search one by one (see [get_best_marking_id_for]).
+
+        :param batch: 2-D array with one n-gram (activity codes, see [encode_n_grams]) per row, left-padded with
+        [NGramIndex.PAD_CODE].
+        :return: an array with the ID of the marking corresponding to the state of each n-gram.
+        """
+        batch = np.asarray(batch, dtype=np.int64)
+        if batch.ndim != 2:
+            raise RuntimeError(f"Error, expected a 2-D array of encoded n-grams, got {batch.ndim} dimension(s).")
+        if self._batch_tables is None:
+            self._build_batch_tables()
+        base, tables = self._batch_tables
+        # Initialize estimated markings to initial marking (if no other marking found, that's default)
+        num_n_grams, width = batch.shape
+        final_markings = np.full(num_n_grams, self.graph.initial_marking_id, dtype=np.int64)
+        active = np.ones(num_n_grams, dtype=bool)
+        packed = np.zeros(num_n_grams, dtype=np.int64)
+        # Search iteratively for a deterministic marking
+        for k in range(1, min(width, len(tables)) + 1):
+            codes = batch[:, width - k]
+            active &= codes != NGramIndex.PAD_CODE
+            (keys, deterministic, resolutions) = tables[k - 1]
+            if not active.any() or len(keys) == 0:
+                active[:] = False
+                break
+            # Pack the k-gram of each n-gram and search for it
+            packed += (codes + 1) * (base ** (k - 1))
+            positions = np.minimum(np.searchsorted(keys, packed), len(keys) - 1)
+            found = active & (keys[positions] == packed)
+            # Retrieve the precomputed best marking of each found k-gram
+            final_markings[found] = resolutions[positions[found]]
+            # Keep searching only for the non-deterministic ones
+            active = found & ~deterministic[positions]
+        if width > len(tables) and self._max_n_gram_size > len(tables):
+            # Continue the search of the non-deterministic ones with the k-grams that cannot be packed
+            for i in np.flatnonzero(active):
+                final_markings[i] = self.get_best_marking_id_for(
+                    [self.activity_labels[code] for code in batch[i] if code != NGramIndex.PAD_CODE]
+                )
+        # Return found markings
+        return final_markings
+
+    def _build_batch_tables(self):
+        """
+        Build, for each size k, the sorted array with the n-grams of size k in the index, each of them packed into one
+        integer (the last activity as least significant digit), together with arrays indicating if each of them is
+        deterministic and its precomputed best marking ID. Only the sizes whose packed k-grams fit in 64 bits get a
+        table.
+        """
+        if self.resolutions is None:
+            self._build_resolutions()
+        base = len(self.activity_codes) + 1  # Digit 0 is reserved for the padding
+        max_size = self._max_n_gram_size
+        while base ** max_size >= 2 ** 63:
+            max_size -= 1
+        packed_markings = [[] for _ in range(max_size)]
+        for n_gram_key, markings in self._get_associations():
+            if len(n_gram_key) > max_size:
+                continue
+            packed = 0
+            for element in n_gram_key:
+                code = element if self.encode_activities else self.activity_codes[element]
+                packed = packed * base + code + 1
+            packed_markings[len(n_gram_key) - 1] += [
+                (packed, len(markings) == 1, self._get_resolution(n_gram_key)[0])
+            ]
+        tables = []
+        for k_grams in packed_markings:
+            k_grams.sort()
+            tables += [(
+                np.array([packed for packed, _, _ in k_grams], dtype=np.int64),
+                np.array([deterministic for _, deterministic, _ in k_grams], dtype=bool),
+                np.array([resolution for _, _, resolution in k_grams], dtype=np.int64),
+            )]
+        self._batch_tables = (base, tables)
+
+    @staticmethod
+    def get_rolling_hash(encoded_n_gram: Iterable[int]) -> int:
+        """
+        Compute the polynomial hash of an encoded n-gram, with the last activity as least significant digit, so the
+        hash of the n-gram extended with a new activity is computed from the hash of the n-gram in O(1) (see
+        [extend_rolling_suffixes]).
+
+        :param encoded_n_gram: n-gram as a sequence of activity codes (see [NGramIndex.activity_codes]).
+        :return: the rolling hash of the n-gram.
+        """
+        rolling_hash = 0
+        for code in encoded_n_gram:
+            rolling_hash = (rolling_hash * NGramIndex.ROLLING_HASH_BASE + code + 1) % NGramIndex.ROLLING_HASH_MODULUS
+        return rolling_hash
+
+    def extend_rolling_suffixes(self, suffixes: List[Tuple[int, int, int]], code: int) -> List[Tuple[int, int, int]]:
+        """
+        Compute the suffixes of a trace after executing a new activity, given the previous ones. Only the suffixes
+        that are the prefix of some n-gram in the index are kept, each of them as a tuple with its size, the ID of its
+        node in the rolling hash table, and its rolling hash (see [get_rolling_hash]). The suffix of size k is the
+        previous suffix of size k-1 extended with the new activity, so each one is computed with O(1) integer
+        operations and searched by its hash, without building its key. The hashes are collision-safe: a node is
+        accepted only if its last activity is the new one, and its prefix is the node of the previous suffix.
+
+        :param suffixes: previous suffixes of the trace (starting with the empty one, see [get_empty_rolling_suffixes]).
+        :param code: activity code of the new activity (see [NGramIndex.activity_codes]).
+        :return: the suffixes of the trace after the new activity.
+        """
+        if self._rolling_hash_table is None:
+            self._build_rolling_hash_table()
+        (table, parents, last_codes, _) = self._rolling_hash_table
+        (base, modulus) = (NGramIndex.ROLLING_HASH_BASE, NGramIndex.ROLLING_HASH_MODULUS)
+        next_suffixes = [(0, 0, 0)]
+        for size, node, rolling_hash in suffixes:
+            rolling_hash = (rolling_hash * base + code + 1) % modulus
+            for candidate in table.get(rolling_hash, ()):
+                if parents[candidate] == node and last_codes[candidate] == code:
+                    next_suffixes += [(size + 1, candidate, rolling_hash)]
+                    break
+        return next_suffixes
+
+    @staticmethod
+    def get_empty_rolling_suffixes() -> List[Tuple[int, int, int]]:
+        """
+        Retrieve the suffixes (see [extend_rolling_suffixes]) of an empty trace, i.e., only the empty suffix.
+        """
+        return [(0, 0, 0)]
+
+    def get_best_marking_id_for_rolling_suffixes(self, suffixes: List[Tuple[int, int, int]]) -> int:
+        """
+        Same as [get_best_marking_id_for] but for a trace given by its suffixes (see [extend_rolling_suffixes]): the
+        best marking is the precomputed resolution of the longest suffix such that all its suffixes are in the index.
+
+        :param suffixes: suffixes of the trace.
+        :return: the ID of the marking corresponding to the state of the case given its last activities.
+        """
+        if self._rolling_hash_table is None:
+            self._build_rolling_hash_table()
+        resolutions = self._rolling_hash_table[3]
+        final_marking = self.graph.initial_marking_id
+        for k in range(1, len(suffixes)):
+            (size, node, _) = suffixes[k]
+            if size != k or resolutions[node] is None:
+                # Suffix of size k not in the index, stop search
+                break
+            final_marking = resolutions[node]
+        # Return found marking
+        return final_marking
+
+    def _build_rolling_hash_table(self):
+        """
+        Build the table with the prefixes of the n-grams of the index by rolling hash. Each prefix is a node storing
+        the ID of the node of its prefix of size n-1 (0 being the empty prefix), its last activity code, and its
+        precomputed best marking (None if the prefix is not an n-gram of the index).
+        """
+        if self.resolutions is None:
+            self._build_resolutions()
+        (table, parents, last_codes, resolutions) = ({}, [None], [None], [None])
+        node_ids = {(): 0}
+        for n_gram_key, _ in self._get_associations():
+            encoded_key = self._get_codes(n_gram_key)
+            for size in range(1, len(encoded_key) + 1):
+                prefix = encoded_key[:size]
+                if prefix not in node_ids:
+                    node_ids[prefix] = len(parents)
+                    table.setdefault(NGramIndex.get_rolling_hash(prefix), []).append(len(parents))
+                    parents += [node_ids[prefix[:-1]]]
+                    last_codes += [prefix[-1]]
+                    resolutions += [None]
+            resolutions[node_ids[encoded_key]] = self._get_resolution(n_gram_key)[0]
+        self._rolling_hash_table = (table, parents, last_codes, resolutions)
+
+    def _get_codes(self, n_gram_key: tuple) -> Tuple[int, ...]:
+        """
+        Transform a key of the index into its tuple of activity codes.
+        """
+        if self.encode_activities:
+            return n_gram_key
+        return tuple(self.activity_codes.get(label, NGramIndex.PAD_CODE) for label in n_gram_key)
+
+    def _build_lookup_structures(self):
+        """
+        Build the structures used to speed up the lookups (depending on the configuration of the index) once the
+        associations in [self.markings] are complete.
+        """
+        self._reset_lookup_structures()
+        self._intern_markings()
+        self._build_resolutions()
+        if self.layout == NGramIndexLayout.TRIE:
+            self._build_suffix_trie()
+        if self.bloom_false_positive_rate is not None:
+            self._build_bloom_filter()
+
+    def _build_bloom_filter(self):
+        num_n_grams = len(self.markings) + (0 if self.disk_tier is None else len(self.disk_tier))
+        self.bloom_filter = BloomFilter(num_n_grams, self.bloom_false_positive_rate)
+        for n_gram_key, _ in self._get_associations():
+            self.bloom_filter.add(self._get_bloom_key(n_gram_key))
+
+    def _intern_markings(self, n_gram_keys: Optional[Iterable[tuple]] = None):
+        """
+        Replace the sets of marking IDs of [self.markings] by immutable ones, sharing the same instance among all the
+        n-grams associated to the same markings.
+
+        :param n_gram_keys: if given, only replace the sets of these n-grams (sharing the immutable sets of the rest).
+        """
+        interned = {} if n_gram_keys is None else {
+            markings: markings for markings in self.markings.values() if type(markings) is frozenset
+        }
+        for n_gram_key in self.markings if n_gram_keys is None else n_gram_keys:
+            markings = frozenset(self.markings[n_gram_key])
+            self.markings[n_gram_key] = interned.setdefault(markings, markings)
+
+    def _reset_lookup_structures(self):
+        """
+        Discard the lookup structures, as they are outdated after modifying the associations in [self.markings]. The
+        lookups fall back to the iterative search until they are built again.
+        """
+        self.resolutions = None
+        self.suffix_trie = None
+        self._batch_tables = None
+        self._rolling_hash_table = None
+        self.bloom_filter = None
+        self._cache.clear()
+
+    @staticmethod
+    def select_n_gram_size_limit(identification_depths: Dict[int, Optional[int]], coverage: float = 1.0) -> int:
+        """
+        Select the smallest size limit of an n-gram index that identifies (as well as any larger limit) at least a
+        fraction [coverage] of the markings of a reachability graph.
+
+        :param identification_depths: dict with the ID of each marking as key, and its identification depth (None if
+        unbounded) as value (see [ReverseSuffixAutomaton.get_identification_depths]).
+        :param coverage: minimum fraction of markings identified with the selected limit.
+        :return: the smallest size limit (at least 1) identifying the given fraction of markings.
+        """
+        depths = sorted(depth for depth in identification_depths.values() if depth is not None)
+        num_markings = math.ceil(coverage * len(identification_depths) - 1e-9)  # Tolerance to rounding errors
+        if num_markings > len(depths):
+            raise RuntimeError(f"Error, a coverage of {coverage} needs markings with unbounded identification depth.")
+        return max([1] + depths[:num_markings])
+
+    def build(
+            self,
+            tier_split: Optional[int] = None,
+            tier_path: Optional[Path] = None,
+            observed_n_grams: Optional[Iterable[List[str]]] = None,
+            workers: int = 1,
+            vectorized: bool = False,
+            marking_limits: Optional[Dict[int, int]] = None,
+            max_entries: Optional[int] = None,
+            max_seconds: Optional[float] = None,
+            progress: Optional[Callable[[int, int, int], None]] = None,
+            cancel: Optional[threading.Event] = None,
+            checkpoint_path: Optional[Path] = None,
+            checkpoint_seconds: float = 600.0,
+    ):
         """
         Build the n-gram index mapping for the reachability graph in [self.graph] and with the n-limit stored in
         [self.n_gram_size_limit].
+
+        If [tier_split] is given, the index is tiered: the n-grams with up to [tier_split] activities are kept in
+        memory, and the longer ones (together with their precomputed best marking) are moved to a disk-backed store
+        in [tier_path], which is only consulted when the search of the best marking goes beyond the n-grams in memory.
+        In sequential complete builds without checkpoints, each level of the expansion beyond [tier_split] is written to
+        the disk tier once the next one is expanded, so the memory is bounded by the n-grams kept in memory, the last
+        two levels, and the frontier of paths instead of by the size of the index (this only pays off when the last two
+        levels are a small part of the index).
+
+        If [observed_n_grams] is given (e.g., the n-grams of a historical event log, see
+        [utils.read_n_grams_from_event_log]), the index is pruned: it only keeps the n-grams needed to search the state
+        of the observed ones, which get the same state as with a complete index. If the index is lazy, the n-grams
+        needed by other (not observed) n-grams are computed on demand; otherwise, their state is searched only with the
+        kept n-grams.
+
+        If [marking_limits] is given, each non-deterministic n-gram is only expanded if one of its markings has a
+        limit greater than its size (markings without a limit take [self.n_gram_size_limit]). All the paths of an
+        expanded n-gram are expanded, so the markings of each n-gram are the same as with a complete build, but the
+        n-grams only leading to markings with a low limit (e.g., the ones inside loops, whose identification depth is
+        unbounded, see [ReverseSuffixAutomaton.get_identification_depths]) are not expanded to the size limit.
+
+        The expansion (by increasing size of the n-grams) can be bounded with [max_entries], [max_seconds], and
+        [cancel], checked every [BUILD_CHECKPOINT_INTERVAL] expanded paths (together with the call to [progress]). When
+        one of them is exceeded, the n-grams of the size being expanded are discarded, and the index is built with the
+        ones completely expanded: it is the same as an index with that size limit (stored in [self.n_gram_size_limit],
+        so it can be increased later with [deepen]), and it is flagged as [self.truncated].
+
+        If [checkpoint_path] is given, the state of the expansion (the n-grams added to the index and the frontier of
+        paths) is saved in that file every [checkpoint_seconds] (and when stopping at a budget), so the build can be
+        continued with [resume_build] if it is interrupted, with the same result. The file is removed once the
+        expansion is complete.
+
+        :param tier_split: maximum size of the n-grams kept in memory (None to keep all of them in memory).
+        :param tier_path: path to the (SQLite) file storing the n-grams longer than [tier_split].
+        :param observed_n_grams: n-grams (lists of activity labels) to keep in the index (None to keep all of them).
+        :param workers: number of processes expanding the reachability graph in parallel (only for complete builds).
+        :param vectorized: expand the reachability graph with NumPy array operations (only for complete builds).
+        :param marking_limits: dict with marking ID as key, and the maximum size of the n-grams expanded to reach it
+        as value (None to expand all the n-grams to the size limit).
+        :param max_entries: maximum number of n-grams in the index (None for no limit).
+        :param max_seconds: maximum duration of the expansion, in seconds (None for no limit).
+        :param progress: function called during the expansion with the size of the n-grams being expanded, the number
+        of paths in the frontier, and the number of n-grams in the index.
+        :param cancel: event to stop the expansion from another thread.
+        :param checkpoint_path: path to the file where the state of the expansion is saved (None to not save it).
+        :param checkpoint_seconds: time between the saves of the state of the expansion, in seconds.
         """
-        # Initialize stacks
-        marking_stack = list(self.graph.markings)  # Stack of markings to explore (incoming edges)
-        n_gram_stack = [[] for _ in marking_stack]  # n-gram (list of str) explored to reach each marking in the stack
-        target_marking_stack = marking_stack.copy()  # List of marking that each n-gram points to
-        # Continue with expansion while there are markings in the stack
+        self._build(
+            tier_split, tier_path, observed_n_grams, workers, vectorized, marking_limits,
+            max_entries, max_seconds, progress, cancel, checkpoint_path, checkpoint_seconds,
+        )
+
+    def resume_build(
+            self,
+            checkpoint_path: Path,
+            tier_split: Optional[int] = None,
+            tier_path: Optional[Path] = None,
+            max_entries: Optional[int] = None,
+            max_seconds: Optional[float] = None,
+            progress: Optional[Callable[[int, int, int], None]] = None,
+            cancel: Optional[threading.Event] = None,
+            checkpoint_seconds: float = 600.0,
+    ):
+        """
+        Continue a build interrupted (or stopped at a budget) from the state saved in [checkpoint_path] (see
+        [build]), with the same result as the uninterrupted build. The index must be created with the same
+        reachability graph and configuration, and the size limit and limits per marking of the interrupted build are
+        restored from the file. The state keeps being saved in the same file until the expansion is complete.
+
+        :param checkpoint_path: path to the file with the state of the interrupted expansion.
+        :param tier_split: maximum size of the n-grams kept in memory (None to keep all of them in memory).
+        :param tier_path: path to the (SQLite) file storing the n-grams longer than [tier_split].
+        :param max_entries: maximum number of n-grams in the index (None for no limit).
+        :param max_seconds: maximum duration of the expansion, in seconds (None for no limit).
+        :param progress: function called during the expansion with the size of the n-grams being expanded, the number
+        of paths in the frontier, and the number of n-grams in the index.
+        :param cancel: event to stop the expansion from another thread.
+        :param checkpoint_seconds: time between the saves of the state of the expansion, in seconds.
+        """
+        self._build(
+            tier_split, tier_path, None, 1, False, None,
+            max_entries, max_seconds, progress, cancel, checkpoint_path, checkpoint_seconds, resume=True,
+        )
+
+    def _build(
+            self,
+            tier_split: Optional[int],
+            tier_path: Optional[Path],
+            observed_n_grams: Optional[Iterable[List[str]]],
+            workers: int,
+            vectorized: bool,
+            marking_limits: Optional[Dict[int, int]],
+            max_entries: Optional[int],
+            max_seconds: Optional[float],
+            progress: Optional[Callable[[int, int, int], None]],
+            cancel: Optional[threading.Event],
+            checkpoint_path: Optional[Path],
+            checkpoint_seconds: float,
+            resume: bool = False,
+    ):
+        """
+        Build the index (see [build]), or continue an interrupted build from its checkpoint if [resume] is True (see
+        [resume_build]).
+        """
+        if (marking_limits is not None or checkpoint_path is not None or max_entries is not None or
+            max_seconds is not None or progress is not None or cancel is not None) and (
+                observed_n_grams is not None or workers > 1 or vectorized
+        ):
+            raise RuntimeError(
+                "Error, the limits per marking, budgets, and checkpoints are only available for sequential complete "
+                "builds."
+            )
+        if tier_split is not None and tier_path is None:
+            raise RuntimeError("Error, a tiered index needs a path to store the n-grams of its disk tier.")
+        fallback = self.lazy and observed_n_grams is not None  # Compute on demand the n-grams not observed
+        if fallback and tier_split is not None:
+            raise RuntimeError("Error, a lazy index cannot be tiered.")
+        if self.partial_order and tier_split is not None:
+            raise RuntimeError("Error, an index with partial-order keys cannot be tiered.")
+        # The index is complete after the build, no need to compute n-grams on demand
+        (self.lazy, self._missing_n_grams, self.truncated) = (False, set(), False)
+        # Bring back the associations of the disk tier (if any) of previous builds
+        if self.disk_tier is not None:
+            for n_gram, markings, _ in self.disk_tier.items():
+                self._add_association(self._get_key(list(n_gram)), markings)
+            self.disk_tier.close()
+            (self.disk_tier, self.tier_split) = (None, None)
+        # Discard the lookup structures of previous builds, and assign codes to the activities of the graph
+        self._reset_lookup_structures()
+        self._update_activity_codes()
+        if self.partial_order:
+            # Discard the partial-order keys of previous builds (the associations cannot be modified by hand)
+            self.markings = {}
+            self._update_concurrent_activities()
+        if tier_split is not None:
+            self._create_disk_tier(tier_split, tier_path)
+        # Write each level to the disk tier once expanded (only in sequential complete builds without checkpoints)
+        spill = tier_split is not None and checkpoint_path is None and observed_n_grams is None and workers == 1 and \
+            not vectorized
+        if observed_n_grams is None and vectorized:
+            self._add_all_n_grams_vectorized()
+        elif observed_n_grams is None and workers > 1:
+            self._add_all_n_grams_in_parallel(workers)
+        elif observed_n_grams is None:
+            (initial_paths, queued_paths) = (None, None)
+            if resume:
+                # Restore the state of the interrupted expansion
+                (marking_limits, initial_paths, queued_paths) = self._load_build_checkpoint(checkpoint_path)
+            checkpoint = self._get_build_checkpoint(
+                max_entries, max_seconds, progress, cancel, marking_limits, checkpoint_path, checkpoint_seconds
+            )
+            completed_size = self._add_all_n_grams(
+                initial_paths=initial_paths,
+                marking_limits=marking_limits,
+                checkpoint=checkpoint,
+                queued_paths=queued_paths,
+                level_callback=self._spill_n_grams if spill else None,
+            )
+            if completed_size is not None:
+                # Stopped at a budget, keep the n-grams completely expanded
+                (self.n_gram_size_limit, self.truncated) = (completed_size, True)
+            elif checkpoint_path is not None:
+                # Expansion complete, its state is not needed anymore
+                Path(checkpoint_path).unlink(missing_ok=True)
+        else:
+            self._add_observed_n_grams(observed_n_grams)
+        if fallback:
+            # Keep computing the not observed n-grams on demand (no lookup structures over an incomplete index)
+            self.lazy = True
+            return
+        if self.partial_order:
+            # Collapse the interleavings of concurrent activities (no lookup structures over partial-order keys)
+            self._collapse_interleavings()
+            return
+        # Move the longest n-grams still in memory to the disk tier (with their precomputed best marking)
+        if tier_split is not None:
+            if not spill:
+                self._build_resolutions()
+            self._move_to_disk_tier([n_gram_key for n_gram_key in self.markings if len(n_gram_key) > tier_split])
+        # Build lookup structures over the final associations
+        self._build_lookup_structures()
+
+    def _add_observed_n_grams(self, observed_n_grams: Iterable[List[str]]):
+        """
+        Add to the index the n-grams needed to search the state of the observed n-grams, i.e., the suffixes of each
+        observed n-gram that would be in the complete index, computing them on demand (see [_compute_marking_ids]).
+        """
+        self.lazy = True
+        for n_gram_key in {tuple(self._filter_n_gram(n_gram)) for n_gram in observed_n_grams}:
+            # The longest suffix in the index is computed with all its suffixes
+            self._get_marking_ids(n_gram_key[-self.n_gram_size_limit:])
+        (self.lazy, self._missing_n_grams) = (False, set())
+
+    def _get_build_checkpoint(
+            self,
+            max_entries: Optional[int],
+            max_seconds: Optional[float],
+            progress: Optional[Callable[[int, int, int], None]],
+            cancel: Optional[threading.Event],
+            marking_limits: Optional[Dict[int, int]],
+            checkpoint_path: Optional[Path],
+            checkpoint_seconds: float,
+    ) -> Optional[Callable[[int, tuple, tuple], bool]]:
+        """
+        Create the function called between the chunks of the expansion of a build (see [_add_all_n_grams]) to report
+        its progress, save its state, and check its budgets, or None if there is nothing to report, save, or check.
+        """
+        if max_entries is None and max_seconds is None and progress is None and cancel is None and \
+                checkpoint_path is None:
+            return None
+        deadline = None if max_seconds is None else time.monotonic() + max_seconds
+        next_save = time.monotonic() + checkpoint_seconds
+
+        def checkpoint(level: int, frontier: tuple, next_frontier: tuple) -> bool:
+            nonlocal next_save
+            num_entries = len(self.markings) + (0 if self.disk_tier is None else len(self.disk_tier))
+            if progress is not None:
+                progress(level, len(frontier[0]) + len(next_frontier[0]), num_entries)
+            stop = (max_entries is not None and num_entries > max_entries) or \
+                (deadline is not None and time.monotonic() > deadline) or \
+                (cancel is not None and cancel.is_set())
+            if checkpoint_path is not None and (stop or time.monotonic() >= next_save):
+                self._save_build_checkpoint(checkpoint_path, frontier, next_frontier, marking_limits)
+                next_save = time.monotonic() + checkpoint_seconds
+            return stop
+
+        return checkpoint
+
+    def _save_build_checkpoint(
+            self,
+            file_path: Path,
+            frontier: tuple,
+            next_frontier: tuple,
+            marking_limits: Optional[Dict[int, int]],
+    ):
+        """
+        Store the state of an expansion (see [_add_all_n_grams]) in a (NumPy .npz) binary file: the n-grams added to
+        the index (in order), the paths of the current level still to expand, and the paths of the next level. The
+        n-grams are stored as activity codes, and the markings with their places, as their IDs may change when
+        computing the reachability graph again. The file is written to a temporary file first, so an interruption
+        while saving keeps the previous checkpoint.
+        """
+        marking_ids = sorted(self.graph.markings)
+        places = [sorted(self.graph.markings[marking_id]) for marking_id in marking_ids]
+        # Position of each n-gram in the index, to store the paths of the frontier (empty n-gram as -1)
+        positions = {n_gram_key: position for position, n_gram_key in enumerate(self.markings)}
+        positions[()] = -1
+        (key_lengths, markings_lengths) = (
+            np.fromiter((len(n_gram_key) for n_gram_key in self.markings), dtype=np.int64, count=len(self.markings)),
+            np.fromiter((len(markings) for markings in self.markings.values()), dtype=np.int64,
+                        count=len(self.markings)),
+        )
+        frontiers = {}
+        for name, (marking_stack, n_gram_stack, target_marking_stack) in [("", frontier), ("next_", next_frontier)]:
+            frontiers[f"{name}frontier_markings"] = np.array(marking_stack, dtype=np.int64)
+            frontiers[f"{name}frontier_keys"] = np.array(
+                [positions[n_gram_key] for n_gram_key in n_gram_stack], dtype=np.int64
+            )
+            frontiers[f"{name}frontier_targets"] = np.array(target_marking_stack, dtype=np.int64)
+        limits = {} if marking_limits is None else marking_limits
+        temporary_path = Path(f"{file_path}.tmp")
+        with open(temporary_path, "wb") as output_file:
+            np.savez(
+                output_file,
+                header=np.array([self.n_gram_size_limit, int(marking_limits is not None)], dtype=np.int64),
+                activity_labels=np.array(self.activity_labels, dtype=str),
+                marking_ids=np.array(marking_ids, dtype=np.int64),
+                place_offsets=np.concatenate(([0], np.cumsum([len(marking) for marking in places]))).astype(np.int64),
+                places=np.array([place for marking in places for place in marking], dtype=str),
+                key_offsets=np.concatenate(([0], np.cumsum(key_lengths))).astype(np.int64),
+                key_codes=np.fromiter(
+                    (code for n_gram_key in self.markings for code in self._get_codes(n_gram_key)),
+                    dtype=np.int64,
+                    count=int(key_lengths.sum()),
+                ),
+                marking_offsets=np.concatenate(([0], np.cumsum(markings_lengths))).astype(np.int64),
+                n_gram_markings=np.fromiter(
+                    (marking for markings in self.markings.values() for marking in markings),
+                    dtype=np.int64,
+                    count=int(markings_lengths.sum()),
+                ),
+                limit_markings=np.array(list(limits), dtype=np.int64),
+                limits=np.array(list(limits.values()), dtype=np.int64),
+                **frontiers,
+            )
+        os.replace(temporary_path, file_path)
+
+    def _load_build_checkpoint(self, file_path: Path) -> Tuple[
+        Optional[Dict[int, int]], List[Tuple[int, tuple, int]], List[Tuple[int, tuple, int]]
+    ]:
+        """
+        Restore the n-grams (and size limit) of an expansion stored with [_save_build_checkpoint], mapping its markings
+        to the ones of [self.graph] with the same places.
+
+        :return: the limits per marking of the expansion (None if not limited), the paths to continue the expansion
+        from, and the paths already added to the next level.
+        """
+        with open(file_path, "rb") as input_file:
+            data = np.load(input_file)
+            (n_gram_size_limit, has_limits) = [int(value) for value in data["header"]]
+            # Map the stored markings and activities to the ones of this graph and index
+            (place_offsets, places) = (data["place_offsets"], data["places"].tolist())
+            marking_ids = {}
+            for position, marking_id in enumerate(data["marking_ids"].tolist()):
+                marking_key = tuple(places[place_offsets[position]:place_offsets[position + 1]])
+                if marking_key not in self.graph.marking_to_key:
+                    raise RuntimeError(f"Error, the checkpoint {file_path} is not from this reachability graph.")
+                marking_ids[marking_id] = self.graph.marking_to_key[marking_key]
+            elements = self._get_key([str(label) for label in data["activity_labels"]])
+            if elements is None:
+                raise RuntimeError(f"Error, the checkpoint {file_path} is not from this reachability graph.")
+            # Restore the n-grams of the index (in the order they were added)
+            (key_offsets, key_codes) = (data["key_offsets"].tolist(), data["key_codes"].tolist())
+            (marking_offsets, n_gram_markings) = (data["marking_offsets"].tolist(), data["n_gram_markings"].tolist())
+            n_gram_keys = [
+                tuple(elements[code] for code in key_codes[key_offsets[position]:key_offsets[position + 1]])
+                for position in range(len(key_offsets) - 1)
+            ]
+            self.markings = {
+                n_gram_key: {
+                    marking_ids[marking]
+                    for marking in n_gram_markings[marking_offsets[position]:marking_offsets[position + 1]]
+                }
+                for position, n_gram_key in enumerate(n_gram_keys)
+            }
+            self.n_gram_size_limit = n_gram_size_limit
+            n_gram_keys += [()]  # Empty n-gram of the first level (stored as -1)
+            # Restore the paths of the frontier
+            (paths, queued_paths) = [
+                [
+                    (marking_ids[marking], n_gram_keys[position], marking_ids[target_marking])
+                    for marking, position, target_marking in zip(
+                        data[f"{name}frontier_markings"].tolist(),
+                        data[f"{name}frontier_keys"].tolist(),
+                        data[f"{name}frontier_targets"].tolist(),
+                    )
+                ]
+                for name in ["", "next_"]
+            ]
+            marking_limits = {
+                marking_ids[marking]: limit
+                for marking, limit in zip(data["limit_markings"].tolist(), data["limits"].tolist())
+            } if has_limits else None
+        if len(paths) == 0:
+            # Stopped at the end of a level, continue with the next one
+            (paths, queued_paths) = (queued_paths, [])
+        return marking_limits, paths, queued_paths
+
+    def _add_all_n_grams(
+            self,
+            last_activities: Optional[Set[str]] = None,
+            target_markings: Optional[Iterable[int]] = None,
+            initial_paths: Optional[Iterable[Tuple[int, tuple, int]]] = None,
+            marking_limits: Optional[Dict[int, int]] = None,
+            checkpoint: Optional[Callable[[int, tuple, tuple], bool]] = None,
+            queued_paths: Optional[Iterable[Tuple[int, tuple, int]]] = None,
+            level_callback: Optional[Callable[[int], None]] = None,
+    ) -> Optional[int]:
+        """
+        Add to the index all the n-grams of the reachability graph, expanding backwards (by increasing size) the
+        non-deterministic ones until reaching the size limit.
+
+        The expansion is level-synchronous over a frontier of paths (current marking, n-gram key, target marking), kept
+        in three parallel lists. The key of each path is built once as a tuple, shared by the index and the frontier,
+        and the incoming edges of each marking are resolved once to their (key element, source marking), so each step
+        only builds its key and adds its target marking to the set of the key. The non-determinism of each key is the
+        size of its set, checked when expanding the next level (once all the paths of the current one are added).
+
+        :param last_activities: if given, only add the n-grams ending with one of these activities.
+        :param target_markings: if given, only add the paths to these markings (the rest of the associations in the
+        index are still taken into account for non-determinism).
+        :param initial_paths: if given, continue the expansion from these paths (current marking, n-gram key, target
+        marking) instead of starting with the empty n-gram.
+        :param marking_limits: if given, only expand the n-grams with a marking whose limit is greater than their size
+        (see [build]).
+        :param checkpoint: if given, the frontier of each level is expanded in chunks of [BUILD_CHECKPOINT_INTERVAL]
+        paths, calling this function after each of them with the size of the n-grams of the level, the paths of the
+        level still to expand, and the paths of the next level, each of them as three lists (current markings, n-gram
+        keys, and target markings). If it returns True, the expansion stops and the n-grams of the level are discarded.
+        :param queued_paths: if given, paths already added to the next level of the [initial_paths] (when resuming an
+        expansion stopped in the middle of a level).
+        :param level_callback: if given, function called with the size of the n-grams of each level once it is
+        completely expanded (the n-grams of the previous levels are not read anymore by the expansion).
+        :return: the size of the longest n-grams completely expanded if the expansion was stopped, None otherwise.
+        """
+        start_element = self._get_key([NGramIndex.TRACE_START])[0]
+        initial_marking_id = self.graph.initial_marking_id
+        n_gram_size_limit = self.n_gram_size_limit
+        markings = self.markings
+        # Incoming edges of each marking as pairs (element of the activity in the key, source marking)
+        incoming = {
+            marking_id: [
+                (self._get_key([self.graph.edge_to_activity[edge_id]])[0], self.graph.edges[edge_id][0])
+                for edge_id in edge_ids
+            ]
+            for marking_id, edge_ids in self.graph.incoming_edges.items()
+        }
+        # Elements not selected as last activity of the n-grams (if any)
+        skipped_elements = set() if last_activities is None else {
+            self._get_key([label])[0]
+            for label in list(self.graph.activity_to_edges) + [NGramIndex.TRACE_START]
+            if label not in last_activities
+        }
+        # Initialize frontier with the empty n-gram, pointing to each marking from itself
+        marking_stack = list(self.graph.markings if target_markings is None else target_markings)
+        n_gram_stack = [()] * len(marking_stack)  # n-gram (key) explored to reach each marking in the frontier
+        target_marking_stack = marking_stack.copy()  # Marking that each n-gram points to
+        if initial_paths is not None:
+            # Continue from the given paths instead
+            (marking_stack, n_gram_stack, target_marking_stack) = ([], [], [])
+            for marking_id, n_gram_key, target_marking in initial_paths:
+                marking_stack.append(marking_id)
+                n_gram_stack.append(n_gram_key)
+                target_marking_stack.append(target_marking)
+        queued = ([], [], [])  # Paths of the next level already added to the index
+        for marking_id, n_gram_key, target_marking in [] if queued_paths is None else queued_paths:
+            queued[0].append(marking_id)
+            queued[1].append(n_gram_key)
+            queued[2].append(target_marking)
+        level = len(n_gram_stack[0]) if len(n_gram_stack) > 0 else 0  # Size of the n-grams in the frontier
+        # Continue with expansion while there are n-grams in the frontier
         while len(marking_stack) > 0:
-            # Initialize lists for next iteration
-            next_marking_stack = []
-            next_n_gram_stack = []
-            next_target_marking_stack = []
-            # Expand each of the markings in the stack backwards
+            ((next_marking_stack, next_n_gram_stack, next_target_marking_stack), queued) = (queued, ([], [], []))
+            level += 1
+            expandable = {}  # Dict with the n-gram (key) as key, and whether its markings allow expanding it as value
             while len(marking_stack) > 0:
-                # Retrieve marking to explore, n-gram that led (backwards) to it, and marking at the end of the n-gram
-                marking_id = marking_stack.pop()
-                previous_n_gram = n_gram_stack.pop()
-                target_marking = target_marking_stack.pop()
-                # If this marking is the initial marking, save corresponding association
+                # Expand the frontier in chunks (only one if there is no need to check for stopping between them)
+                chunk_end = 0 if checkpoint is None else max(
+                    0, len(marking_stack) - NGramIndex.BUILD_CHECKPOINT_INTERVAL
+                )
+                while len(marking_stack) > chunk_end:
+                    # Retrieve marking to explore, n-gram that led (backwards) to it, and marking at the end of the
+                    # n-gram (popping them to release the paths of the level while the next one grows)
+                    (marking_id, previous_n_gram, target_marking) = (
+                        marking_stack.pop(), n_gram_stack.pop(), target_marking_stack.pop()
+                    )
+                    # If the n-gram is deterministic, there is no need to search further
+                    if len(previous_n_gram) > 0 and len(markings[previous_n_gram]) < 2:
+                        continue
+                    # If no marking of the n-gram allows expanding it, stop too
+                    if marking_limits is not None and len(previous_n_gram) > 0:
+                        if previous_n_gram not in expandable:
+                            expandable[previous_n_gram] = any(
+                                marking_limits.get(marking, n_gram_size_limit) > len(previous_n_gram)
+                                for marking in markings[previous_n_gram]
+                            )
+                        if not expandable[previous_n_gram]:
+                            continue
+                    # If this marking is the initial marking, save corresponding association
+                    if marking_id == initial_marking_id and (
+                            len(previous_n_gram) > 0 or start_element not in skipped_elements
+                    ):
+                        current_n_gram = (start_element,) + previous_n_gram
+                        n_gram_markings = markings.get(current_n_gram)
+                        if n_gram_markings is None:
+                            markings[current_n_gram] = {target_marking}
+                        elif type(n_gram_markings) is set:
+                            n_gram_markings |= {target_marking}
+                        else:
+                            markings[current_n_gram] = set(n_gram_markings) | {target_marking}
+                    # Grow n-gram with each incoming edge
+                    for element, source_marking_id in incoming[marking_id]:
+                        if len(skipped_elements) > 0 and len(previous_n_gram) == 0 and \
+                                element in skipped_elements:
+                            continue
+                        # Add association
+                        current_n_gram = (element,) + previous_n_gram
+                        n_gram_markings = markings.get(current_n_gram)
+                        if n_gram_markings is None:
+                            markings[current_n_gram] = {target_marking}
+                        elif type(n_gram_markings) is set:
+                            # Merged in place (merging grows the set tables less than adding)
+                            n_gram_markings |= {target_marking}
+                        else:
+                            # Associations already in the index (immutable after a build) are copied when first
+                            # updated
+                            markings[current_n_gram] = set(n_gram_markings) | {target_marking}
+                        # Save source marking for exploration if necessary
+                        if len(current_n_gram) < n_gram_size_limit:
+                            next_marking_stack.append(source_marking_id)
+                            next_n_gram_stack.append(current_n_gram)
+                            next_target_marking_stack.append(target_marking)
+                if checkpoint is not None and checkpoint(
+                        level,
+                        (marking_stack, n_gram_stack, target_marking_stack),
+                        (next_marking_stack, next_n_gram_stack, next_target_marking_stack),
+                ):
+                    # Stop, discarding the n-grams of this level (incomplete)
+                    for n_gram_key in [n_gram_key for n_gram_key in markings if len(n_gram_key) >= level]:
+                        del markings[n_gram_key]
+                    return level - 1
+            if level_callback is not None:
+                level_callback(level)
+            (marking_stack, n_gram_stack, target_marking_stack) = (
+                next_marking_stack, next_n_gram_stack, next_target_marking_stack
+            )
+        return None
+
+    def _add_all_n_grams_vectorized(self):
+        """
+        Add to the index all the n-grams of the reachability graph (same as [_add_all_n_grams]) with NumPy array
+        operations. The incoming edges of the graph are exported to CSR arrays (see
+        [ReachabilityGraph.get_incoming_csr]), and the frontier of each level is held as parallel arrays with the
+        current marking, the n-gram packed into one integer (the last activity as least significant digit, as in
+        [_build_batch_tables]), and the target marking of each path. Each level is expanded over all the incoming
+        edges of the frontier at once, and deduplicated with [np.unique]. If the n-grams up to the size limit cannot be
+        packed in 64 bits (large alphabets or size limits), the index is built with [_add_all_n_grams] instead.
+        """
+        base = len(self.activity_codes) + 1  # Digit 0 is reserved for the empty n-gram
+        if base ** self.n_gram_size_limit >= 2 ** 63:
+            # The packed n-grams would overflow, expand without array operations
+            self._add_all_n_grams()
+            return
+        (indptr, codes, sources) = self.graph.get_incoming_csr(self.activity_codes)
+        start_digit = self.activity_codes[NGramIndex.TRACE_START] + 1
+        initial_marking_id = self.graph.initial_marking_id
+        # Associations already in the index (e.g., added by hand), packed, by size
+        existing = self._pack_associations(base)
+        no_associations = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        # Initialize frontier with the empty n-gram, pointing to each marking from itself
+        current = np.array(sorted(self.graph.markings), dtype=np.int64)
+        packed = np.zeros(len(current), dtype=np.int64)
+        targets = current.copy()
+        associations = []  # List with the arrays of (packed n-gram, target marking) added in each level
+        size = 0
+        while len(current) > 0:
+            weight = base ** size  # Weight of the digit of the activity preceding the n-grams in the frontier
+            # N-grams preceded by the trace start (if the current marking is the initial one)
+            at_start = current == initial_marking_id
+            start_pairs = (start_digit * weight + packed[at_start], targets[at_start])
+            # N-grams preceded by the activity of each incoming edge of the current marking
+            counts = indptr[current + 1] - indptr[current]
+            path_ids = np.repeat(np.arange(len(current)), counts)
+            edge_ids = np.arange(len(path_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+            edge_ids += indptr[current][path_ids]
+            next_current = sources[edge_ids]
+            next_packed = (codes[edge_ids] + 1) * weight + packed[path_ids]
+            next_targets = targets[path_ids]
+            # Associations of the n-grams of the next size
+            level_existing = existing.get(size + 1, no_associations)
+            level_packed = np.concatenate([start_pairs[0], next_packed, level_existing[0]])
+            level_targets = np.concatenate([start_pairs[1], next_targets, level_existing[1]])
+            pairs = NGramIndex._unique_columns(level_packed, level_targets)
+            associations += [pairs]
+            size += 1
+            if size >= self.n_gram_size_limit:
+                break
+            # Keep expanding backwards the non-deterministic n-grams (deduplicating the paths)
+            (unique_packed, num_targets) = np.unique(pairs[0], return_counts=True)  # Pairs are unique
+            ambiguous = np.isin(next_packed, unique_packed[num_targets > 1])
+            (current, packed, targets) = NGramIndex._unique_columns(
+                next_current[ambiguous], next_packed[ambiguous], next_targets[ambiguous]
+            )
+        # Add the associations, decoding the packed n-grams
+        for size, (level_packed, level_targets) in enumerate(associations, start=1):
+            # Pairs sorted by packed n-gram, so the targets of each n-gram are contiguous
+            bounds = np.flatnonzero(np.diff(level_packed)) + 1
+            starts = [0] + bounds.tolist()
+            ends = bounds.tolist() + [len(level_packed)]
+            unique_packed = level_packed[starts]
+            digits = (unique_packed[:, None] // base ** np.arange(size - 1, -1, -1, dtype=np.int64)) % base - 1
+            if not self.encode_activities:
+                digits = np.array(self.activity_labels, dtype=object)[digits]
+            level_targets = level_targets.tolist()
+            for n_gram_elements, start, end in zip(digits.tolist(), starts, ends):
+                self.markings[tuple(n_gram_elements)] = set(level_targets[start:end])
+
+    @staticmethod
+    def _unique_columns(*arrays: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        Deduplicate the rows of a set of parallel arrays, sorting them by the first array (then the second, ...).
+        """
+        if len(arrays[0]) == 0:
+            return arrays
+        order = np.lexsort(arrays[::-1])
+        sorted_arrays = [array[order] for array in arrays]
+        changed = np.zeros(len(order), dtype=bool)
+        changed[0] = True
+        for array in sorted_arrays:
+            changed[1:] |= array[1:] != array[:-1]
+        return tuple(array[changed] for array in sorted_arrays)
+
+    def _pack_associations(self, base: int) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Pack the associations in the index (n-gram as one integer, as in [_add_all_n_grams_vectorized]), grouped by
+        size, as a tuple of arrays with the packed n-gram and the target marking of each association.
+        """
+        packed_associations = {}
+        for n_gram_key, markings in self.markings.items():
+            packed = 0
+            for element in n_gram_key:
+                code = element if self.encode_activities else self.activity_codes[element]
+                packed = packed * base + code + 1
+            (packed_n_grams, targets) = packed_associations.setdefault(len(n_gram_key), ([], []))
+            packed_n_grams += [packed] * len(markings)
+            targets += list(markings)
+        return {
+            size: (np.array(packed_n_grams, dtype=np.int64), np.array(targets, dtype=np.int64))
+            for size, (packed_n_grams, targets) in packed_associations.items()
+        }
+
+    def _add_all_n_grams_in_parallel(self, workers: int):
+        """
+        Add to the index all the n-grams of the reachability graph (same as [_add_all_n_grams]) in a pool of [workers]
+        processes. The n-grams ending with an activity are only expanded from (and their non-determinism only depends
+        on) the edges of that activity, so each process expands independently the n-grams ending with one activity.
+        """
+        # Split the expansion by last activity, starting with the ones with more edges to balance the processes
+        last_activities = sorted(
+            self.graph.activity_to_edges,
+            key=lambda label: (-len(self.graph.activity_to_edges[label]), label),
+        ) + [NGramIndex.TRACE_START]
+        # Associations already in the index (e.g., added by hand) are taken into account for non-determinism
+        last_elements = {label: self._get_key([label])[0] for label in last_activities}
+        with ProcessPoolExecutor(workers, initializer=_init_shard_worker, initargs=(self.graph,)) as executor:
+            for shard_markings in executor.map(
+                    _build_shard,
+                    last_activities,
+                    [
+                        {
+                            n_gram_key: markings
+                            for n_gram_key, markings in self.markings.items()
+                            if n_gram_key[-1] == last_elements[label]
+                        }
+                        for label in last_activities
+                    ],
+                    itertools.repeat(self.n_gram_size_limit),
+                    itertools.repeat(self.encode_activities),
+                    itertools.repeat(self.activity_codes),
+            ):
+                self.markings.update(shard_markings)
+
+    def deepen(self, new_limit: int):
+        """
+        Increase the size limit of the n-grams of the index to [new_limit], with the same result as building it again
+        with the new limit. All the associations of the index are kept, and the backward expansion continues from the
+        paths of the n-grams of the current maximum size that are still non-deterministic. The current maximum size is
+        the size of the longest n-gram in the index, so it also works for indexes read from a file (whose size limit is
+        not stored).
+
+        :param new_limit: new maximum size of the n-grams of the index.
+        """
+        if self.disk_tier is not None or self.partial_order:
+            raise RuntimeError("Error, only indexes with sequence keys in memory can be deepened.")
+        current_limit = max(map(len, self.markings), default=0)
+        if new_limit <= max(current_limit, self.n_gram_size_limit):
+            raise RuntimeError(f"Error, the new size limit ({new_limit}) must be greater than the current one.")
+        (self.n_gram_size_limit, self.truncated) = (new_limit, False)
+        if self.lazy:
+            # The n-grams longer than the previous limit can now be computed on demand (discarding the best markings
+            # cached with the previous limit)
+            self._missing_n_grams = set()
+            self._reset_lookup_structures()
+            return
+        # Continue from the paths of the non-deterministic n-grams of the current maximum size (not starting the trace)
+        start_element = self._get_key([NGramIndex.TRACE_START])[0]
+        frontier = {
+            n_gram_key for n_gram_key, markings in self.markings.items()
+            if len(n_gram_key) == current_limit and len(markings) > 1 and n_gram_key[0] != start_element
+        }
+        self._add_all_n_grams(initial_paths=[
+            (marking_id, n_gram_key, target_marking)
+            for n_gram_key, paths in self._search_paths_of_n_grams(frontier).items()
+            for marking_id, target_marking in paths
+        ])
+        # Update the lookup structures with the new n-grams (the rest do not depend on them)
+        resolutions = self.resolutions
+        self._reset_lookup_structures()
+        if resolutions is None:
+            self._build_lookup_structures()
+        else:
+            self.resolutions = resolutions
+            self._update_lookup_structures(
+                {n_gram_key for n_gram_key in self.markings if len(n_gram_key) > current_limit}
+            )
+
+    def _search_paths_of_n_grams(self, n_gram_keys: Set[tuple]) -> Dict[tuple, Set[Tuple[int, int]]]:
+        """
+        Search for the paths of a set of n-grams (with no trace start) reading them backwards in the reachability
+        graph, as the pairs (current marking, target marking) of each path. Same as [_search_paths_backwards], but
+        searching by increasing size the paths of all their suffixes, so the n-grams sharing a suffix share its search.
+        """
+        # Incoming edges of each marking, as the source markings of each element (key of the activity)
+        incoming = {}
+        for edge_id, (source_marking_id, target_marking_id) in self.graph.edges.items():
+            element = self._get_key([self.graph.edge_to_activity[edge_id]])[0]
+            incoming.setdefault(target_marking_id, {}).setdefault(element, []).append(source_marking_id)
+        # Extend the paths of each suffix with the previous element, starting with the empty suffix
+        paths = {(): {(marking_id, marking_id) for marking_id in self.graph.markings}}
+        for size in range(1, max(map(len, n_gram_keys), default=0) + 1):
+            paths = {
+                suffix: {
+                    (source_marking_id, target_marking)
+                    for marking_id, target_marking in paths[suffix[1:]]
+                    for source_marking_id in incoming.get(marking_id, {}).get(suffix[0], ())
+                }
+                for suffix in {n_gram_key[-size:] for n_gram_key in n_gram_keys}
+            }
+        return paths
+
+    def apply_graph_delta(
+            self,
+            added_markings: Iterable[Set[str]] = (),
+            added_edges: Iterable[Tuple[str, Set[str], Set[str]]] = (),
+            removed_edges: Iterable[Tuple[str, Set[str], Set[str]]] = (),
+    ):
+        """
+        Apply a change to the reachability graph in [self.graph] and update the index incrementally, with the same
+        result as building it again. Only the paths to the markings that are up to n-1 edges downstream of a changed
+        edge (affected markings) can change, so their associations are removed from the index and expanded again.
+        Then, the n-grams whose non-determinism changed are added (searching their markings in the whole graph) or
+        removed, by increasing size.
+
+        :param added_markings: markings (sets of places) to add to the graph.
+        :param added_edges: edges to add to the graph, as tuples (activity label, source marking, target marking).
+        :param removed_edges: edges to remove from the graph, as tuples (activity label, source marking, target
+        marking).
+        """
+        if self.disk_tier is not None or self.partial_order:
+            raise RuntimeError("Error, only indexes with sequence keys in memory can be updated incrementally.")
+        (added_edges, removed_edges) = (list(added_edges), list(removed_edges))
+        # Markings affected by the removed edges (in the graph before removing them)
+        affected_markings = self._get_downstream_markings(
+            {self.graph.marking_to_key[tuple(sorted(target_marking))] for _, _, target_marking in removed_edges}
+        )
+        elements = self._get_elements()
+        # Apply the changes to the graph
+        for marking in added_markings:
+            self.graph.add_marking(marking)
+        for activity, source_marking, target_marking in added_edges:
+            self.graph.add_edge(activity, source_marking, target_marking)
+        for activity, source_marking, target_marking in removed_edges:
+            self.graph.remove_edge(activity, source_marking, target_marking)
+        self._update_activity_codes()
+        resolutions = self.resolutions
+        self._reset_lookup_structures()
+        if self.lazy:
+            # Discard the n-grams computed on demand (also the ones persisted, so they are not preloaded in later runs)
+            (self.markings, self._missing_n_grams) = ({}, set())
+            if self.lazy_file_path is not None:
+                open(self.lazy_file_path, "w").close()
+            return
+        # Markings affected by the added edges (in the graph after adding them)
+        affected_markings |= self._get_downstream_markings(
+            {self.graph.marking_to_key[tuple(sorted(target_marking))] for _, _, target_marking in added_edges}
+        )
+        elements |= self._get_elements()
+        # Remove the associations to the affected markings, and expand them again
+        previous_markings = dict(self.markings)
+        for n_gram_key, markings in previous_markings.items():
+            if not markings.isdisjoint(affected_markings):
+                self.markings[n_gram_key] = set(markings) - affected_markings
+        self._add_all_n_grams(target_markings=affected_markings)
+        # Add or remove the n-grams changed by the expansion, or whose suffix changed its non-determinism, by size
+        candidates = {}
+        for n_gram_key, markings in self.markings.items():
+            previous = previous_markings.get(n_gram_key)
+            if previous is None or not previous.isdisjoint(affected_markings) or \
+                    not markings.isdisjoint(affected_markings):
+                candidates.setdefault(len(n_gram_key), set()).add(n_gram_key)
+        changed_n_gram_keys = set()
+        for size in range(1, self.n_gram_size_limit + 1):
+            changed_n_gram_keys |= candidates.get(size, set())
+            for n_gram_key in candidates.get(size, set()):
+                previous_size = len(previous_markings.get(n_gram_key, ()))
+                if size > 1 and len(self.markings.get(n_gram_key[1:], ())) < 2:
+                    # Suffix not in the index or deterministic
+                    self.markings.pop(n_gram_key, None)
+                elif n_gram_key not in previous_markings:
+                    # New n-gram, search its paths to the markings not affected too
+                    self.markings[n_gram_key] = set(self._search_marking_ids_backwards(self._get_labels(n_gram_key)))
+                current_size = len(self.markings.get(n_gram_key, ()))
+                if current_size == 0:
+                    self.markings.pop(n_gram_key, None)
+                if size < self.n_gram_size_limit and current_size > 1 and previous_size < 2:
+                    # Non-determinism is new, so it was not expanded to the markings not affected
+                    candidates.setdefault(size + 1, set()).update(
+                        (element,) + n_gram_key for element in self._get_previous_elements(n_gram_key)
+                    )
+                elif size < self.n_gram_size_limit and current_size < 2 <= previous_size:
+                    # Non-determinism is lost, so its extensions must be removed
+                    candidates.setdefault(size + 1, set()).update(
+                        (element,) + n_gram_key for element in elements if (element,) + n_gram_key in self.markings
+                    )
+        # Update the lookup structures over the final associations
+        if resolutions is None:
+            self._build_lookup_structures()
+        else:
+            self.resolutions = resolutions
+            self._update_lookup_structures(changed_n_gram_keys)
+
+    def _update_lookup_structures(self, changed_n_gram_keys: Set[tuple]):
+        """
+        Update the lookup structures built with [_build_lookup_structures] after modifying the associations of the
+        n-grams in [changed_n_gram_keys] (removing them from the index if they are not in [self.markings]). The
+        precomputed best marking of an n-gram only depends on the n-grams that are its suffix, so only the changed
+        n-grams and their extensions are recomputed (or all of them, if most n-grams changed).
+        """
+        if len(changed_n_gram_keys) > len(self.markings) / 2:
+            self._build_lookup_structures()
+            return
+        # Changed n-grams still in the index and their extensions
+        n_gram_keys = {
+            n_gram_key for n_gram_key in self.markings
+            if any(n_gram_key[-k:] in changed_n_gram_keys for k in range(len(n_gram_key), 0, -1))
+        }
+        # Remove the n-grams not in the index anymore, and recompute the rest
+        for n_gram_key in changed_n_gram_keys - n_gram_keys:
+            self.resolutions.pop(n_gram_key, None)
+        self._intern_markings(n_gram_keys)
+        self._build_resolutions(n_gram_keys)
+        self._max_n_gram_size = max(map(len, self.markings), default=0)
+        if self.layout == NGramIndexLayout.TRIE:
+            self._build_suffix_trie()
+        if self.bloom_false_positive_rate is not None:
+            self._build_bloom_filter()
+
+    def _get_downstream_markings(self, marking_ids: Set[int]) -> Set[int]:
+        """
+        Retrieve the markings reachable from [marking_ids] traversing up to n-1 edges of the reachability graph
+        (including [marking_ids]), i.e., the markings whose paths of up to n edges might traverse an edge to them.
+        """
+        downstream_markings = set(marking_ids)
+        frontier = set(marking_ids)
+        for _ in range(self.n_gram_size_limit - 1):
+            frontier = {
+                self.graph.edges[edge_id][1]
+                for marking_id in frontier
+                for edge_id in self.graph.outgoing_edges[marking_id]
+            } - downstream_markings
+            downstream_markings |= frontier
+        return downstream_markings
+
+    def _get_elements(self) -> Set:
+        """
+        Retrieve the elements (key of an activity or the trace start) of the n-grams of the reachability graph.
+        """
+        return {self._get_key([label])[0] for label in list(self.graph.activity_to_edges) + [NGramIndex.TRACE_START]}
+
+    def _get_previous_elements(self, n_gram_key: tuple) -> Set:
+        """
+        Retrieve the elements (key of an activity or the trace start) that can precede an n-gram in the reachability
+        graph, i.e., the activities of the incoming edges of the markings reached reading it backwards.
+        """
+        previous_elements = set()
+        for _, marking_id in self._search_paths_backwards(self._get_labels(n_gram_key)):
+            if marking_id is not None:
+                previous_elements |= {
+                    self._get_key([self.graph.edge_to_activity[edge_id]])[0]
+                    for edge_id in self.graph.incoming_edges[marking_id]
+                }
                 if marking_id == self.graph.initial_marking_id:
-                    current_n_gram = [NGramIndex.TRACE_START] + previous_n_gram
-                    self.add_association(current_n_gram, target_marking)
-                # Grow n-gram with each incoming edge
-                for edge_id in self.graph.incoming_edges[marking_id]:
-                    # Add association
-                    current_n_gram = [self.graph.edge_to_activity[edge_id]] + previous_n_gram
-                    self.add_association(current_n_gram, target_marking)
-                    # Save source marking for exploration if necessary
-                    if len(current_n_gram) < self.n_gram_size_limit:
-                        (source_marking_id, _) = self.graph.edges[edge_id]
-                        next_marking_stack += [source_marking_id]
-                        next_n_gram_stack += [current_n_gram]
-                        next_target_marking_stack += [target_marking]
-            # Update search stacks when necessary to keep expanding backwards
-            while len(next_marking_stack) > 0:
-                # Retrieve marking to explore, n-gram that led (backwards) to it, and marking at the end of the n-gram
-                marking_id = next_marking_stack.pop()
-                previous_n_gram = next_n_gram_stack.pop()
-                target_marking = next_target_marking_stack.pop()
-                # If the n-gram is not deterministic, add it to search further
-                markings = self.get_marking_state(previous_n_gram)
-                if len(markings) > 1:
-                    marking_stack += [marking_id]
-                    n_gram_stack += [previous_n_gram]
-                    target_marking_stack += [target_marking]
+                    previous_elements.add(self._get_key([NGramIndex.TRACE_START])[0])
+        return previous_elements
+
+    def _create_disk_tier(self, tier_split: int, tier_path: Path):
+        """
+        Create the (empty) disk-backed store for the n-grams longer than [tier_split] in [tier_path], replacing its
+        previous content.
+        """
+        self.disk_tier = SQLiteNGramTier(tier_path)
+        self.disk_tier.clear()
+        self.disk_tier.set_metadata("tier_split", str(tier_split))
+        (self.tier_split, self.resolutions) = (tier_split, {})
+
+    def _spill_n_grams(self, size: int):
+        """
+        Once the n-grams of size [size] are completely expanded, precompute their best marking (see
+        [_build_resolutions]) and move the n-grams of size [size]-1 (not needed anymore to compute any other) to the
+        disk tier, if they are longer than [self.tier_split].
+        """
+        self._build_resolutions([n_gram_key for n_gram_key in self.markings if len(n_gram_key) == size])
+        if size - 1 > self.tier_split:
+            self._move_to_disk_tier([n_gram_key for n_gram_key in self.markings if len(n_gram_key) == size - 1])
+
+    def _move_to_disk_tier(self, n_gram_keys: List[tuple]):
+        """
+        Move n-grams (with their precomputed best marking) from memory to the disk tier, in one batch.
+        """
+        self.disk_tier.put_many(
+            (self._get_labels(n_gram_key), self.markings[n_gram_key], self.resolutions[n_gram_key])
+            for n_gram_key in n_gram_keys
+        )
+        for n_gram_key in n_gram_keys:
+            del self.markings[n_gram_key]
+            del self.resolutions[n_gram_key]
+
+    def freeze(self) -> FrozenNGramIndex:
+        """
+        Create a read-only version of the index, backed by a minimal perfect hash over the encoded n-grams and flat
+        arrays for the n-grams, their marking IDs, and their best marking, with the same lookup semantics and a much
+        lower memory footprint. This index is not modified.
+
+        :return: the frozen version of this index.
+        """
+        n_grams = {
+            encoded_key: (markings, resolution)
+            for encoded_key, markings, resolution in self._get_encoded_associations()
+        }
+        return FrozenNGramIndex.build(self.graph, self.n_gram_size_limit, dict(self.activity_codes), n_grams)
+
+    def _get_encoded_associations(self) -> Iterator[Tuple[Tuple[int, ...], FrozenSet[int], int]]:
+        """
+        Iterate over all the n-grams of the index (including the ones in the disk tier) encoded as tuples of activity
+        codes, with their marking IDs and their best marking ID. If the lookup structures are outdated, the best
+        markings are computed without replacing the ones of this index.
+        """
+        resolutions = self.resolutions
+        if resolutions is None:
+            # Outdated lookup structures, compute the resolutions without replacing the ones of this index
+            max_n_gram_size = self._max_n_gram_size
+            self._build_resolutions()
+            (resolutions, self.resolutions, self._max_n_gram_size) = (self.resolutions, None, max_n_gram_size)
+        for n_gram_key, markings in self._get_associations():
+            encoded_key = n_gram_key if self.encode_activities else tuple(
+                self.activity_codes[label] for label in n_gram_key
+            )
+            resolution = resolutions.get(n_gram_key) or self._get_resolution(n_gram_key)
+            yield encoded_key, markings, resolution[0]
+
+    def to_sqlite(self, file_path: Path):
+        """
+        Store the index (including its disk tier, if any) in an SQLite database in WAL mode (see [SQLiteNGramIndex]),
+        replacing its previous content. The reachability graph must be stored separately.
+
+        :param file_path: path to the database file.
+        """
+        if self.partial_order:
+            raise RuntimeError("Error, an index with partial-order keys cannot be stored (build it when loading).")
+        self._update_activity_codes()
+        SQLiteNGramIndex.write(
+            file_path, self.graph, self.n_gram_size_limit, dict(self.activity_codes), self._get_encoded_associations()
+        )
+
+    @staticmethod
+    def from_sqlite(file_path: Path, reachability_graph: ReachabilityGraph, pool_size: int = 4) -> SQLiteNGramIndex:
+        """
+        Open an index stored with [to_sqlite] as a read-only index that runs its lookups on the database, without
+        loading its n-grams in memory, and that can be queried from multiple threads.
+
+        :param file_path: path to the database file.
+        :param reachability_graph: reachability graph of the index.
+        :param pool_size: number of read-only connections to the database (i.e., maximum number of concurrent lookups).
+        :return: the index backed by the database.
+        """
+        return SQLiteNGramIndex(file_path, reachability_graph, pool_size)
 
     def get_self_contained_map(self) -> dict:
         return {
-            key: [self.graph.markings[marking] for marking in self.markings[key]]
-            for key in self.markings
+            self._get_labels(key): [self.graph.markings[marking] for marking in markings]
+            for key, markings in self._get_associations()
         }
 
     def to_self_contained_map_file(self, file_path: Path):
+        if self.partial_order:
+            raise RuntimeError("Error, an index with partial-order keys cannot be stored (build it when loading).")
         with open(file_path, "w") as output_file:
-            for n_gram in self.markings:
-                markings = [self.graph.markings[marking] for marking in self.markings[n_gram]]
-                output_file.write(f"{str(n_gram)} : {str(markings)}\n")
+            for n_gram_key, markings in self.markings.items():
+                output_file.write(self._format_line(n_gram_key, markings))
+        # Store the Bloom filter (if any) alongside the index, removing outdated ones
+        bloom_filter_path = NGramIndex._get_bloom_filter_path(file_path)
+        if self.bloom_filter is not None:
+            self.bloom_filter.to_file(bloom_filter_path)
+        elif bloom_filter_path.exists():
+            bloom_filter_path.unlink()
+        # Store the disk tier (if any) alongside the index (which only contains the n-grams in memory)
+        tier_path = NGramIndex._get_tier_path(file_path)
+        if self.disk_tier is not None:
+            if tier_path.resolve() != self.disk_tier.file_path.resolve():
+                tier_path.unlink(missing_ok=True)
+                self.disk_tier.backup(tier_path)
+        elif tier_path.exists():
+            tier_path.unlink()
+
+    def _format_line(self, n_gram_key: tuple, markings: Iterable[int]) -> str:
+        markings = [self.graph.markings[marking] for marking in markings]
+        return f"{str(self._get_labels(n_gram_key))} : {str(markings)}\n"
+
+    def _parse_line(self, line: str) -> Tuple[tuple, Set[int]]:
+        match = re.search(r'\((.*?)\)\s*:\s*\[(.*)\]', line)
+        if not match:
+            raise RuntimeError(f"Problem with format of line: {line}.")
+        key = ast.literal_eval(f"({match.group(1)})")
+        value = ast.literal_eval(f"[{match.group(2)}]")
+        n_gram_key = self._get_key(list(key))
+        if n_gram_key is None:
+            raise RuntimeError(f"Problem with the activities (not in the graph) of line: {line}.")
+        return n_gram_key, {self.graph.marking_to_key[tuple(sorted(marking))] for marking in value}
+
+    @staticmethod
+    def _get_bloom_filter_path(file_path: Path) -> Path:
+        return Path(f"{file_path}.bloom")
 
     @staticmethod
-    def from_self_contained_map_file(file_path: Path, reachability_graph: ReachabilityGraph) -> 'NGramIndex':
+    def _get_tier_path(file_path: Path) -> Path:
+        return Path(f"{file_path}.tier")
+
+    @staticmethod
+    def from_self_contained_map_file(
+            file_path: Path,
+            reachability_graph: ReachabilityGraph,
+            encode_activities: bool = False,
+            layout: NGramIndexLayout = NGramIndexLayout.DICT,
+    ) -> 'NGramIndex':
         # Instantiate the marking
-        n_gram_index = NGramIndex(reachability_graph, 0)
+        n_gram_index = NGramIndex(reachability_graph, 0, encode_activities, layout)
         # Go over file line by line
         with open(file_path, "r") as input_file:
             for line in input_file:
                 # Retrieve key and value
                 if line != "":
-                    match = re.search(r'\((.*?)\)\s*:\s*\[(.*)\]', line)
-                    if match:
-                        key = ast.literal_eval(f"({match.group(1)})")
-                        value = ast.literal_eval(f"[{match.group(2)}]")
-                        n_gram_index.markings[key] = {
-                            reachability_graph.marking_to_key[tuple(sorted(marking))]
-                            for marking in value
-                        }
-                    else:
-                        raise RuntimeError(f"Problem with format of line: {line}.")
+                    (n_gram_key, markings) = n_gram_index._parse_line(line)
+                    n_gram_index.markings[n_gram_key] = markings
+        # Attach the disk tier stored alongside the index (if any)
+        tier_path = NGramIndex._get_tier_path(file_path)
+        if tier_path.exists():
+            n_gram_index.disk_tier = SQLiteNGramTier(tier_path)
+            n_gram_index.tier_split = int(n_gram_index.disk_tier.get_metadata("tier_split"))
+        # Build lookup structures over the read associations (including the ones in the disk tier)
+        n_gram_index._build_lookup_structures()
+        # Read the Bloom filter stored alongside the index (if any)
+        bloom_filter_path = NGramIndex._get_bloom_filter_path(file_path)
+        if bloom_filter_path.exists():
+            n_gram_index.bloom_filter = BloomFilter.from_file(bloom_filter_path)
+            n_gram_index.bloom_false_positive_rate = n_gram_index.bloom_filter.false_positive_rate
         # Return read n-gram index
         return n_gram_index
+
+
+_shard_graph: Optional[ReachabilityGraph] = None  # Reachability graph of the worker processes of a parallel build
+
+
+def _init_shard_worker(graph: ReachabilityGraph):
+    global _shard_graph
+    _shard_graph = graph
+
+
+def _build_shard(
+        last_activity: str,
+        markings: Dict[tuple, Set[int]],
+        n_gram_size_limit: int,
+        encode_activities: bool,
+        activity_codes: Dict[str, int],
+) -> Dict[tuple, Set[int]]:
+    """
+    Expand backwards the n-grams ending with one activity in a parallel build (see
+    [NGramIndex._add_all_n_grams_in_parallel]), starting with the associations already in the index ending with it.
+    """
+    n_gram_index = NGramIndex(_shard_graph, n_gram_size_limit, encode_activities)
+    n_gram_index.activity_codes = dict(activity_codes)
+    n_gram_index.markings = {n_gram_key: set(n_gram_markings) for n_gram_key, n_gram_markings in markings.items()}
+    n_gram_index._add_all_n_grams({last_activity})
+    return n_gram_index.markings
@@ -0,0 +1,106 @@
+import itertools
+import json
+import sqlite3
+from pathlib import Path
+from typing import FrozenSet, Iterable, Iterator, Optional, Tuple
+
+
+class SQLiteNGramTier:
+    """
+    Disk-backed store (SQLite database) for the n-grams of an index, with their marking IDs and their precomputed best
+    marking (see [NGramIndex._build_resolutions]). The n-grams are stored as the (JSON) list of their activity labels,
+    so the same store is valid for indexes with and without encoded activities.
+    """
+
+    WRITE_BATCH_SIZE = 1_000  # Number of rows sorted and inserted together by [put_many]
+
+    def __init__(self, file_path: Path):
+        self.file_path = Path(file_path)
+        self.connection = sqlite3.connect(str(self.file_path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS n_grams ("
+            "n_gram TEXT PRIMARY KEY, size INTEGER NOT NULL, markings TEXT NOT NULL, "
+            "best_marking INTEGER, best_size INTEGER)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+
+    @staticmethod
+    def _encode(n_gram: Tuple[str, ...]) -> str:
+        return json.dumps(list(n_gram), separators=(",", ":"))
+
+    def get(self, n_gram: Tuple[str, ...]) -> Optional[Tuple[FrozenSet[int], Optional[Tuple[int, int]]]]:
+        """
+        Retrieve the marking IDs and the best marking (ID and size k of the k-gram where the search stops) of an
+        n-gram, or None if the n-gram is not in the store.
+        """
+        row = self.connection.execute(
+            "SELECT markings, best_marking, best_size FROM n_grams WHERE n_gram = ?",
+            (SQLiteNGramTier._encode(n_gram),),
+        ).fetchone()
+        if row is None:
+            return None
+        (markings, best_marking, best_size) = row
+        return frozenset(json.loads(markings)), None if best_marking is None else (best_marking, best_size)
+
+    def put_many(self, n_grams: Iterable[Tuple[Tuple[str, ...], FrozenSet[int], Optional[Tuple[int, int]]]]):
+        """
+        Insert (or replace) n-grams with their marking IDs and best marking (None if not computed) in one transaction.
+        The rows are inserted in batches of [WRITE_BATCH_SIZE], each of them sorted by key, so the B-tree of the keys
+        is filled in order without materializing all the rows.
+        """
+        rows = (
+            (
+                SQLiteNGramTier._encode(n_gram),
+                len(n_gram),
+                json.dumps(sorted(markings)),
+                None if resolution is None else resolution[0],
+                None if resolution is None else resolution[1],
+            )
+            for n_gram, markings, resolution in n_grams
+        )
+        with self.connection:
+            while True:
+                batch = sorted(itertools.islice(rows, SQLiteNGramTier.WRITE_BATCH_SIZE))
+                if len(batch) == 0:
+                    break
+                self.connection.executemany("INSERT OR REPLACE INTO n_grams VALUES (?, ?, ?, ?, ?)", batch)
+
+    def items(self) -> Iterator[Tuple[Tuple[str, ...], FrozenSet[int], Optional[Tuple[int, int]]]]:
+        """
+        Iterate over the n-grams of the store (by increasing size), with their marking IDs and best marking.
+        """
+        cursor = self.connection.execute(
+            "SELECT n_gram, markings, best_marking, best_size FROM n_grams ORDER BY size"
+        )
+        for n_gram, markings, best_marking, best_size in cursor:
+            resolution = None if best_marking is None else (best_marking, best_size)
+            yield tuple(json.loads(n_gram)), frozenset(json.loads(markings)), resolution
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM n_grams").fetchone()[0]
+
+    def get_max_size(self) -> int:
+        return self.connection.execute("SELECT COALESCE(MAX(size), 0) FROM n_grams").fetchone()[0]
+
+    def get_metadata(self, name: str) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM metadata WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_metadata(self, name: str, value: str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (name, value))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM n_grams")
+
+    def backup(self, file_path: Path):
+        target = sqlite3.connect(str(file_path))
+        try:
+            self.connection.backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        self.connection.close()
@@ -1,6 +1,8 @@
 import ast
 from dataclasses import dataclass
-from typing import List, Set
+from typing import Dict, List, Set, FrozenSet, Tuple
+
+import numpy as np
 
 
 @dataclass
@@ -10,16 +12,19 @@ class ReachabilityGraph:
         self.activity_to_edges = {}  # Dict with activity label as key, and list of edge IDs as value
         self.edge_to_activity = {}  # Dict with edge ID as key, and activity label as value
         self.markings = {}  # Dict with ID as key, and set of place IDs (marking) as value
+        self.frozen_markings = {}  # Dict with ID as key, and immutable (interned) copy of the marking as value
         self.marking_to_key = {}  # Dict with marking (sorted tuple) as key, and ID as value
         self.incoming_edges = {}  # Dict with marking ID as key, and set of incoming edge IDs as value
         self.outgoing_edges = {}  # Dict with marking ID as key, and set of outgoing edge IDs as value
         self.initial_marking_id = None  # ID of the initial marking
+        self._next_edge_id = 0  # ID of the next edge to add (IDs of removed edges are not reused)
 
     def add_marking(self, marking: set, is_initial=False):
         marking_key = tuple(sorted(marking))
         if marking_key not in self.marking_to_key:
             marking_id = len(self.markings)
             self.markings[marking_id] = marking
+            self.frozen_markings[marking_id] = frozenset(marking)
             self.marking_to_key[marking_key] = marking_id
             self.incoming_edges[marking_id] = set()
             self.outgoing_edges[marking_id] = set()
@@ -28,7 +33,7 @@ class ReachabilityGraph:
 
     def add_edge(self, activity: str, source_marking: set, target_marking: set):
         # Get edge components
-        edge_id = len(self.edges)
+        edge_id = self._next_edge_id
         source_id = self.marking_to_key[tuple(sorted(source_marking))]
         target_id = self.marking_to_key[tuple(sorted(target_marking))]
         # Check if edge already in the graph
@@ -43,6 +48,55 @@ class ReachabilityGraph:
             self.edge_to_activity[edge_id] = activity
             self.incoming_edges[target_id] |= {edge_id}
             self.outgoing_edges[source_id] |= {edge_id}
+            self._next_edge_id += 1
+
+    def remove_edge(self, activity: str, source_marking: set, target_marking: set):
+        # Get edge components
+        source_id = self.marking_to_key[tuple(sorted(source_marking))]
+        target_id = self.marking_to_key[tuple(sorted(target_marking))]
+        # Search for the edge in the graph
+        edge_ids = [
+            edge_id
+            for edge_id in self.activity_to_edges.get(activity, set())
+            if self.edges[edge_id] == (source_id, target_id)
+        ]
+        for edge_id in edge_ids:
+            # Update graph elements
+            del self.edges[edge_id]
+            del self.edge_to_activity[edge_id]
+            self.activity_to_edges[activity] = self.activity_to_edges[activity] - {edge_id}
+            if len(self.activity_to_edges[activity]) == 0:
+                del self.activity_to_edges[activity]
+            self.incoming_edges[target_id] -= {edge_id}
+            self.outgoing_edges[source_id] -= {edge_id}
+
+    def get_frozen_marking(self, marking_id: int) -> FrozenSet[str]:
+        """
+        Retrieve the immutable version of a marking. The same frozenset instance is returned for each call, so it can
+        be stored or compared without copying, and modifying it does not alter the reachability graph.
+
+        :param marking_id: ID of the marking in the reachability graph.
+        :return: the marking (frozenset of place IDs) with the given ID.
+        """
+        return self.frozen_markings[marking_id]
+
+    def get_incoming_csr(self, activity_codes: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Export the incoming edges of the graph in CSR (compressed sparse row) format: the incoming edges of the
+        marking with ID m are the positions indptr[m]..indptr[m+1]-1 of the arrays with the code of their activity
+        and the ID of their source marking.
+
+        :param activity_codes: dict with the activity label as key and its (int) code as value.
+        :return: a tuple with the arrays indptr, activity codes, and source marking IDs.
+        """
+        num_markings = max(self.markings) + 1 if len(self.markings) > 0 else 0
+        edge_ids = sorted(self.edges, key=lambda edge_id: self.edges[edge_id][1])
+        targets = np.array([self.edges[edge_id][1] for edge_id in edge_ids], dtype=np.int64)
+        indptr = np.zeros(num_markings + 1, dtype=np.int64)
+        np.cumsum(np.bincount(targets, minlength=num_markings), out=indptr[1:])
+        codes = np.array([activity_codes[self.edge_to_activity[edge_id]] for edge_id in edge_ids], dtype=np.int64)
+        sources = np.array([self.edges[edge_id][0] for edge_id in edge_ids], dtype=np.int64)
+        return indptr, codes, sources
 
     def get_markings_from_activity_sequence(self, activity_sequence: List[str]) -> List[Set[str]]:
         # Initiate search in the initial marking
@@ -0,0 +1,213 @@
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from ongoing_process_state.n_gram_index import NGramIndex
+from ongoing_process_state.reachability_graph import ReachabilityGraph
+
+
+class ReverseSuffixAutomaton:
+    """
+    Alternative to the n-gram index without a limit in the size of the n-grams. The reachability graph is read
+    backwards and determinised: each state of the automaton is the set of pairs (target marking, current marking) such
+    that the suffix read so far (backwards, from the last activity) leads from the current marking to the target
+    marking. The initial state has the pair (m, m) for each marking m, and reading [NGramIndex.TRACE_START] keeps only
+    the pairs whose current marking is the initial one. The markings associated to a suffix are the target markings of
+    its state, so the states with one (or no) target marking are not expanded further. Finally, the automaton is
+    minimised merging the states with the same target markings and transitions.
+
+    The recent history of a case, read backwards, walks the automaton until reaching a state with one target marking,
+    with no limit in the number of activities read.
+    """
+
+    def __init__(self, graph: ReachabilityGraph):
+        self.graph = graph
+        self.initial_state = 0
+        self.transitions: List[Dict[str, int]] = []  # Dict with the previous activity as key and next state as value
+        self.markings: List[FrozenSet[int]] = []  # Target marking IDs of each state
+
+    def __len__(self) -> int:
+        return len(self.markings)
+
+    def build(self):
+        """
+        Build the automaton for the reachability graph in [self.graph] with the subset construction, and minimise it.
+        """
+        # Initialize the subset construction with the pairs (m, m) for each marking
+        initial_pairs = frozenset((marking_id, marking_id) for marking_id in self.graph.markings)
+        states = {initial_pairs: 0}
+        transitions = [{}]
+        markings = [frozenset(self.graph.markings)]
+        stack = [initial_pairs]
+        # Expand each ambiguous state backwards
+        while len(stack) > 0:
+            pairs = stack.pop()
+            state = states[pairs]
+            # Group the pairs reached through each (backwards) activity
+            next_pairs = {}
+            for target_marking, marking_id in pairs:
+                if marking_id == self.graph.initial_marking_id:
+                    next_pairs.setdefault(NGramIndex.TRACE_START, set()).add((target_marking, marking_id))
+                for edge_id in self.graph.incoming_edges[marking_id]:
+                    (source_marking_id, _) = self.graph.edges[edge_id]
+                    label = self.graph.edge_to_activity[edge_id]
+                    next_pairs.setdefault(label, set()).add((target_marking, source_marking_id))
+            for label, label_pairs in next_pairs.items():
+                # A state reached through the trace start only needs its markings (there is nothing before it)
+                label_pairs = frozenset(
+                    (target_marking, None) for target_marking, _ in label_pairs
+                ) if label == NGramIndex.TRACE_START else frozenset(label_pairs)
+                if label_pairs not in states:
+                    states[label_pairs] = len(transitions)
+                    transitions += [{}]
+                    markings += [frozenset(target_marking for target_marking, _ in label_pairs)]
+                    if len(markings[-1]) > 1 and label != NGramIndex.TRACE_START:
+                        # Ambiguous state, keep expanding it
+                        stack += [label_pairs]
+                transitions[state][label] = states[label_pairs]
+        # Minimise the automaton
+        (self.transitions, self.markings, self.initial_state) = ReverseSuffixAutomaton._minimise(transitions, markings)
+
+    @staticmethod
+    def _minimise(
+            transitions: List[Dict[str, int]],
+            markings: List[FrozenSet[int]],
+    ) -> Tuple[List[Dict[str, int]], List[FrozenSet[int]], int]:
+        """
+        Merge the equivalent states of the automaton with Moore's partition refinement: start grouping the states by
+        their markings, and split the groups until all the states of each group go to the same groups with the same
+        activities.
+        """
+        # Initial partition by target markings
+        block_ids = {}
+        blocks = [block_ids.setdefault(state_markings, len(block_ids)) for state_markings in markings]
+        num_blocks = len(block_ids)
+        # Refine until no block is split
+        while True:
+            signatures = {}
+            new_blocks = []
+            for state, state_transitions in enumerate(transitions):
+                signature = (
+                    blocks[state],
+                    frozenset((label, blocks[next_state]) for label, next_state in state_transitions.items()),
+                )
+                new_blocks += [signatures.setdefault(signature, len(signatures))]
+            if len(signatures) == num_blocks:
+                break
+            (blocks, num_blocks) = (new_blocks, len(signatures))
+        # Build the minimal automaton with one state per block
+        minimal_transitions = [{} for _ in range(num_blocks)]
+        minimal_markings = [frozenset() for _ in range(num_blocks)]
+        for state, state_transitions in enumerate(transitions):
+            minimal_markings[blocks[state]] = markings[state]
+            minimal_transitions[blocks[state]] = {
+                label: blocks[next_state] for label, next_state in state_transitions.items()
+            }
+        return minimal_transitions, minimal_markings, blocks[0]
+
+    def get_identification_depths(self) -> Dict[int, Optional[int]]:
+        """
+        Compute, for each marking of the reachability graph, its identification depth: the size n from which all the
+        n-grams associated to it are deterministic (or cannot be extended further), i.e., the minimum size limit of an
+        n-gram index to identify the marking as well as with any larger limit. The depth of a marking is the length of
+        the longest walk from the initial state of the automaton through states with that marking, as only the
+        non-deterministic states are expanded. If one of these walks has a loop, the depth is unbounded (None).
+
+        :return: a dict with the ID of each marking as key, and its identification depth (None if unbounded) as value.
+        """
+        return {marking_id: self._get_longest_walk(marking_id) for marking_id in self.graph.markings}
+
+    def _get_longest_walk(self, marking_id: int) -> Optional[int]:
+        """
+        Compute the length of the longest walk from the initial state through states with the marking [marking_id]
+        (with an iterative depth-first search), or None if there is a loop in them.
+        """
+        def successors(state: int) -> List[int]:
+            return [
+                next_state for next_state in self.transitions[state].values()
+                if marking_id in self.markings[next_state]
+            ]
+
+        lengths = {}  # Dict with the (explored) state as key, and the length of its longest walk as value
+        stack = [(self.initial_state, iter(successors(self.initial_state)))]
+        in_stack = {self.initial_state}
+        while len(stack) > 0:
+            (state, next_states) = stack[-1]
+            next_state = next(next_states, None)
+            if next_state is None:
+                # All the walks from this state explored
+                stack.pop()
+                in_stack.remove(state)
+                lengths[state] = max([lengths[next_state] + 1 for next_state in successors(state)], default=0)
+            elif next_state in in_stack:
+                # Loop in the states with the marking
+                return None
+            elif next_state not in lengths:
+                stack += [(next_state, iter(successors(next_state)))]
+                in_stack.add(next_state)
+        return lengths[self.initial_state]
+
+    def _get_state(self, n_gram: List[str]):
+        state = self.initial_state
+        for label in reversed(n_gram):
+            state = self.transitions[state].get(label)
+            if state is None:
+                break
+        return state
+
+    def get_marking_ids(self, n_gram: List[str]) -> FrozenSet[int]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the IDs (in the reachability
+        graph) of the markings associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: an immutable set with the ID(s) of the marking(s) corresponding to the state of the process.
+        """
+        state = self._get_state(n_gram)
+        return frozenset() if state is None else self.markings[state]
+
+    def get_marking_state(self, n_gram: List[str]) -> List[FrozenSet[str]]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the list of markings (set of
+        enabled flows) associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: a list with the marking(s) corresponding to the state of the process.
+        """
+        return [self.graph.frozen_markings[marking] for marking in self.get_marking_ids(n_gram)]
+
+    def get_best_marking_state_for(self, n_gram: List[str]) -> FrozenSet[str]:
+        """
+        Same as [NGramIndex.get_best_marking_state_for], but without limit in the size of the n-gram: walk the
+        automaton with the n-gram read backwards until the marking is deterministic, the suffix is not possible in the
+        reachability graph, or the n-gram is consumed. If more than one marking are associated to the last state
+        reached, return the one with the lowest ID.
+
+        If the n-gram contains activities that are not in the reachability graph (or marking n-grams), filter them out.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the marking corresponding to the state of the case given the last N activities.
+        """
+        return self.graph.frozen_markings[self.get_best_marking_id_for(n_gram)]
+
+    def get_best_marking_id_for(self, n_gram: List[str]) -> int:
+        """
+        Same as [get_best_marking_state_for], but returning the ID of the marking in the reachability graph.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the ID of the marking corresponding to the state of the case given the last N activities.
+        """
+        # Initialize estimated marking to initial marking (if no other marking found, that's default)
+        final_marking = self.graph.initial_marking_id
+        state = self.initial_state
+        # Walk the automaton with the n-gram read backwards
+        for label in reversed(n_gram):
+            if label in self.graph.activity_to_edges or label == NGramIndex.TRACE_START:
+                state = self.transitions[state].get(label)
+                if state is None or len(self.markings[state]) == 0:
+                    # Suffix not possible, stop search
+                    break
+                # Keep the marking with lowest ID, and stop if deterministic
+                final_marking = min(self.markings[state])
+                if len(self.markings[state]) == 1:
+                    break
+        # Return found marking
+        return final_marking
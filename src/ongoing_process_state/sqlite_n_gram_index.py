@@ -0,0 +1,234 @@
+import json
+import queue
+import sqlite3
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+from ongoing_process_state.reachability_graph import ReachabilityGraph
+
+
+class SQLiteNGramIndex:
+    """
+    Read-only n-gram index backed by an SQLite database (see NGramIndex.to_sqlite), for deployments where the index
+    does not fit (or should not be loaded) in memory. Only the activities and the markings are read when opening the
+    index; the n-grams stay in the database, keyed by their activity codes packed in a few bytes each (big-endian, so
+    the keys sort as the tuples of codes), with their marking IDs packed as 32-bit integers and their precomputed best
+    marking ID.
+
+    The lookups run on a pool of read-only connections, so the index can be queried from multiple threads. Each
+    connection keeps its statements prepared (the statement cache of sqlite3 reuses them while their SQL is the same).
+    """
+
+    def __init__(self, file_path: Path, graph: ReachabilityGraph, pool_size: int = 4):
+        self.file_path = Path(file_path)
+        self.graph = graph
+        self._pool = queue.Queue()  # Idle read-only connections (or None once the index is closed)
+        self._closed = False  # Whether the index has been closed (the connections in use are closed when returned)
+        self._lock = threading.Lock()  # Lock to return the connections to the pool and to close it
+        for _ in range(pool_size):
+            self._pool.put(
+                sqlite3.connect(f"{self.file_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+            )
+        with self._connection() as connection:
+            metadata = dict(connection.execute("SELECT name, value FROM metadata"))
+            self.n_gram_size_limit = int(metadata["n_gram_size_limit"])
+            self.max_n_gram_size = int(metadata["max_n_gram_size"])
+            self.code_width = int(metadata["code_width"])  # Number of bytes of each activity code in the keys
+            # Dict with activity label as key, and its (int) code as value
+            self.activity_codes = {
+                label: code for code, label in connection.execute("SELECT code, label FROM activities")
+            }
+            # Map the stored markings to the ones of the graph with the same places (the IDs may change when computing
+            # the reachability graph again)
+            self._marking_ids = {}  # Dict with the stored marking ID as key, and the ID in [self.graph] as value
+            for marking_id, places in connection.execute("SELECT id, places FROM markings"):
+                marking_key = tuple(json.loads(places))
+                if marking_key not in graph.marking_to_key:
+                    raise RuntimeError(f"Error, the index in {file_path} is not from this reachability graph.")
+                self._marking_ids[marking_id] = graph.marking_to_key[marking_key]
+
+    @staticmethod
+    def write(
+            file_path: Path,
+            graph: ReachabilityGraph,
+            n_gram_size_limit: int,
+            activity_codes: Dict[str, int],
+            n_grams: Iterable[Tuple[Tuple[int, ...], FrozenSet[int], int]],
+    ):
+        """
+        Store an index in an SQLite database (in WAL mode), replacing its previous content. The n-grams are inserted
+        sorted by key in one transaction.
+
+        :param file_path: path to the database file.
+        :param graph: reachability graph of the index.
+        :param n_gram_size_limit: maximum size of the n-grams in the index.
+        :param activity_codes: dict with the code of each activity label.
+        :param n_grams: encoded n-grams with their marking IDs and best marking ID.
+        """
+        file_path = Path(file_path)
+        for path in [file_path, Path(f"{file_path}-wal"), Path(f"{file_path}-shm")]:
+            path.unlink(missing_ok=True)
+        code_width = max(1, (max(activity_codes.values(), default=0).bit_length() + 7) // 8)
+        connection = sqlite3.connect(str(file_path))
+        try:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            rows = sorted(
+                (
+                    SQLiteNGramIndex._encode_key(n_gram, code_width),
+                    struct.pack(f">{len(markings)}i", *sorted(markings)),
+                    resolution,
+                )
+                for n_gram, markings, resolution in n_grams
+            )
+            with connection:
+                connection.execute("CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                connection.execute("CREATE TABLE activities (code INTEGER PRIMARY KEY, label TEXT NOT NULL)")
+                connection.execute("CREATE TABLE markings (id INTEGER PRIMARY KEY, places TEXT NOT NULL)")
+                connection.execute(
+                    "CREATE TABLE n_grams ("
+                    "key BLOB PRIMARY KEY, markings BLOB NOT NULL, best_marking INTEGER NOT NULL) WITHOUT ROWID"
+                )
+                connection.executemany(
+                    "INSERT INTO metadata VALUES (?, ?)",
+                    [
+                        ("n_gram_size_limit", str(n_gram_size_limit)),
+                        ("max_n_gram_size", str(max([len(key) // code_width for key, _, _ in rows], default=0))),
+                        ("code_width", str(code_width)),
+                    ],
+                )
+                connection.executemany("INSERT INTO activities VALUES (?, ?)", [
+                    (code, label) for label, code in activity_codes.items()
+                ])
+                connection.executemany("INSERT INTO markings VALUES (?, ?)", [
+                    (marking_id, json.dumps(sorted(marking))) for marking_id, marking in graph.markings.items()
+                ])
+                connection.executemany("INSERT INTO n_grams VALUES (?, ?, ?)", rows)
+            # Move the content of the write-ahead log to the database file
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _encode_key(n_gram_key: Tuple[int, ...], code_width: int) -> bytes:
+        return b"".join(code.to_bytes(code_width, "big") for code in n_gram_key)
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a connection from the pool (waiting until one is idle), returning it once used (or closing it, if the
+        index has been closed meanwhile).
+        """
+        connection = self._pool.get()
+        if connection is None:
+            # Closed index, wake up the next thread waiting for a connection
+            self._pool.put(None)
+            raise RuntimeError("Error, the index has been closed.")
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                if self._closed:
+                    connection.close()
+                else:
+                    self._pool.put(connection)
+
+    def __len__(self) -> int:
+        with self._connection() as connection:
+            return connection.execute("SELECT COUNT(*) FROM n_grams").fetchone()[0]
+
+    def _get_key(self, n_gram: List[str]) -> Optional[Tuple[int, ...]]:
+        key = tuple(self.activity_codes.get(label) for label in n_gram)
+        return None if None in key else key
+
+    def get_marking_ids(self, n_gram: List[str]) -> FrozenSet[int]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the IDs (in the reachability
+        graph) of the markings associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: an immutable set with the ID(s) of the marking(s) corresponding to the state of the process.
+        """
+        n_gram_key = self._get_key(n_gram)
+        if n_gram_key is None:
+            return frozenset()
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT markings FROM n_grams WHERE key = ?",
+                (SQLiteNGramIndex._encode_key(n_gram_key, self.code_width),),
+            ).fetchone()
+        if row is None:
+            return frozenset()
+        return frozenset(self._marking_ids[marking] for marking in struct.unpack(f">{len(row[0]) // 4}i", row[0]))
+
+    def get_marking_state(self, n_gram: List[str]) -> List[FrozenSet[str]]:
+        """
+        Retrieve, given an n-gram representing the last N activities executed in a trace, the list of markings (set of
+        enabled flows) associated to that state.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: a list with the marking(s) corresponding to the state of the process.
+        """
+        return [self.graph.frozen_markings[marking] for marking in self.get_marking_ids(n_gram)]
+
+    def get_best_marking_id_for(self, n_gram: List[str]) -> int:
+        """
+        Same as NGramIndex.get_best_marking_id_for: the best marking is the precomputed resolution of the longest
+        suffix of the (filtered) n-gram present in the index. All the suffixes are retrieved with one query, and the
+        longest one is searched among them as in the binary search of the other indexes.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the ID of the marking corresponding to the state of the case given the last N activities.
+        """
+        # Filter out nonexistent (in the reachability graph) activities, and encode the n-gram
+        n_gram_key = tuple(self.activity_codes[label] for label in n_gram if label in self.activity_codes)
+        upper = min(len(n_gram_key), self.max_n_gram_size)
+        if upper == 0:
+            return self.graph.initial_marking_id
+        # Retrieve the resolutions of the suffixes present in the index
+        encoded_key = SQLiteNGramIndex._encode_key(n_gram_key[-upper:], self.code_width)
+        with self._connection() as connection:
+            rows = connection.execute(
+                f"SELECT key, best_marking FROM n_grams WHERE key IN ({', '.join('?' * upper)})",
+                [encoded_key[-size * self.code_width:] for size in range(1, upper + 1)],
+            ).fetchall()
+        resolutions = {len(key) // self.code_width: self._marking_ids[best_marking] for key, best_marking in rows}
+        # Search for the longest suffix
+        if upper in resolutions:
+            return resolutions[upper]
+        # Binary search keeping [lower] as a suffix in the index (or 0) and [upper] as a suffix not in the index
+        lower, final_marking = 0, self.graph.initial_marking_id
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            if middle not in resolutions:
+                upper = middle
+            else:
+                lower, final_marking = middle, resolutions[middle]
+        # Return found marking
+        return final_marking
+
+    def get_best_marking_state_for(self, n_gram: List[str]) -> FrozenSet[str]:
+        """
+        Same as NGramIndex.get_best_marking_state_for.
+
+        :param n_gram: list of activity labels representing the last N activities recorded in the trace.
+        :return: the marking corresponding to the state of the case given the last N activities.
+        """
+        return self.graph.frozen_markings[self.get_best_marking_id_for(n_gram)]
+
+    def close(self):
+        """
+        Close all the connections of the pool (the index cannot be queried anymore). The connections in use by other
+        threads are closed once their query finishes.
+        """
+        with self._lock:
+            self._closed = True
+            while not self._pool.empty():
+                connection = self._pool.get()
+                if connection is not None:
+                    connection.close()
+            # Wake up the threads waiting for a connection
+            self._pool.put(None)
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import List
 
 from lxml import etree
 
@@ -128,3 +129,34 @@ def read_petri_net(model_path: Path) -> PetriNet:
         return petri_net
     except etree.XMLSyntaxError as e:
         print(f"XML Syntax Error: {e}")
+
+
+def read_n_grams_from_event_log(
+        log_path: Path,
+        n_gram_size: int,
+        case_column: str = "case_id",
+        activity_column: str = "Activity",
+) -> List[List[str]]:
+    """
+    Read an event log in CSV format (can be compressed) and compute the n-gram observed after each of its events,
+    i.e., the last [n_gram_size] activities executed in the case, preceded by [NGramIndex.TRACE_START] when the case
+    has less than [n_gram_size] recorded events. The events of each case are processed in the order they appear in
+    the log.
+
+    :param log_path: path to the CSV file with the event log.
+    :param n_gram_size: maximum size of the n-grams.
+    :param case_column: name of the column with the case ID.
+    :param activity_column: name of the column with the activity label.
+    :return: a list with the n-gram observed after each event of the event log.
+    """
+    # Imported here so reading process models does not need to load pandas nor the n-gram index
+    import pandas as pd
+    from ongoing_process_state.n_gram_index import NGramIndex
+
+    event_log = pd.read_csv(log_path, usecols=[case_column, activity_column])
+    n_grams = []
+    for _, events in event_log.groupby(case_column, sort=False):
+        trace = [NGramIndex.TRACE_START] + [str(activity) for activity in events[activity_column]]
+        for i in range(2, len(trace) + 1):
+            n_grams += [trace[max(0, i - n_gram_size):i]]
+    return n_grams
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+import pytest
+
+from ongoing_process_state.bloom_filter import BloomFilter
+
+
+@pytest.fixture
+def temp_file_path():
+    # Create a temporary file and get the path
+    tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)  # Set delete=False
+    path = tmp.name
+    try:
+        yield path
+    finally:
+        # Cleanup: close the file and remove it
+        tmp.close()
+        os.remove(path)
+
+
+def test_bloom_filter():
+    bloom_filter = BloomFilter(1000, false_positive_rate=0.01)
+    items = [hash(("item", i)) for i in range(1000)]
+    for item in items:
+        bloom_filter.add(item)
+    # Assert no false negatives
+    assert all(item in bloom_filter for item in items)
+    # Assert false positive rate close to the expected one
+    false_positives = sum(hash(("other", i)) in bloom_filter for i in range(10000))
+    assert false_positives < 10000 * 0.03
+
+
+def test_bloom_filter_wrong_rate():
+    with pytest.raises(RuntimeError):
+        BloomFilter(10, false_positive_rate=0.0)
+
+
+def test_bloom_filter_input_output(temp_file_path):
+    bloom_filter = BloomFilter(100, false_positive_rate=0.05)
+    for i in range(100):
+        bloom_filter.add(hash((1, i)))
+    # Export and import
+    bloom_filter.to_file(temp_file_path)
+    read_bloom_filter = BloomFilter.from_file(temp_file_path)
+    # Assert equality
+    assert read_bloom_filter.false_positive_rate == bloom_filter.false_positive_rate
+    assert read_bloom_filter.num_bits == bloom_filter.num_bits
+    assert read_bloom_filter.num_hashes == bloom_filter.num_hashes
+    assert read_bloom_filter.bits == bloom_filter.bits
+    assert all(hash((1, i)) in read_bloom_filter for i in range(100))
@@ -0,0 +1,82 @@
+import random
+from typing import List
+
+from ongoing_process_state.case_tracker import CaseTracker
+from ongoing_process_state.n_gram_index import NGramIndex
+from ongoing_process_state.reachability_graph import ReachabilityGraph
+from test_bpmn_model_fixtures import _bpmn_model_with_AND_and_XOR, \
+    _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND
+
+
+def _random_traces(graph: ReachabilityGraph, num_traces: int, max_length: int) -> List[List[str]]:
+    # Random walks over the reachability graph from the initial marking
+    rng = random.Random(42)
+    traces = []
+    for _ in range(num_traces):
+        (trace, marking_id) = ([], graph.initial_marking_id)
+        while len(trace) < max_length and len(graph.outgoing_edges[marking_id]) > 0:
+            edge_id = rng.choice(sorted(graph.outgoing_edges[marking_id]))
+            trace += [graph.edge_to_activity[edge_id]]
+            (_, marking_id) = graph.edges[edge_id]
+        traces += [trace]
+    return traces
+
+
+def _assert_same_states(n_gram_index: NGramIndex, traces: List[List[str]]):
+    case_tracker = CaseTracker(n_gram_index)
+    for case_id, trace in enumerate(traces):
+        case_tracker.start_case(case_id)
+        assert case_tracker.get_best_marking_id(case_id) == \
+               n_gram_index.get_best_marking_id_for([NGramIndex.TRACE_START])
+        for i in range(len(trace)):
+            n_gram = [NGramIndex.TRACE_START] + trace[:i + 1]
+            assert case_tracker.update(case_id, trace[i]) == n_gram_index.get_best_marking_id_for(n_gram)
+            assert case_tracker.get_best_marking_state(case_id) == n_gram_index.get_best_marking_state_for(n_gram)
+        case_tracker.end_case(case_id)
+    assert len(case_tracker) == 0
+
+
+def test_rolling_hash():
+    # The hash of an n-gram extended with a new activity is computed from the hash of the n-gram
+    assert NGramIndex.get_rolling_hash([]) == 0
+    assert NGramIndex.get_rolling_hash([3]) == 4
+    assert NGramIndex.get_rolling_hash([2, 3]) == NGramIndex.get_rolling_hash([2]) * NGramIndex.ROLLING_HASH_BASE + 4
+    assert NGramIndex.get_rolling_hash([2, 3]) != NGramIndex.get_rolling_hash([3, 2])
+
+
+def test_case_tracker_simple():
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    case_tracker = CaseTracker(n_gram_index)
+    # Track two interleaved cases
+    assert case_tracker.update("case-1", "A") == reachability_graph.marking_to_key[("5", "6")]
+    assert case_tracker.update("case-2", "A") == reachability_graph.marking_to_key[("5", "6")]
+    assert case_tracker.update("case-1", "C") == n_gram_index.get_best_marking_id_for(["A", "C"])
+    assert case_tracker.update("case-1", "B") == reachability_graph.marking_to_key[("12",)]
+    # Activities not in the graph are filtered out
+    assert case_tracker.update("case-1", "Z") == reachability_graph.marking_to_key[("12",)]
+    assert case_tracker.get_best_marking_state("case-1") == {"12"}
+    assert case_tracker.get_best_marking_state("case-2") == {"5", "6"}
+    assert len(case_tracker) == 2
+
+
+def test_case_tracker_same_states():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    traces = _random_traces(reachability_graph, num_traces=30, max_length=15)
+    for encode_activities in [False, True]:
+        n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities)
+        n_gram_index.build()
+        _assert_same_states(n_gram_index, traces)
+
+
+def test_case_tracker_hash_collisions(monkeypatch):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    # Force many collisions with a tiny modulus
+    monkeypatch.setattr(NGramIndex, "ROLLING_HASH_MODULUS", 7)
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4)
+    n_gram_index.build()
+    _assert_same_states(n_gram_index, _random_traces(reachability_graph, num_traces=30, max_length=15))
@@ -0,0 +1,116 @@
+import itertools
+import os
+import tempfile
+
+import pytest
+
+from ongoing_process_state.frozen_n_gram_index import FrozenNGramIndex
+from ongoing_process_state.n_gram_index import NGramIndex
+from test_bpmn_model_fixtures import _bpmn_model_with_AND_and_XOR, _bpmn_model_with_XOR_within_AND, \
+    _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND
+
+
+@pytest.fixture
+def temp_file_path():
+    # Create a temporary file and get the path
+    tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)  # Set delete=False
+    path = tmp.name
+    try:
+        yield path
+    finally:
+        # Cleanup: close the file and remove it
+        tmp.close()
+        os.remove(path)
+
+
+def test_freeze_simple():
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    frozen_n_gram_index = n_gram_index.freeze()
+    # Check size
+    assert len(frozen_n_gram_index) == len(n_gram_index.markings)
+    # Check specific markings
+    assert frozen_n_gram_index.get_marking_state([NGramIndex.TRACE_START]) == [{"1"}]
+    assert frozen_n_gram_index.get_marking_state(["A"]) == [{"5", "6"}]
+    assert frozen_n_gram_index.get_marking_state(["A", "B"]) == [{"9", "6"}]
+    assert frozen_n_gram_index.get_marking_state(["C", "B"]) == [{"12"}]
+    assert frozen_n_gram_index.get_marking_state(["F"]) == [{"23"}]
+    # Check missing n-grams
+    assert frozen_n_gram_index.get_marking_state(["F", "A"]) == []
+    assert frozen_n_gram_index.get_marking_state(["Z"]) == []
+    # Check best markings
+    assert frozen_n_gram_index.get_best_marking_state_for(["A", "C", "B"]) == {"12"}
+    assert frozen_n_gram_index.get_best_marking_state_for(["Z", "C", "Z", "B"]) == {"12"}
+    assert frozen_n_gram_index.get_best_marking_state_for([]) == {"1"}
+    # Freeze after modifying the index, without building its outdated lookup structures
+    n_gram_index.add_association(["F", "A"], 0)
+    assert n_gram_index.freeze().get_marking_ids(["F", "A"]) == {0}
+    assert n_gram_index.resolutions is None and n_gram_index.suffix_trie is None
+
+
+def test_freeze_same_lookups():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4)
+    n_gram_index.build()
+    frozen_n_gram_index = n_gram_index.freeze()
+    # Check the markings of each n-gram are the same
+    for n_gram, markings in n_gram_index.markings.items():
+        assert frozen_n_gram_index.get_marking_ids(list(n_gram)) == markings
+    # Check the best marking of all n-grams up to size 4 is the same
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    for size in range(1, 5):
+        for n_gram in itertools.product(labels, repeat=size):
+            assert frozen_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                   n_gram_index.get_best_marking_id_for(list(n_gram))
+
+
+def test_freeze_empty():
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    frozen_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3).freeze()
+    assert len(frozen_n_gram_index) == 0
+    assert frozen_n_gram_index.get_marking_ids(["A"]) == set()
+    assert frozen_n_gram_index.get_best_marking_state_for(["A"]) == {"1"}
+
+
+def test_frozen_input_output(temp_file_path):
+    bpmn_model = _bpmn_model_with_XOR_within_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, encode_activities=True)
+    n_gram_index.build()
+    frozen_n_gram_index = n_gram_index.freeze()
+    # Export to file
+    frozen_n_gram_index.to_file(temp_file_path)
+    # Import from file
+    read_frozen_n_gram_index = FrozenNGramIndex.from_file(temp_file_path, reachability_graph)
+    # Assert equality
+    assert read_frozen_n_gram_index.activity_codes == frozen_n_gram_index.activity_codes
+    assert read_frozen_n_gram_index.n_gram_size_limit == 3
+    assert read_frozen_n_gram_index.displacements == frozen_n_gram_index.displacements
+    assert read_frozen_n_gram_index.key_codes == frozen_n_gram_index.key_codes
+    assert read_frozen_n_gram_index.marking_ids == frozen_n_gram_index.marking_ids
+    for n_gram, markings in n_gram_index.markings.items():
+        labels = [n_gram_index.activity_labels[code] for code in n_gram]
+        assert read_frozen_n_gram_index.get_marking_ids(labels) == markings
+        assert read_frozen_n_gram_index.get_best_marking_id_for(labels) == n_gram_index.get_best_marking_id_for(labels)
+
+
+def test_freeze_few_n_grams():
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    # Build frozen indexes with only 2 and 3 n-grams, which easily fall in the same bucket
+    for n_grams in [
+        {(1,): (frozenset({1}), 1), (2,): (frozenset({2}), 2)},
+        {(1,): (frozenset({1}), 1), (2,): (frozenset({2, 3}), 2), (2, 1): (frozenset({3}), 3)},
+    ]:
+        frozen_n_gram_index = FrozenNGramIndex.build(reachability_graph, 5, {}, n_grams)
+        assert len(frozen_n_gram_index) == len(n_grams)
+        # Each n-gram is in a different slot, and retrieves its markings
+        assert {frozen_n_gram_index._get_slot(n_gram) for n_gram in n_grams} == set(range(len(n_grams)))
+        for n_gram, (markings, resolution) in n_grams.items():
+            slot = frozen_n_gram_index._get_slot(n_gram)
+            assert frozen_n_gram_index.resolutions[slot] == resolution
+        assert frozen_n_gram_index._get_slot((4,)) is None
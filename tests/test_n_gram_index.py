@@ -1,10 +1,15 @@
+import itertools
 import os
+import random
 import tempfile
+import threading
+from collections import Counter
 from typing import List, Set, Tuple
 
 import pytest
 
-from ongoing_process_state.n_gram_index import NGramIndex
+from ongoing_process_state.n_gram_index import NGramIndex, NGramIndexLayout
+from ongoing_process_state.reverse_suffix_automaton import ReverseSuffixAutomaton
 from test_bpmn_model_fixtures import _bpmn_model_with_loop_inside_AND, _bpmn_model_with_AND_and_nested_XOR, \
     _bpmn_model_with_XOR_within_AND, _bpmn_model_with_AND_and_XOR, \
     _bpmn_model_with_two_loops_inside_AND_followed_by_XOR_within_AND, \
@@ -28,6 +33,10 @@ def _prepare(markings: List[Set[str]]) -> Set[Tuple[str]]:
     return {tuple(sorted(marking)) for marking in markings}
 
 
+def _prepare_map(n_gram_index: NGramIndex) -> dict:
+    return {n_gram: _prepare(markings) for n_gram, markings in n_gram_index.get_self_contained_map().items()}
+
+
 def test_build_simple_size_limit():
     bpmn_model = _bpmn_model_with_AND_and_XOR()
     reachability_graph = bpmn_model.get_reachability_graph()
@@ -331,6 +340,245 @@ def test_get_best_marking_state_for():
                                                                              {"17", "18", "26"}, {"17", "18", "28"}]
 
 
+def test_get_best_marking_state_for_trie_layout():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, layout=NGramIndexLayout.TRIE)
+    n_gram_index.build()
+    # Assert the trie stores each n-gram backwards
+    assert set(n_gram_index.suffix_trie.children) == \
+           set(reachability_graph.activity_to_edges) | {NGramIndex.TRACE_START}
+    assert n_gram_index.suffix_trie.children["B"].children["A"].markings == n_gram_index.markings[("A", "B")]
+    # Assert n-grams that get one single state with the 1-gram
+    assert n_gram_index.get_best_marking_state_for(["F"]) == {"38"}
+    assert n_gram_index.get_best_marking_state_for(["E", "D", "F"]) == {"38"}
+    assert n_gram_index.get_best_marking_state_for([NGramIndex.TRACE_START]) == {"3", "26"}
+    # Assert n-grams that get one single state with the 2-gram
+    assert n_gram_index.get_best_marking_state_for(["E", "D", "A"]) == {"13", "14", "28"}
+    assert n_gram_index.get_best_marking_state_for(["A", "D", "E"]) == {"33", "28"}
+    assert n_gram_index.get_best_marking_state_for(["D", "A", "D"]) == {"13", "14", "28"}
+    # Assert unknown activities are filtered out
+    assert n_gram_index.get_best_marking_state_for(["D", "Z", "A"]) == {"13", "14", "28"}
+    # Assert n-grams that don't get deterministic even with the complete n-gram
+    assert n_gram_index.get_best_marking_state_for([NGramIndex.TRACE_START, "A", "C", "D"]) in [{"13", "18", "28"},
+                                                                                                {"17", "18", "28"}]
+    assert n_gram_index.get_best_marking_state_for(["C", "B", "B", "B"]) in [{"17", "14", "26"}, {"17", "14", "28"},
+                                                                             {"17", "18", "26"}, {"17", "18", "28"}]
+    # Assert the same results as the default layout for all deterministic n-grams
+    dict_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, encode_activities=True)
+    dict_n_gram_index.build()
+    for n_gram, markings in n_gram_index.markings.items():
+        if len(markings) == 1:
+            assert n_gram_index.get_best_marking_state_for(list(n_gram)) == \
+                   dict_n_gram_index.get_best_marking_state_for(list(n_gram))
+
+
+def test_get_best_marking_states_for_batch():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    n_grams = [
+        ["F"],  # Deterministic with the 1-gram
+        ["E", "D", "F"],
+        [NGramIndex.TRACE_START],
+        ["E", "D", "A"],  # Deterministic with the 2-gram
+        ["D", "Z", "A"],  # Unknown activity filtered out
+        ["A", "D", "E"],
+        [],  # Empty n-gram, initial marking
+        ["C", "B", "B", "B"],  # Non-deterministic
+    ]
+    batch = n_gram_index.encode_n_grams(n_grams)
+    # Check the encoding of the batch
+    assert batch.shape == (len(n_grams), 4)
+    assert list(batch[2]) == [NGramIndex.PAD_CODE, NGramIndex.PAD_CODE, NGramIndex.PAD_CODE, 0]
+    assert list(batch[4]) == [NGramIndex.PAD_CODE, NGramIndex.PAD_CODE] + [
+        n_gram_index.activity_codes["D"], n_gram_index.activity_codes["A"]
+    ]
+    # Check the markings found for the batch
+    marking_ids = n_gram_index.get_best_marking_states_for(batch)
+    markings = [reachability_graph.markings[marking_id] for marking_id in marking_ids]
+    assert markings[0] == {"38"}
+    assert markings[1] == {"38"}
+    assert markings[2] == {"3", "26"}
+    assert markings[3] == {"13", "14", "28"}
+    assert markings[4] == {"13", "14", "28"}
+    assert markings[5] == {"33", "28"}
+    assert markings[6] == {"3", "26"}
+    assert markings[7] in [{"17", "14", "26"}, {"17", "14", "28"}, {"17", "18", "26"}, {"17", "18", "28"}]
+    # Check same results as the single n-gram search for all the deterministic n-grams of the index
+    n_grams = [list(n_gram) for n_gram, markings in n_gram_index.markings.items() if len(markings) == 1]
+    marking_ids = n_gram_index.get_best_marking_states_for(n_gram_index.encode_n_grams(n_grams))
+    for n_gram, marking_id in zip(n_grams, marking_ids):
+        assert reachability_graph.markings[marking_id] == n_gram_index.get_best_marking_state_for(n_gram)
+
+
+def test_get_best_marking_states_for_large_alphabet():
+    bpmn_model = _bpmn_model_with_loop_inside_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    # Add many (deterministic) activities, so the longest n-grams of the index cannot be packed in 64 bits
+    for i in range(60):
+        reachability_graph.add_marking({f"x{i}"})
+        reachability_graph.add_edge(f"X{i}", {f"x{i}"}, {f"x{i}"})
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=14)
+    n_gram_index.build()
+    assert (len(n_gram_index.activity_codes) + 1) ** n_gram_index._max_n_gram_size >= 2 ** 63
+    # Check same results as the single n-gram search for all the n-grams of the index (and longer ones)
+    n_grams = [list(n_gram) for n_gram in n_gram_index.markings]
+    n_grams += [["X0"] + n_gram + ["A"] for n_gram in n_grams]
+    marking_ids = n_gram_index.get_best_marking_states_for(n_gram_index.encode_n_grams(n_grams))
+    assert list(marking_ids) == [n_gram_index.get_best_marking_id_for(n_gram) for n_gram in n_grams]
+
+
+def test_precomputed_resolutions():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    # Check the resolution of each n-gram of the index
+    assert n_gram_index.resolutions[("F",)] == (reachability_graph.marking_to_key[("38",)], 1)
+    assert n_gram_index.resolutions[("D", "A")] == (min(n_gram_index.markings[("D", "A")]), 2)
+    for n_gram, markings in n_gram_index.markings.items():
+        assert n_gram_index.resolutions[n_gram] == (min(markings), len(n_gram))
+    # Check the result is the same as the iterative search for all n-grams up to size 4
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    for size in range(1, 5):
+        for n_gram in itertools.product(labels, repeat=size):
+            assert n_gram_index._get_best_marking_id_in_resolutions(list(n_gram)) == \
+                   n_gram_index._get_best_marking_id_iteratively(list(n_gram))
+    # Check non-deterministic markings are always resolved to the same one
+    assert len({tuple(sorted(n_gram_index.get_best_marking_state_for(["B", "B", "B"]))) for _ in range(20)}) == 1
+
+
+def test_precomputed_resolutions_with_gaps():
+    reachability_graph = _bpmn_model_with_AND_and_XOR().get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    marking_b = reachability_graph.marking_to_key[("6", "9")]
+    marking_c = reachability_graph.marking_to_key[("12",)]
+    # Add n-grams manually, with ("A", "C", "B") but without its suffix ("C", "B")
+    n_gram_index.add_associations(["B"], {marking_b, marking_c})
+    n_gram_index.add_associations(["A", "C", "B"], {marking_c})
+    n_gram_index.add_associations(["C", "A", "C", "B"], {marking_b})
+    # Check the lookups fall back to the iterative search until building the resolutions
+    assert n_gram_index.resolutions is None
+    assert n_gram_index.get_best_marking_state_for(["A", "C", "B"]) == reachability_graph.markings[min(marking_b,
+                                                                                                     marking_c)]
+    n_gram_index._build_lookup_structures()
+    # The search stops at ("C", "B") as it is not in the index
+    assert n_gram_index.resolutions[("A", "C", "B")] == (min(marking_b, marking_c), 1)
+    assert n_gram_index.resolutions[("C", "A", "C", "B")] == (min(marking_b, marking_c), 1)
+    assert n_gram_index.get_best_marking_state_for(["A", "C", "B"]) == reachability_graph.markings[min(marking_b,
+                                                                                                     marking_c)]
+    assert n_gram_index.get_best_marking_state_for(["C", "A", "C", "B"]) == reachability_graph.markings[min(marking_b,
+                                                                                                          marking_c)]
+
+
+def test_get_marking_ids():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    marking_id = reachability_graph.marking_to_key[("13", "14", "28")]
+    # Check the IDs of the markings
+    assert n_gram_index.get_marking_ids(["D", "A"]) == {marking_id}
+    assert n_gram_index.get_marking_ids(["Z", "A"]) == set()
+    assert n_gram_index.get_best_marking_id_for(["E", "D", "A"]) == marking_id
+    assert n_gram_index.get_best_marking_id_for([]) == reachability_graph.initial_marking_id
+    # Check the sets of marking IDs are immutable and shared among n-grams with the same markings
+    assert isinstance(n_gram_index.get_marking_ids(["D", "A"]), frozenset)
+    assert n_gram_index.get_marking_ids(["D", "A"]) is n_gram_index.get_marking_ids(["A", "D"])
+    # Check the returned markings are immutable and the same instance for each call
+    marking = n_gram_index.get_best_marking_state_for(["E", "D", "A"])
+    assert isinstance(marking, frozenset)
+    assert marking is n_gram_index.get_best_marking_state_for(["D", "A"])
+    assert marking is reachability_graph.get_frozen_marking(marking_id)
+    assert n_gram_index.get_marking_state(["D", "A"])[0] is marking
+    assert marking == reachability_graph.markings[marking_id]
+
+
+def test_get_best_marking_state_for_with_cache():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, cache_size=2)
+    n_gram_index.build()
+    # First search of each n-gram is a miss, second one a hit
+    assert n_gram_index.get_best_marking_state_for(["E", "D", "A"]) == {"13", "14", "28"}
+    assert n_gram_index.get_best_marking_state_for(["A", "D", "E"]) == {"33", "28"}
+    assert (n_gram_index.cache_hits, n_gram_index.cache_misses) == (0, 2)
+    assert n_gram_index.get_best_marking_state_for(["E", "D", "A"]) == {"13", "14", "28"}
+    assert (n_gram_index.cache_hits, n_gram_index.cache_misses) == (1, 2)
+    # Least recently used n-gram is evicted when the cache is full
+    assert n_gram_index.get_best_marking_state_for(["E", "D", "F"]) == {"38"}
+    assert list(n_gram_index._cache) == [("E", "D", "A"), ("E", "D", "F")]
+    assert n_gram_index.get_best_marking_state_for(["A", "D", "E"]) == {"33", "28"}
+    assert (n_gram_index.cache_hits, n_gram_index.cache_misses) == (1, 4)
+    # Warm-up loads the most frequent n-grams
+    n_gram_index.warm_up([["F"], ["D", "A"], ["D", "A"], ["E", "F"], ["E", "F"], ["E", "F"]])
+    assert list(n_gram_index._cache) == [("D", "A"), ("E", "F")]
+    assert n_gram_index.get_best_marking_state_for(["D", "A"]) == {"13", "14", "28"}
+    assert n_gram_index.get_best_marking_state_for(["E", "F"]) == {"38"}
+    assert (n_gram_index.cache_hits, n_gram_index.cache_misses) == (3, 4)
+    # Cache is discarded when the index changes
+    n_gram_index.build()
+    assert len(n_gram_index._cache) == 0
+
+
+def test_bloom_filter():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, bloom_false_positive_rate=0.01)
+    n_gram_index.build()
+    # Check all the n-grams of the index pass the filter
+    assert n_gram_index.bloom_filter is not None
+    for n_gram in n_gram_index.markings:
+        assert n_gram_index._may_contain(n_gram)
+    misses = [n_gram for n_gram in itertools.product("ABCDEF", repeat=3) if n_gram not in n_gram_index.markings]
+    assert sum(n_gram_index._may_contain(n_gram) for n_gram in misses) < len(misses) * 0.05
+    # Check lookups are not altered
+    assert n_gram_index.get_marking_state(["D", "A"]) == [{"13", "14", "28"}]
+    assert n_gram_index.get_marking_state(["F", "F"]) == []
+    assert n_gram_index.get_best_marking_state_for(["E", "D", "A"]) == {"13", "14", "28"}
+    # Check the filter is discarded when modifying the index, and rebuilt with the lookup structures
+    n_gram_index.add_association(["F", "F"], reachability_graph.marking_to_key[("38",)])
+    assert n_gram_index.bloom_filter is None
+    assert n_gram_index.get_marking_state(["F", "F"]) == [{"38"}]
+    n_gram_index._build_lookup_structures()
+    assert n_gram_index.get_marking_state(["F", "F"]) == [{"38"}]
+    assert n_gram_index._may_contain(("F", "F"))
+    # Check rebuilding after modifying the graph is not affected by the previous filter
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, bloom_false_positive_rate=0.0001)
+    n_gram_index.build()
+    reachability_graph.add_edge("X", {"38"}, reachability_graph.markings[reachability_graph.initial_marking_id])
+    n_gram_index.build()
+    fresh_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    fresh_n_gram_index.build()
+    assert n_gram_index.markings == fresh_n_gram_index.markings
+
+
+def test_input_output_bloom_filter(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, bloom_false_positive_rate=0.01)
+    n_gram_index.build()
+    bloom_filter_path = f"{temp_file_path}.bloom"
+    try:
+        # Export to file, storing the Bloom filter alongside
+        n_gram_index.to_self_contained_map_file(temp_file_path)
+        assert os.path.exists(bloom_filter_path)
+        # Import from file, encoding the activities
+        read_n_gram_index = NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph, True)
+        assert read_n_gram_index.bloom_filter.bits == n_gram_index.bloom_filter.bits
+        assert read_n_gram_index.bloom_false_positive_rate == 0.01
+        assert read_n_gram_index.get_marking_state(["D", "A"]) == [{"13", "14", "28"}]
+        # Export without Bloom filter removes the outdated one
+        n_gram_index.bloom_filter = None
+        n_gram_index.to_self_contained_map_file(temp_file_path)
+        assert not os.path.exists(bloom_filter_path)
+    finally:
+        if os.path.exists(bloom_filter_path):
+            os.remove(bloom_filter_path)
+
+
 def test_input_output_simple(temp_file_path):
     # Compute simple n-gram index
     bpmn_model = _bpmn_model_with_AND_and_nested_XOR()
@@ -357,3 +605,676 @@ def test_input_output_complex(temp_file_path):
     read_n_gram_index = NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph)
     # Assert equality
     assert n_gram_index.markings == read_n_gram_index.markings
+
+
+def test_build_encoded_activities():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    encoded_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, encode_activities=True)
+    encoded_n_gram_index.build()
+    # Check the keys are tuples of integer codes, with the trace start encoded as 0
+    assert all(isinstance(code, int) for n_gram in encoded_n_gram_index.markings for code in n_gram)
+    assert encoded_n_gram_index.activity_codes[NGramIndex.TRACE_START] == 0
+    assert (0,) in encoded_n_gram_index.markings
+    # Check both indexes store the same associations
+    assert {
+               n_gram: _prepare(markings) for n_gram, markings in encoded_n_gram_index.get_self_contained_map().items()
+           } == {
+               n_gram: _prepare(markings) for n_gram, markings in n_gram_index.get_self_contained_map().items()
+           }
+    assert _prepare(encoded_n_gram_index.get_marking_state(["C", "D"])) == _prepare([{"13", "18", "28"},
+                                                                                     {"17", "18", "28"}])
+    assert encoded_n_gram_index.get_marking_state(["D", "A"]) == [{"13", "14", "28"}]
+    assert encoded_n_gram_index.get_marking_state(["Z", "A"]) == []
+    # Check the search of the best marking filters out unknown labels
+    assert encoded_n_gram_index.get_best_marking_state_for(["E", "Z", "D", "A"]) == {"13", "14", "28"}
+    assert encoded_n_gram_index.get_best_marking_state_for(["A", "D", "E"]) == {"33", "28"}
+
+
+def test_input_output_encoded_activities(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5, encode_activities=True)
+    n_gram_index.build()
+    # Export to file and import as a non-encoded index
+    n_gram_index.to_self_contained_map_file(temp_file_path)
+    read_n_gram_index = NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph)
+    assert {
+               n_gram: _prepare(markings) for n_gram, markings in read_n_gram_index.get_self_contained_map().items()
+           } == {
+               n_gram: _prepare(markings) for n_gram, markings in n_gram_index.get_self_contained_map().items()
+           }
+    # Import as an encoded index
+    read_n_gram_index = NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph, True)
+    assert n_gram_index.markings == read_n_gram_index.markings
+    # Import a file with an activity that is not in the graph as an encoded index
+    with open(temp_file_path, "a") as output_file:
+        output_file.write(f"{str(('A', 'Z'))} : {str([reachability_graph.markings[0]])}\n")
+    with pytest.raises(RuntimeError):
+        NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph, True)
+    # Add associations by hand to an encoded index
+    n_gram_index.add_association(["A", "D"], 0)
+    assert 0 in n_gram_index.get_marking_ids(["A", "D"])
+    with pytest.raises(RuntimeError):
+        n_gram_index.add_association(["A", "Z"], 0)
+
+
+def _suffix_edit_distance(n_gram_key: Tuple[str], query: List[str]) -> int:
+    # Minimum edit distance between the n-gram and any suffix of the query
+    row = list(range(len(query) + 1))
+    for element in reversed(n_gram_key):
+        previous_row, row = row, [row[0] + 1]
+        for j, query_element in enumerate(reversed(query), start=1):
+            row += [min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + (query_element != element))]
+    return min(row)
+
+
+def test_get_approximate_marking_ids():
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    # Exact matches are the suffixes of the n-gram in the index
+    results = n_gram_index.get_approximate_marking_ids(["A", "C", "B"], max_distance=0)
+    assert [(n_gram, distance) for n_gram, distance, _ in results] == [(("C", "B"), 0), (("B",), 0)]
+    # A spurious event is tolerated
+    results = n_gram_index.get_approximate_marking_ids(["A", "C", "D", "B"], max_distance=1)
+    assert (("C", "B"), 1, n_gram_index.markings[("C", "B")]) in results
+    # Results are ranked by distance and then by size
+    assert results[0][:2] == (("B",), 0)
+    ranks = [(distance, -len(n_gram)) for n_gram, distance, _ in results]
+    assert ranks == sorted(ranks)
+
+
+def test_get_approximate_marking_ids_same_as_scan():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    for encode_activities in [False, True]:
+        n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities)
+        n_gram_index.build()
+        n_grams = {n_gram_index._get_labels(n_gram_key): n_gram_key for n_gram_key in n_gram_index.markings}
+        for query in [["A", "B", "C", "D"], ["A", "D", "F", "E", "C"], [NGramIndex.TRACE_START, "B", "D"]]:
+            for max_distance in range(3):
+                # Check the results are the n-grams within the distance found by a linear scan of the index
+                results = n_gram_index.get_approximate_marking_ids(query, max_distance)
+                assert {(n_gram, distance) for n_gram, distance, _ in results} == {
+                    (n_gram, _suffix_edit_distance(n_gram, query))
+                    for n_gram in n_grams
+                    if _suffix_edit_distance(n_gram, query) <= max_distance
+                }
+                assert all(markings == n_gram_index.markings[n_grams[n_gram]] for n_gram, _, markings in results)
+
+
+def test_tiered_index(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5)
+    n_gram_index.build()
+    tier_path = f"{temp_file_path}.db"
+    try:
+        tiered_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5, bloom_false_positive_rate=0.01)
+        tiered_n_gram_index.build(tier_split=2, tier_path=tier_path)
+        # Check only the short n-grams are kept in memory
+        assert max(len(n_gram) for n_gram in tiered_n_gram_index.markings) == 2
+        assert len(tiered_n_gram_index.markings) + len(tiered_n_gram_index.disk_tier) == len(n_gram_index.markings)
+        assert _prepare_map(tiered_n_gram_index) == _prepare_map(n_gram_index)
+        # Check the lookups are the same, consulting the disk tier only when needed
+        disk_probes = []
+        get_from_disk = tiered_n_gram_index.disk_tier.get
+        tiered_n_gram_index.disk_tier.get = lambda n_gram: disk_probes.append(n_gram) or get_from_disk(n_gram)
+        labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+        for size in range(1, 6):
+            for n_gram in itertools.product(labels, repeat=size):
+                assert tiered_n_gram_index.get_marking_ids(list(n_gram)) == n_gram_index.get_marking_ids(list(n_gram))
+                disk_probes.clear()
+                assert tiered_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                       n_gram_index.get_best_marking_id_for(list(n_gram))
+                suffix = n_gram[-2:]
+                if n_gram_index._get_best_marking_id_in_resolutions(list(suffix)) != \
+                        n_gram_index.get_best_marking_id_for(list(n_gram)):
+                    # The search goes beyond the n-grams in memory
+                    assert len(disk_probes) > 0
+                elif len(n_gram) <= 2 or len(n_gram_index.markings.get(suffix, [])) <= 1 or \
+                        n_gram_index.resolutions[suffix][1] < 2:
+                    # The search ends within the n-grams in memory
+                    assert len(disk_probes) == 0
+        tiered_n_gram_index.disk_tier.get = get_from_disk
+        # Check the tiered index cannot be modified
+        with pytest.raises(RuntimeError):
+            tiered_n_gram_index.add_association(["A", "B", "C"], 0)
+        # Store and read the tiered index
+        tiered_n_gram_index.to_self_contained_map_file(temp_file_path)
+        read_n_gram_index = NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph, True)
+        assert read_n_gram_index.tier_split == 2
+        assert _prepare_map(read_n_gram_index) == _prepare_map(n_gram_index)
+        for n_gram in n_gram_index.markings:
+            assert read_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                   n_gram_index.get_best_marking_id_for(list(n_gram))
+        read_n_gram_index.disk_tier.close()
+        # Build again without tiers
+        tiered_n_gram_index.build()
+        assert tiered_n_gram_index.disk_tier is None
+        assert tiered_n_gram_index.markings == n_gram_index.markings
+        # Tiered index without path
+        with pytest.raises(RuntimeError):
+            NGramIndex(reachability_graph, n_gram_size_limit=5).build(tier_split=2)
+    finally:
+        for path in [tier_path, f"{temp_file_path}.tier", f"{temp_file_path}.bloom"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_tiered_trie_index_input_output(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    tier_path = f"{temp_file_path}.db"
+    try:
+        tiered_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5, layout=NGramIndexLayout.TRIE)
+        tiered_n_gram_index.build(tier_split=2, tier_path=tier_path)
+        # Store and read the tiered index, building the trie with the n-grams of the disk tier too
+        tiered_n_gram_index.to_self_contained_map_file(temp_file_path)
+        read_n_gram_index = NGramIndex.from_self_contained_map_file(
+            temp_file_path, reachability_graph, layout=NGramIndexLayout.TRIE
+        )
+        assert read_n_gram_index.tier_split == 2
+        labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+        for size in range(1, 7):
+            for n_gram in itertools.product(labels, repeat=size):
+                assert read_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                       tiered_n_gram_index.get_best_marking_id_for(list(n_gram))
+        read_n_gram_index.disk_tier.close()
+        tiered_n_gram_index.disk_tier.close()
+    finally:
+        for path in [tier_path, f"{temp_file_path}.tier"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_out_of_core_build(monkeypatch, temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    n_gram_index.build()
+    # Report the n-grams in memory every few paths
+    monkeypatch.setattr(NGramIndex, "BUILD_CHECKPOINT_INTERVAL", 5)
+    tier_path = f"{temp_file_path}.db"
+    try:
+        tiered_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+        in_memory = []
+        tiered_n_gram_index.build(
+            tier_split=2,
+            tier_path=tier_path,
+            progress=lambda *_: in_memory.append(len(tiered_n_gram_index.markings)),
+        )
+        # Check each level was written to the tier during the expansion (keeping up to two levels in memory, besides
+        # the short n-grams), with the same index as a complete build
+        sizes = Counter(len(n_gram) for n_gram in n_gram_index.markings)
+        assert max(in_memory) <= sizes[1] + sizes[2] + max(sizes[size] + sizes[size + 1] for size in range(3, 6))
+        assert max(in_memory) < len(n_gram_index.markings)
+        assert max(len(n_gram) for n_gram in tiered_n_gram_index.markings) == 2
+        assert _prepare_map(tiered_n_gram_index) == _prepare_map(n_gram_index)
+        for n_gram, markings, resolution in tiered_n_gram_index.disk_tier.items():
+            assert resolution == n_gram_index.resolutions[n_gram]
+        for n_gram in n_gram_index.markings:
+            assert tiered_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                   n_gram_index.get_best_marking_id_for(list(n_gram))
+        # Store and read the tiered index
+        tiered_n_gram_index.to_self_contained_map_file(temp_file_path)
+        read_n_gram_index = NGramIndex.from_self_contained_map_file(temp_file_path, reachability_graph)
+        assert read_n_gram_index.tier_split == 2
+        assert _prepare_map(read_n_gram_index) == _prepare_map(n_gram_index)
+        read_n_gram_index.disk_tier.close()
+        # Stop at a budget, counting the n-grams in the tier too
+        max_entries = len(n_gram_index.markings) // 2
+        tiered_n_gram_index.disk_tier.close()
+        tiered_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+        tiered_n_gram_index.build(tier_split=2, tier_path=tier_path, max_entries=max_entries)
+        assert tiered_n_gram_index.truncated
+        assert len(tiered_n_gram_index.markings) + len(tiered_n_gram_index.disk_tier) <= max_entries
+        truncated_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+        truncated_n_gram_index.build(max_entries=max_entries)
+        assert _prepare_map(tiered_n_gram_index) == _prepare_map(truncated_n_gram_index)
+        tiered_n_gram_index.disk_tier.close()
+    finally:
+        for path in [tier_path, f"{temp_file_path}.tier"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_lazy_index(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4)
+    n_gram_index.build()
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    for encode_activities in [False, True]:
+        os.remove(temp_file_path)
+        lazy_n_gram_index = NGramIndex(
+            reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities,
+            lazy=True, lazy_file_path=temp_file_path,
+        )
+        # The lazy index starts empty
+        assert len(lazy_n_gram_index.markings) == 0
+        # Queries give the same markings as a complete build
+        for size in range(1, 6):
+            for n_gram in itertools.product(labels, repeat=size):
+                assert lazy_n_gram_index.get_marking_ids(list(n_gram)) == n_gram_index.get_marking_ids(list(n_gram))
+                assert lazy_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                       n_gram_index.get_best_marking_id_for(list(n_gram))
+        assert _prepare_map(lazy_n_gram_index) == _prepare_map(n_gram_index)
+        # The computed n-grams are preloaded by a new lazy index
+        preloaded_n_gram_index = NGramIndex(
+            reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities,
+            lazy=True, lazy_file_path=temp_file_path,
+        )
+        assert preloaded_n_gram_index.markings == lazy_n_gram_index.markings
+        # Lookups needing the complete index are not available until it is built
+        with pytest.raises(RuntimeError):
+            lazy_n_gram_index.get_best_marking_states_for(lazy_n_gram_index.encode_n_grams([["A", "B"]]))
+        lazy_n_gram_index.build()
+        assert not lazy_n_gram_index.lazy
+        assert lazy_n_gram_index.get_best_marking_states_for(lazy_n_gram_index.encode_n_grams([["A", "B"]])) == \
+               n_gram_index.get_best_marking_states_for(n_gram_index.encode_n_grams([["A", "B"]]))
+
+
+def test_build_pruned_with_observed_n_grams():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5)
+    n_gram_index.build()
+    observed_n_grams = [
+        [NGramIndex.TRACE_START, "A"],
+        [NGramIndex.TRACE_START, "A", "B"],
+        ["A", "B", "C", "B", "B"],
+        ["B", "C", "B", "B", "Z"],  # Activities not in the graph are filtered out
+    ]
+    for encode_activities in [False, True]:
+        # Pruned index: same state for the observed n-grams, with fewer n-grams
+        pruned_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5, encode_activities=encode_activities)
+        pruned_n_gram_index.build(observed_n_grams=observed_n_grams)
+        assert 0 < len(pruned_n_gram_index.markings) < len(n_gram_index.markings)
+        assert not pruned_n_gram_index.lazy
+        for n_gram in observed_n_grams:
+            assert pruned_n_gram_index.get_best_marking_id_for(n_gram) == n_gram_index.get_best_marking_id_for(n_gram)
+        for n_gram, markings in _prepare_map(pruned_n_gram_index).items():
+            assert _prepare(n_gram_index.get_marking_state(list(n_gram))) == markings
+        # Lazy pruned index: same state for any n-gram, computing the not observed ones on demand
+        lazy_n_gram_index = NGramIndex(
+            reachability_graph, n_gram_size_limit=5, encode_activities=encode_activities, lazy=True
+        )
+        lazy_n_gram_index.build(observed_n_grams=observed_n_grams)
+        assert lazy_n_gram_index.lazy
+        assert len(lazy_n_gram_index.markings) == len(pruned_n_gram_index.markings)
+        labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+        for n_gram in itertools.product(labels, repeat=4):
+            assert lazy_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                   n_gram_index.get_best_marking_id_for(list(n_gram))
+        # A lazy index cannot be tiered
+        with pytest.raises(RuntimeError):
+            NGramIndex(reachability_graph, lazy=True).build(tier_split=2, tier_path="index.db", observed_n_grams=[])
+
+
+def test_partial_order_keys():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4)
+    n_gram_index.build()
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    for encode_activities in [False, True]:
+        partial_order_n_gram_index = NGramIndex(
+            reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities, partial_order=True
+        )
+        partial_order_n_gram_index.build()
+        # The interleavings of concurrent activities are collapsed
+        assert len(partial_order_n_gram_index.markings) < len(n_gram_index.markings)
+        assert any(
+            isinstance(element, tuple)
+            for n_gram_key in partial_order_n_gram_index.markings
+            for element in n_gram_key
+        )
+        # Same markings as with sequence keys
+        for size in range(1, 6):
+            for n_gram in itertools.product(labels, repeat=size):
+                assert partial_order_n_gram_index.get_marking_ids(list(n_gram)) == \
+                       n_gram_index.get_marking_ids(list(n_gram))
+                assert partial_order_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                       n_gram_index.get_best_marking_id_for(list(n_gram))
+        # The associations cannot be modified
+        with pytest.raises(RuntimeError):
+            partial_order_n_gram_index.add_association(["A", "B"], 0)
+
+
+def test_build_in_parallel():
+    for bpmn_model in [
+        _bpmn_model_with_AND_and_nested_XOR(),
+        _bpmn_model_with_two_loops_inside_AND_followed_by_XOR_within_AND(),
+        _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND(),
+    ]:
+        reachability_graph = bpmn_model.get_reachability_graph()
+        for encode_activities in [False, True]:
+            n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5, encode_activities=encode_activities)
+            n_gram_index.build()
+            # Shards expanded in parallel, with the same associations as the sequential build
+            parallel_n_gram_index = NGramIndex(
+                reachability_graph, n_gram_size_limit=5, encode_activities=encode_activities
+            )
+            parallel_n_gram_index.build(workers=3)
+            assert parallel_n_gram_index.markings == n_gram_index.markings
+            assert parallel_n_gram_index.resolutions == n_gram_index.resolutions
+            # Associations added by hand before the build are taken into account
+            for index in [n_gram_index, parallel_n_gram_index]:
+                index.add_association(["A"], reachability_graph.initial_marking_id)
+            n_gram_index.build()
+            parallel_n_gram_index.build(workers=3)
+            assert parallel_n_gram_index.markings == n_gram_index.markings
+
+
+def test_build_vectorized():
+    for bpmn_model in [
+        _bpmn_model_with_AND_and_nested_XOR(),
+        _bpmn_model_with_loop_inside_AND(),
+        _bpmn_model_with_two_loops_inside_AND_followed_by_XOR_within_AND(),
+        _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND(),
+    ]:
+        reachability_graph = bpmn_model.get_reachability_graph()
+        for n_gram_size_limit in [1, 3, 6]:
+            for encode_activities in [False, True]:
+                n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit, encode_activities=encode_activities)
+                n_gram_index.build()
+                # Expansion with array operations, with the same associations as the default build
+                vectorized_n_gram_index = NGramIndex(
+                    reachability_graph, n_gram_size_limit, encode_activities=encode_activities
+                )
+                vectorized_n_gram_index.build(vectorized=True)
+                assert vectorized_n_gram_index.markings == n_gram_index.markings
+                # Associations added by hand before the build are taken into account
+                for index in [n_gram_index, vectorized_n_gram_index]:
+                    index.add_association(["A"], reachability_graph.initial_marking_id)
+                    index.build(vectorized=index is vectorized_n_gram_index)
+                assert vectorized_n_gram_index.markings == n_gram_index.markings
+
+
+def test_build_vectorized_large_alphabet():
+    bpmn_model = _bpmn_model_with_loop_inside_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    # Add many (deterministic) activities, so the n-grams up to the size limit cannot be packed in 64 bits
+    for i in range(60):
+        reachability_graph.add_marking({f"x{i}"})
+        reachability_graph.add_edge(f"X{i}", {f"x{i}"}, {f"x{i}"})
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=14)
+    n_gram_index.build()
+    # The vectorized build falls back to the default expansion, with the same associations
+    vectorized_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=14)
+    vectorized_n_gram_index.build(vectorized=True)
+    assert vectorized_n_gram_index.markings == n_gram_index.markings
+
+
+def test_apply_graph_delta():
+    rng = random.Random(7)
+    for bpmn_model in [
+        _bpmn_model_with_AND_and_nested_XOR(),
+        _bpmn_model_with_two_loops_inside_AND_followed_by_XOR_within_AND(),
+        _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND(),
+    ]:
+        reachability_graph = bpmn_model.get_reachability_graph()
+        for encode_activities in [False, True]:
+            n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities)
+            n_gram_index.build()
+            for _ in range(3):
+                # Remove some edges
+                removed_edges = [
+                    (
+                        reachability_graph.edge_to_activity[edge_id],
+                        reachability_graph.markings[reachability_graph.edges[edge_id][0]],
+                        reachability_graph.markings[reachability_graph.edges[edge_id][1]],
+                    )
+                    for edge_id in rng.sample(sorted(reachability_graph.edges), 2)
+                ]
+                n_gram_index.apply_graph_delta(removed_edges=removed_edges)
+                _assert_same_as_new_build(n_gram_index)
+                # Add them again, with a new marking and activities
+                markings = sorted(reachability_graph.markings)
+                new_marking = {f"new-{len(markings)}"}
+                added_edges = removed_edges + [
+                    ("X", reachability_graph.markings[rng.choice(markings)], new_marking),
+                    ("Y", new_marking, reachability_graph.markings[rng.choice(markings)]),
+                    ("A", reachability_graph.markings[rng.choice(markings)], reachability_graph.markings[markings[0]]),
+                ]
+                n_gram_index.apply_graph_delta(added_markings=[new_marking], added_edges=added_edges)
+                _assert_same_as_new_build(n_gram_index)
+
+
+def _assert_same_as_new_build(n_gram_index: NGramIndex):
+    new_n_gram_index = NGramIndex(
+        n_gram_index.graph, n_gram_index.n_gram_size_limit, encode_activities=n_gram_index.encode_activities
+    )
+    new_n_gram_index.activity_codes = dict(n_gram_index.activity_codes)
+    new_n_gram_index.activity_labels = list(n_gram_index.activity_labels)
+    new_n_gram_index.build()
+    assert n_gram_index.markings == new_n_gram_index.markings
+    assert n_gram_index.resolutions == new_n_gram_index.resolutions
+
+
+def test_apply_graph_delta_lazy_index(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    n_grams = [list(n_gram) for size in range(1, 5) for n_gram in itertools.product(labels, repeat=size)]
+    # Compute all the n-grams of a lazy index (persisting them in the file)
+    os.remove(temp_file_path)
+    lazy_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4, lazy=True, lazy_file_path=temp_file_path)
+    for n_gram in n_grams:
+        lazy_n_gram_index.get_marking_ids(n_gram)
+    # Remove some edges, the persisted n-grams are discarded too
+    removed_edges = [
+        (
+            reachability_graph.edge_to_activity[edge_id],
+            reachability_graph.markings[reachability_graph.edges[edge_id][0]],
+            reachability_graph.markings[reachability_graph.edges[edge_id][1]],
+        )
+        for edge_id in sorted(reachability_graph.edges)[:3]
+    ]
+    lazy_n_gram_index.apply_graph_delta(removed_edges=removed_edges)
+    assert os.path.getsize(temp_file_path) == 0
+    # A lazy index restarted from the file gives the same markings as a new build over the modified graph
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4)
+    n_gram_index.build()
+    for n_gram in n_grams:
+        lazy_n_gram_index.get_marking_ids(n_gram)
+    restarted_n_gram_index = NGramIndex(
+        reachability_graph, n_gram_size_limit=4, lazy=True, lazy_file_path=temp_file_path
+    )
+    assert restarted_n_gram_index.markings == n_gram_index.markings
+    for n_gram in n_grams:
+        assert restarted_n_gram_index.get_marking_ids(n_gram) == n_gram_index.get_marking_ids(n_gram)
+
+
+def test_deepen(temp_file_path):
+    for bpmn_model in [
+        _bpmn_model_with_AND_and_nested_XOR(),
+        _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND(),
+    ]:
+        reachability_graph = bpmn_model.get_reachability_graph()
+        for encode_activities in [False, True]:
+            # Deepen an index in memory
+            n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=2, encode_activities=encode_activities)
+            n_gram_index.build()
+            n_gram_index.deepen(3)
+            _assert_same_as_new_build(n_gram_index)
+            n_gram_index.to_self_contained_map_file(temp_file_path)
+            n_gram_index.deepen(5)
+            _assert_same_as_new_build(n_gram_index)
+            # Deepen an index read from a file (without size limit)
+            read_n_gram_index = NGramIndex.from_self_contained_map_file(
+                temp_file_path, reachability_graph, encode_activities
+            )
+            read_n_gram_index.deepen(5)
+            assert read_n_gram_index.n_gram_size_limit == 5
+            _assert_same_as_new_build(read_n_gram_index)
+            # The size limit can only increase
+            with pytest.raises(RuntimeError):
+                read_n_gram_index.deepen(5)
+            # Deepen a lazy index (the longer n-grams are computed on demand)
+            lazy_n_gram_index = NGramIndex(reachability_graph, 2, encode_activities, lazy=True)
+            labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+            for n_gram in itertools.product(labels, repeat=3):
+                assert len(lazy_n_gram_index.get_marking_ids(list(n_gram))) == 0
+            lazy_n_gram_index.deepen(4)
+            for size in range(1, 5):
+                for n_gram in itertools.product(labels, repeat=size):
+                    assert lazy_n_gram_index.get_marking_ids(list(n_gram)) == n_gram_index.get_marking_ids(list(n_gram))
+
+
+def test_deepen_lazy_index_with_cache():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4)
+    n_gram_index.build()
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    n_grams = [list(n_gram) for size in range(1, 6) for n_gram in itertools.product(labels, repeat=size)]
+    # Fill the cache of a lazy index with the best markings of the previous limit
+    lazy_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=2, lazy=True, cache_size=len(n_grams))
+    for n_gram in n_grams:
+        lazy_n_gram_index.get_best_marking_id_for(n_gram)
+    # Deepen it, the cached best markings are discarded
+    lazy_n_gram_index.deepen(4)
+    for n_gram in n_grams:
+        assert lazy_n_gram_index.get_best_marking_id_for(n_gram) == n_gram_index.get_best_marking_id_for(n_gram)
+
+
+def test_select_n_gram_size_limit():
+    identification_depths = {0: 1, 1: 1, 2: 2, 3: 3, 4: None}
+    assert NGramIndex.select_n_gram_size_limit(identification_depths, coverage=0.2) == 1
+    assert NGramIndex.select_n_gram_size_limit(identification_depths, coverage=0.6) == 2
+    assert NGramIndex.select_n_gram_size_limit(identification_depths, coverage=0.8) == 3
+    assert NGramIndex.select_n_gram_size_limit(identification_depths, coverage=0.0) == 1
+    with pytest.raises(RuntimeError):
+        NGramIndex.select_n_gram_size_limit(identification_depths)
+
+
+def test_build_with_marking_limits():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    automaton = ReverseSuffixAutomaton(reachability_graph)
+    automaton.build()
+    identification_depths = automaton.get_identification_depths()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    n_gram_index.build()
+    # With the depths of the markings as limits, the index is the same
+    limited_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    limited_n_gram_index.build(marking_limits={
+        marking_id: depth for marking_id, depth in identification_depths.items() if depth is not None
+    })
+    assert limited_n_gram_index.markings == n_gram_index.markings
+    # Limiting the markings with unbounded depth, their n-grams are not expanded (with the same markings)
+    marking_limits = {marking_id: 2 if depth is None else depth for marking_id, depth in identification_depths.items()}
+    limited_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    limited_n_gram_index.build(marking_limits=marking_limits)
+    assert len(limited_n_gram_index.markings) < len(n_gram_index.markings)
+    for n_gram, markings in limited_n_gram_index.markings.items():
+        assert markings == n_gram_index.markings[n_gram]
+        if len(n_gram) > 2:
+            assert any(marking_limits[marking] >= len(n_gram) for marking in n_gram_index.markings[n_gram[1:]])
+    # Only available in sequential complete builds
+    with pytest.raises(RuntimeError):
+        limited_n_gram_index.build(marking_limits=marking_limits, workers=2)
+
+
+def test_build_with_budgets(monkeypatch):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    n_gram_index.build()
+    # Check the budgets every few paths
+    monkeypatch.setattr(NGramIndex, "BUILD_CHECKPOINT_INTERVAL", 5)
+    # Report the progress without stopping
+    reports = []
+    reported_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    reported_n_gram_index.build(progress=lambda *report: reports.append(report))
+    assert not reported_n_gram_index.truncated
+    assert reported_n_gram_index.markings == n_gram_index.markings
+    assert [level for level, _, _ in reports] == sorted(level for level, _, _ in reports)
+    assert reports[-1] == (6, 0, len(n_gram_index.markings))
+    # Stop at a maximum number of n-grams, keeping the ones completely expanded
+    for max_entries in [10, len(n_gram_index.markings) // 4, len(n_gram_index.markings) // 2]:
+        truncated_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+        truncated_n_gram_index.build(max_entries=max_entries)
+        assert truncated_n_gram_index.truncated
+        assert len(truncated_n_gram_index.markings) <= max_entries
+        _assert_same_as_new_build(truncated_n_gram_index)
+        # The index can be completed later
+        truncated_n_gram_index.deepen(6)
+        assert not truncated_n_gram_index.truncated
+        assert truncated_n_gram_index.markings == n_gram_index.markings
+    # Stop at a maximum duration, or when cancelled
+    cancel = threading.Event()
+    cancel.set()
+    for budget in [{"max_seconds": 0}, {"cancel": cancel}]:
+        truncated_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+        truncated_n_gram_index.build(**budget)
+        assert truncated_n_gram_index.truncated
+        assert truncated_n_gram_index.n_gram_size_limit == 0
+        assert len(truncated_n_gram_index.markings) == 0
+    # Only available in sequential complete builds
+    with pytest.raises(RuntimeError):
+        truncated_n_gram_index.build(max_entries=10, vectorized=True)
+
+
+def test_resume_build(monkeypatch, temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    # Save the state of the expansion every few paths
+    monkeypatch.setattr(NGramIndex, "BUILD_CHECKPOINT_INTERVAL", 5)
+    for encode_activities, marking_limits in [
+        (False, None),
+        (True, None),
+        (False, {marking_id: 1 + marking_id % 5 for marking_id in reachability_graph.markings}),
+    ]:
+        n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6, encode_activities=encode_activities)
+        n_gram_index.build(marking_limits=marking_limits)
+        for num_reports in [2, 7, 20]:
+            # Interrupt the build abruptly after some reports (the state was saved in the previous one)
+            def interrupt(*_):
+                reports.append(_)
+                if len(reports) == num_reports:
+                    raise KeyboardInterrupt
+
+            reports = []
+            interrupted_n_gram_index = NGramIndex(
+                reachability_graph, n_gram_size_limit=6, encode_activities=encode_activities
+            )
+            with pytest.raises(KeyboardInterrupt):
+                interrupted_n_gram_index.build(
+                    marking_limits=marking_limits,
+                    progress=interrupt,
+                    checkpoint_path=temp_file_path,
+                    checkpoint_seconds=0,
+                )
+            # Resume it in a new index, stopping it again at a budget
+            cancel = threading.Event()
+            cancel.set()
+            resumed_n_gram_index = NGramIndex(
+                reachability_graph, n_gram_size_limit=3, encode_activities=encode_activities
+            )
+            resumed_n_gram_index.resume_build(temp_file_path, cancel=cancel, checkpoint_seconds=0)
+            assert resumed_n_gram_index.truncated
+            # Resume it until complete
+            resumed_n_gram_index = NGramIndex(
+                reachability_graph, n_gram_size_limit=3, encode_activities=encode_activities
+            )
+            resumed_n_gram_index.resume_build(temp_file_path)
+            assert not resumed_n_gram_index.truncated
+            assert resumed_n_gram_index.n_gram_size_limit == 6
+            assert resumed_n_gram_index.markings == n_gram_index.markings
+            assert list(resumed_n_gram_index.markings) == list(n_gram_index.markings)
+            assert resumed_n_gram_index.resolutions == n_gram_index.resolutions
+            # The checkpoint is removed once the expansion is complete
+            assert not os.path.exists(temp_file_path)
+    # Not valid for another reachability graph
+    other_reachability_graph = _bpmn_model_with_AND_and_nested_XOR().get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    n_gram_index.build(max_entries=10, checkpoint_path=temp_file_path)
+    with pytest.raises(RuntimeError):
+        NGramIndex(other_reachability_graph, n_gram_size_limit=6).resume_build(temp_file_path)
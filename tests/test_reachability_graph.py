@@ -75,6 +75,34 @@ def test_reachability_graph_model():
     assert len(graph.markings) == 8
 
 
+def test_frozen_markings():
+    graph = _simple_reachability_graph()
+    marking_id = graph.marking_to_key[("11", "6")]
+    # Assert the frozen version of each marking is equal and immutable
+    assert len(graph.frozen_markings) == len(graph.markings)
+    assert graph.get_frozen_marking(marking_id) == graph.markings[marking_id]
+    assert isinstance(graph.get_frozen_marking(marking_id), frozenset)
+    # Assert the same instance is returned in each call
+    assert graph.get_frozen_marking(marking_id) is graph.get_frozen_marking(marking_id)
+
+
+def test_get_incoming_csr():
+    graph = _non_deterministic_reachability_graph()
+    activity_codes = {label: code for code, label in enumerate(sorted(graph.activity_to_edges))}
+    (indptr, codes, sources) = graph.get_incoming_csr(activity_codes)
+    assert len(indptr) == len(graph.markings) + 1
+    assert len(codes) == len(sources) == len(graph.edges)
+    # The incoming edges of each marking are in its range of the arrays
+    for marking_id in graph.markings:
+        incoming_edges = {
+            (activity_codes[graph.edge_to_activity[edge_id]], graph.edges[edge_id][0])
+            for edge_id in graph.incoming_edges[marking_id]
+        }
+        start, end = indptr[marking_id], indptr[marking_id + 1]
+        assert set(zip(codes[start:end].tolist(), sources[start:end].tolist())) == incoming_edges
+        assert end - start == len(graph.incoming_edges[marking_id])
+
+
 def test_get_markings_from_activity_sequence_simple():
     # Instantiate graph
     graph = _simple_reachability_graph()
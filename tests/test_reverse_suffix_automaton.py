@@ -0,0 +1,83 @@
+import itertools
+
+from ongoing_process_state.n_gram_index import NGramIndex
+from ongoing_process_state.reverse_suffix_automaton import ReverseSuffixAutomaton
+from test_bpmn_model_fixtures import _bpmn_model_with_AND_and_XOR, _bpmn_model_with_loop_inside_AND, \
+    _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND, _bpmn_model_with_XOR_within_AND
+
+
+def test_build_simple():
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    automaton = ReverseSuffixAutomaton(reachability_graph)
+    automaton.build()
+    # Check specific markings
+    assert automaton.get_marking_state([NGramIndex.TRACE_START]) == [{"1"}]
+    assert automaton.get_marking_state(["A"]) == [{"5", "6"}]
+    assert automaton.get_marking_state(["A", "B"]) == [{"9", "6"}]
+    assert automaton.get_marking_state(["C", "B"]) == [{"12"}]
+    assert automaton.get_marking_state(["F"]) == [{"23"}]
+    assert automaton.get_marking_state(["F", "A"]) == []
+    # Check best markings
+    assert automaton.get_best_marking_state_for(["A", "C", "B"]) == {"12"}
+    assert automaton.get_best_marking_state_for(["Z", "C", "Z", "B"]) == {"12"}
+    assert automaton.get_best_marking_state_for([]) == {"1"}
+
+
+def test_same_markings_as_n_gram_index():
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    automaton = ReverseSuffixAutomaton(reachability_graph)
+    automaton.build()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=6)
+    n_gram_index.build()
+    # The automaton is smaller than the index
+    assert len(automaton) < len(n_gram_index.markings)
+    # Check the markings of each n-gram in the index are the same
+    for n_gram, markings in n_gram_index.markings.items():
+        assert automaton.get_marking_ids(list(n_gram)) == markings
+    # Check the best marking of all n-grams shorter than the limit of the index is the same
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    for size in range(1, 5):
+        for n_gram in itertools.product(labels, repeat=size):
+            assert automaton.get_best_marking_id_for(list(n_gram)) == \
+                   n_gram_index.get_best_marking_id_for(list(n_gram))
+
+
+def test_unbounded_n():
+    bpmn_model = _bpmn_model_with_loop_inside_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    automaton = ReverseSuffixAutomaton(reachability_graph)
+    automaton.build()
+    # Long histories are read until the state is deterministic, beyond any n limit
+    n_gram = [NGramIndex.TRACE_START, "A"] + ["B", "C"] * 10 + ["D"]
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=len(n_gram))
+    n_gram_index.build()
+    assert automaton.get_best_marking_state_for(n_gram) == n_gram_index.get_best_marking_state_for(n_gram)
+
+
+def test_identification_depths():
+    for bpmn_model in [
+        _bpmn_model_with_AND_and_XOR(),
+        _bpmn_model_with_XOR_within_AND(),
+        _bpmn_model_with_loop_inside_AND(),
+        _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND(),
+    ]:
+        reachability_graph = bpmn_model.get_reachability_graph()
+        automaton = ReverseSuffixAutomaton(reachability_graph)
+        automaton.build()
+        identification_depths = automaton.get_identification_depths()
+        assert set(identification_depths) == set(reachability_graph.markings)
+        # The longest n-gram associated to each marking in an index with a larger limit is its depth
+        n_gram_size_limit = max([depth for depth in identification_depths.values() if depth is not None]) + 2
+        n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=n_gram_size_limit)
+        n_gram_index.build()
+        for marking_id, depth in identification_depths.items():
+            longest = max([len(n_gram) for n_gram, markings in n_gram_index.markings.items() if marking_id in markings])
+            assert longest == (n_gram_size_limit if depth is None else depth)
+    # Specific depths
+    bpmn_model = _bpmn_model_with_XOR_within_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    automaton = ReverseSuffixAutomaton(reachability_graph)
+    automaton.build()
+    assert sorted(automaton.get_identification_depths().values()) == [1, 1, 1, 2, 2, 2, 3, 3, 3, 3]
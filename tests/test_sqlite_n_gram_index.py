@@ -0,0 +1,131 @@
+import itertools
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ongoing_process_state.n_gram_index import NGramIndex
+from test_bpmn_model_fixtures import _bpmn_model_with_AND_and_XOR, _bpmn_model_with_XOR_within_AND, \
+    _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND
+
+
+@pytest.fixture
+def temp_file_path():
+    # Create a temporary file and get the path
+    tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)  # Set delete=False
+    path = tmp.name
+    try:
+        yield path
+    finally:
+        # Cleanup: close the file and remove it (with the files of the write-ahead log, if any)
+        tmp.close()
+        for file_path in [path, f"{path}-wal", f"{path}-shm", f"{path}.db"]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def test_sqlite_simple(temp_file_path):
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    n_gram_index.to_sqlite(temp_file_path)
+    sqlite_n_gram_index = NGramIndex.from_sqlite(temp_file_path, reachability_graph)
+    # Check size and storage mode
+    assert len(sqlite_n_gram_index) == len(n_gram_index.markings)
+    assert sqlite_n_gram_index.n_gram_size_limit == 3
+    connection = sqlite3.connect(temp_file_path)
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    connection.close()
+    # Check specific markings
+    assert sqlite_n_gram_index.get_marking_state([NGramIndex.TRACE_START]) == [{"1"}]
+    assert sqlite_n_gram_index.get_marking_state(["A"]) == [{"5", "6"}]
+    assert sqlite_n_gram_index.get_marking_state(["A", "B"]) == [{"9", "6"}]
+    assert sqlite_n_gram_index.get_marking_state(["C", "B"]) == [{"12"}]
+    assert sqlite_n_gram_index.get_marking_state(["F"]) == [{"23"}]
+    # Check missing n-grams
+    assert sqlite_n_gram_index.get_marking_state(["F", "A"]) == []
+    assert sqlite_n_gram_index.get_marking_state(["Z"]) == []
+    # Check best markings
+    assert sqlite_n_gram_index.get_best_marking_state_for(["A", "C", "B"]) == {"12"}
+    assert sqlite_n_gram_index.get_best_marking_state_for(["Z", "C", "Z", "B"]) == {"12"}
+    assert sqlite_n_gram_index.get_best_marking_state_for([]) == {"1"}
+    sqlite_n_gram_index.close()
+    # Store again, replacing the previous content
+    NGramIndex(reachability_graph, n_gram_size_limit=3).to_sqlite(temp_file_path)
+    sqlite_n_gram_index = NGramIndex.from_sqlite(temp_file_path, reachability_graph)
+    assert len(sqlite_n_gram_index) == 0
+    assert sqlite_n_gram_index.get_best_marking_state_for(["A"]) == {"1"}
+    sqlite_n_gram_index.close()
+    # Not valid for another reachability graph
+    with pytest.raises(RuntimeError):
+        NGramIndex.from_sqlite(temp_file_path, _bpmn_model_with_XOR_within_AND().get_reachability_graph())
+
+
+def test_sqlite_same_lookups(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    for encode_activities, tier_split in [(False, None), (True, None), (False, 2)]:
+        n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=4, encode_activities=encode_activities)
+        n_gram_index.build(tier_split=tier_split, tier_path=f"{temp_file_path}.db")
+        n_gram_index.to_sqlite(temp_file_path)
+        sqlite_n_gram_index = NGramIndex.from_sqlite(temp_file_path, reachability_graph)
+        # Check the markings of each n-gram are the same
+        for n_gram_key, markings in n_gram_index._get_associations():
+            assert sqlite_n_gram_index.get_marking_ids(list(n_gram_index._get_labels(n_gram_key))) == markings
+        # Check the best marking of all n-grams up to size 4 is the same
+        labels = [NGramIndex.TRACE_START, "Z"] + list(reachability_graph.activity_to_edges)
+        for size in range(1, 5):
+            for n_gram in itertools.product(labels, repeat=size):
+                assert sqlite_n_gram_index.get_best_marking_id_for(list(n_gram)) == \
+                       n_gram_index.get_best_marking_id_for(list(n_gram))
+        sqlite_n_gram_index.close()
+        if n_gram_index.disk_tier is not None:
+            n_gram_index.disk_tier.close()
+
+
+def test_sqlite_concurrent_lookups(temp_file_path):
+    bpmn_model = _bpmn_model_with_three_loops_inside_AND_two_of_them_inside_sub_AND()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=5)
+    n_gram_index.build()
+    n_gram_index.to_sqlite(temp_file_path)
+    # Query from more threads than connections in the pool
+    sqlite_n_gram_index = NGramIndex.from_sqlite(temp_file_path, reachability_graph, pool_size=2)
+    labels = [NGramIndex.TRACE_START] + list(reachability_graph.activity_to_edges)
+    n_grams = [list(n_gram) for n_gram in itertools.product(labels, repeat=4)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        states = list(executor.map(sqlite_n_gram_index.get_best_marking_state_for, n_grams))
+    assert states == [n_gram_index.get_best_marking_state_for(n_gram) for n_gram in n_grams]
+    sqlite_n_gram_index.close()
+    # Indexes with partial-order keys cannot be stored
+    partial_order_n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3, partial_order=True)
+    partial_order_n_gram_index.build()
+    with pytest.raises(RuntimeError):
+        partial_order_n_gram_index.to_sqlite(temp_file_path)
+
+
+def test_sqlite_close_with_connections_in_use(temp_file_path):
+    bpmn_model = _bpmn_model_with_AND_and_XOR()
+    reachability_graph = bpmn_model.get_reachability_graph()
+    n_gram_index = NGramIndex(reachability_graph, n_gram_size_limit=3)
+    n_gram_index.build()
+    n_gram_index.to_sqlite(temp_file_path)
+    sqlite_n_gram_index = NGramIndex.from_sqlite(temp_file_path, reachability_graph, pool_size=1)
+    # Close the index while its only connection is in use, and another thread is waiting for it
+    waiting = ThreadPoolExecutor(max_workers=1)
+    with sqlite_n_gram_index._connection() as connection:
+        future = waiting.submit(sqlite_n_gram_index.get_best_marking_state_for, ["A"])
+        sqlite_n_gram_index.close()
+        assert connection.execute("SELECT COUNT(*) FROM n_grams").fetchone()[0] == len(n_gram_index.markings)
+    # The connection is closed once returned, instead of going back to the pool
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection.execute("SELECT COUNT(*) FROM n_grams")
+    # The waiting thread and later queries fail
+    with pytest.raises(RuntimeError):
+        future.result(timeout=10)
+    waiting.shutdown()
+    with pytest.raises(RuntimeError):
+        sqlite_n_gram_index.get_best_marking_state_for(["A"])
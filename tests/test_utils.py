@@ -1,7 +1,8 @@
 from pathlib import Path
 
 from ongoing_process_state.bpmn_model import BPMNNodeType
-from ongoing_process_state.utils import read_bpmn_model, read_petri_net
+from ongoing_process_state.n_gram_index import NGramIndex
+from ongoing_process_state.utils import read_bpmn_model, read_petri_net, read_n_grams_from_event_log
 
 
 def test_read_bpmn_model():
@@ -103,3 +104,19 @@ def test_read_petri_net():
     marking = petri_net.simulate_execution("task-26", marking)
     assert marking == {"sink"}
     assert petri_net.is_final_marking(marking)
+
+
+def test_read_n_grams_from_event_log():
+    log_path = Path("./tests/assets/event_log_test.csv")
+    n_grams = read_n_grams_from_event_log(log_path, n_gram_size=3)
+    # Assert one n-gram per event
+    assert len(n_grams) == 15
+    # Assert the n-grams of the first case
+    assert n_grams[0] == [NGramIndex.TRACE_START, "A"]
+    assert n_grams[1] == [NGramIndex.TRACE_START, "A", "B"]
+    assert n_grams[2] == ["A", "B", "C"]
+    assert n_grams[3] == ["B", "C", "D"]
+    assert n_grams[4] == ["C", "D", "F"]
+    # Assert the n-grams of the second case
+    assert n_grams[5] == [NGramIndex.TRACE_START, "A"]
+    assert n_grams[9] == ["B", "E", "F"]